@@ -19,6 +19,8 @@ SET time_zone = "+00:00";
 --
 -- Database: `admin_telegbots`
 --
+-- Only needed with dbbackend = 'mysql'. The sqlite backend creates the same tables itself
+--
 
 -- --------------------------------------------------------
 
@@ -32,10 +34,120 @@ CREATE TABLE IF NOT EXISTS `repos` (
   `url` varchar(100) NOT NULL,
   `commit_hash` varchar(100) NOT NULL DEFAULT '0',
   `adminonly` tinyint(1) NOT NULL DEFAULT '0',
+  `buildmatrix` varchar(255) NOT NULL DEFAULT '',
+  `autobuild` tinyint(1) NOT NULL DEFAULT '0',
+  `delivery` varchar(16) NOT NULL DEFAULT 'full',
+  `selected` tinyint(1) NOT NULL DEFAULT '1',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `chatid` (`chatid`,`url`),
+  KEY `url` (`url`),
+  KEY `autobuild` (`autobuild`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 AUTO_INCREMENT=1 ;
+
+-- Upgrading an existing database:
+-- ALTER TABLE `repos` ADD `buildmatrix` varchar(255) NOT NULL DEFAULT '' AFTER `adminonly`;
+-- ALTER TABLE `repos` ADD `autobuild` tinyint(1) NOT NULL DEFAULT '0' AFTER `buildmatrix`, ADD KEY `autobuild` (`autobuild`);
+-- ALTER TABLE `repos` ADD `delivery` varchar(16) NOT NULL DEFAULT 'full' AFTER `autobuild`;
+-- ALTER TABLE `repos` ADD KEY `url` (`url`);
+-- ALTER TABLE `repos` ADD `selected` tinyint(1) NOT NULL DEFAULT '1' AFTER `delivery`, DROP KEY `chatid`, ADD UNIQUE KEY `chatid` (`chatid`,`url`);
+-- UPDATE `repos` SET `url`=LOWER(TRIM(BOTH '/' FROM `url`));
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `remotes`
+-- Every github repo added by any chat, built once for all of them
+--
+
+CREATE TABLE IF NOT EXISTS `remotes` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `url` varchar(100) NOT NULL,
+  `commit_hash` varchar(100) DEFAULT NULL,
+  `built` double DEFAULT NULL,
+  `log` mediumtext,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `url` (`url`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 AUTO_INCREMENT=1 ;
+
+-- Upgrading an existing database:
+-- INSERT IGNORE INTO `remotes` (`url`) SELECT DISTINCT `url` FROM `repos`;
+-- ALTER TABLE `remotes` ADD `log` mediumtext AFTER `built`;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `apkfiles`
+--
+
+CREATE TABLE IF NOT EXISTS `apkfiles` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `url` varchar(255) NOT NULL,
+  `commit_hash` varchar(100) NOT NULL,
+  `variant` varchar(100) NOT NULL,
+  `file_id` varchar(255) NOT NULL,
   PRIMARY KEY (`id`),
-  UNIQUE KEY `chatid` (`chatid`)
+  UNIQUE KEY `artifact` (`url`,`commit_hash`,`variant`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8 AUTO_INCREMENT=1 ;
 
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `buildjobs`
+--
+
+CREATE TABLE IF NOT EXISTS `buildjobs` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `repokey` varchar(255) NOT NULL,
+  `url` varchar(100) NOT NULL DEFAULT '',
+  `commit_hash` varchar(100) DEFAULT NULL,
+  `buildmatrix` varchar(255) NOT NULL DEFAULT '',
+  `chatid` bigint(20) NOT NULL,
+  `messageid` int(11) NOT NULL,
+  `replyto` int(11) NOT NULL,
+  `force` tinyint(1) NOT NULL DEFAULT '0',
+  `priority` int(11) NOT NULL DEFAULT '10',
+  `state` varchar(16) NOT NULL DEFAULT 'queued',
+  `worker` varchar(100) DEFAULT NULL,
+  `created` double NOT NULL,
+  `started` double DEFAULT NULL,
+  `heartbeat` double DEFAULT NULL,
+  `finished` double DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `claim` (`state`,`priority`,`id`),
+  KEY `repokey` (`state`,`repokey`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 AUTO_INCREMENT=1 ;
+
+-- Upgrading an existing database, with no jobs queued:
+-- ALTER TABLE `buildjobs` ADD `url` varchar(100) NOT NULL DEFAULT '' AFTER `repokey`, ADD `buildmatrix` varchar(255) NOT NULL DEFAULT '' AFTER `commit_hash`;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `buildhistory`
+-- Append only, one row per finished build. Rows older than historyretention are pruned
+--
+
+CREATE TABLE IF NOT EXISTS `buildhistory` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `url` varchar(100) NOT NULL,
+  `commit_hash` varchar(100) DEFAULT NULL,
+  `buildmatrix` varchar(255) NOT NULL DEFAULT '',
+  `result` varchar(16) NOT NULL,
+  `reason` varchar(16) NOT NULL,
+  `chatid` bigint(20) DEFAULT NULL,
+  `chats` int(11) NOT NULL DEFAULT '1',
+  `started` double NOT NULL,
+  `duration` double NOT NULL,
+  `artifactbytes` bigint(20) NOT NULL DEFAULT '0',
+  `peakmemory` bigint(20) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `repo` (`url`,`started`),
+  KEY `started` (`started`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 AUTO_INCREMENT=1 ;
+
+-- Upgrading an existing database:
+-- ALTER TABLE `buildhistory` ADD `peakmemory` bigint(20) DEFAULT NULL AFTER `artifactbytes`;
+
 /*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;
 /*!40101 SET CHARACTER_SET_RESULTS=@OLD_CHARACTER_SET_RESULTS */;
 /*!40101 SET COLLATION_CONNECTION=@OLD_COLLATION_CONNECTION */;
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import logging
+
+from telegram import Update
+
+from mwt import MWT
+
+logger = logging.getLogger(__name__)
+
+ADMIN_STATUSES = ('creator', 'administrator')
+"""Update types announcing membership changes. python-telegram-bot 8 does not parse them, Update.de_json drops them"""
+MEMBER_UPDATES = ('chat_member', 'my_chat_member')
+
+
+class AdminIndex(object):
+	"""In memory index of the admins of every group the bot has seen.
+
+	The admin list of a group is loaded with get_chat_administrators the first time it is needed and kept until a
+	member update or service message tells that it changed. Lists are reloaded after ttl seconds anyway to recover
+	from updates missed while the bot was down. Concurrent loads of a group share one api call. At most maxsize groups
+	are indexed, the least recently used one is dropped first"""
+
+	def __init__(self, ttl=60 * 60, maxsize=4096):
+		@MWT(timeout=ttl, maxsize=maxsize, key=lambda bot, chat_id: chat_id)
+		def fetch(bot, chat_id):
+			return set(admin.user.id for admin in bot.get_chat_administrators(chat_id))
+		self._fetch = fetch
+
+	def isadmin(self, bot, chat_id, user_id):
+		"""Return True if the user is an admin of the group"""
+		return user_id in self._fetch(bot, chat_id)
+
+	def invalidate(self, chat_id):
+		"""Forget the admins of the group so they are loaded again on the next check"""
+		self._fetch.invalidate(None, chat_id)
+
+	def memberupdate(self, kind, data):
+		"""Apply a raw chat_member or my_chat_member update. A change of the bot itself may change what it can see of
+		the group, any other change only matters if the user becomes or stops being an admin"""
+		chat_id = (data.get('chat') or {}).get('id')
+		if chat_id is None:
+			return
+		old = (data.get('old_chat_member') or {}).get('status')
+		new = (data.get('new_chat_member') or {}).get('status')
+		if kind == 'my_chat_member' or (old != new and (old in ADMIN_STATUSES or new in ADMIN_STATUSES)):
+			self.invalidate(chat_id)
+
+	def track(self, update):
+		"""Update the index from the service messages of an incoming update"""
+		message = update.message
+		if message is not None:
+			if message.left_chat_member is not None or message.migrate_to_chat_id:
+				self.invalidate(message.chat_id)
+
+	def watch(self):
+		"""Feed the member updates of every update parsed by python-telegram-bot, polled or received by the webhook, to
+		the index before Update.de_json drops them"""
+		parse = Update.de_json.__func__
+		index = self
+
+		def de_json(cls, data, bot):
+			for kind in MEMBER_UPDATES:
+				if data and data.get(kind):
+					try:
+						index.memberupdate(kind, data[kind])
+					except Exception as e:
+						logger.info(e)
+			return parse(cls, data, bot)
+		Update.de_json = classmethod(de_json)
+
+	def stats(self):
+		stats = self._fetch.stats()
+		return {'groups': stats['size'], 'loads': stats['misses']}
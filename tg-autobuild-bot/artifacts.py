@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+artifactdir = getattr(config, 'artifactdir', 'artifacts')
+artifactmaxsize = getattr(config, 'artifactmaxsize', 2 * 1024 * 1024 * 1024)
+artifactmaxcount = getattr(config, 'artifactmaxcount', 500)
+
+DEFAULT_VARIANT = 'release'
+
+"""A stored apk. url, commit and variant form the key of the artifact and path is where the apk is stored"""
+Artifact = namedtuple('Artifact', 'url commit variant path')
+
+
+def isabbreviation(short, sha):
+	"""Return True if short is sha or an abbreviation of it. Only hex hashes of at least 7 characters count, the
+	default commit_hash '0' of a chat which never built and empty hashes match nothing"""
+	if not short or not sha or len(short) < 7:
+		return False
+	try:
+		int(short, 16)
+	except ValueError:
+		return False
+	return sha.startswith(short)
+
+
+def filehash(path):
+	"""Return the sha256 hex digest of a file"""
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+class ArtifactStore(object):
+	"""Content addressed store of built apks.
+
+	Artifacts are indexed by (repo url, commit sha, build variant) in index.json inside the store directory. The apk
+	itself is kept once per content hash under <sha256[:2]>/<sha256>/<name> so the same apk indexed under several
+	keys is only stored once. Least recently used entries are evicted once the store holds more than maxsize bytes or
+	maxcount entries"""
+
+	def __init__(self, root, maxsize, maxcount):
+		self.root = root
+		self.maxsize = maxsize
+		self.maxcount = maxcount
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		self._indexpath = os.path.join(root, 'index.json')
+		self._index = self._load()
+
+	def _load(self):
+		try:
+			with open(self._indexpath) as f:
+				return json.load(f)
+		except IOError:
+			return {}
+		except ValueError as e:
+			logger.info("Artifact index is corrupt, starting with an empty one: %s", e)
+			return {}
+
+	def _save(self):
+		"""Write the index atomically. Must be called with the lock held"""
+		if not os.path.isdir(self.root):
+			os.makedirs(self.root)
+		tmp = self._indexpath + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(self._index, f)
+		os.rename(tmp, self._indexpath)
+
+	@staticmethod
+	def _key(url, commit, variant):
+		return '{0}@{1}#{2}'.format(url, commit, variant)
+
+	def _find(self, url, commit, variant):
+		"""Return the index key of an artifact. commit may be an abbreviated sha. Must be called with the lock held"""
+		if not isabbreviation(commit, commit):
+			return None
+		key = self._key(url, commit, variant)
+		if key in self._index:
+			return key
+		for candidate, entry in self._index.items():
+			if entry['url'] == url and entry['variant'] == variant and isabbreviation(commit, entry['commit']):
+				return candidate
+		return None
+
+	def get(self, url, commit, variant=DEFAULT_VARIANT):
+		"""Return the Artifact or None if it is not stored"""
+		with self._lock:
+			key = self._find(url, commit, variant)
+			entry = self._index.get(key) if key is not None else None
+			if entry is None or not os.path.isfile(os.path.join(self.root, entry['file'])):
+				if entry is not None:
+					del self._index[key]
+					self._save()
+				self.misses += 1
+				return None
+			entry['atime'] = time.time()
+			self.hits += 1
+			return Artifact(url, entry['commit'], variant, os.path.join(self.root, entry['file']))
+
+	def put(self, url, commit, srcpath, name, variant=DEFAULT_VARIANT):
+		"""Move srcpath into the store under the given key and return the stored Artifact"""
+		sha256 = filehash(srcpath)
+		relpath = os.path.join(sha256[:2], sha256, name)
+		destpath = os.path.join(self.root, relpath)
+		with self._lock:
+			if os.path.isfile(destpath):
+				os.remove(srcpath)
+			else:
+				if not os.path.isdir(os.path.dirname(destpath)):
+					os.makedirs(os.path.dirname(destpath))
+				shutil.move(srcpath, destpath)
+			now = time.time()
+			self._index[self._key(url, commit, variant)] = {
+				'url': url, 'commit': commit, 'variant': variant, 'file': relpath, 'sha256': sha256,
+				'size': os.path.getsize(destpath), 'created': now, 'atime': now}
+			self._evict()
+			self._save()
+		return Artifact(url, commit, variant, destpath)
+
+	def digest(self, artifact):
+		"""Return the sha256 of the stored apk of artifact"""
+		with self._lock:
+			entry = self._index.get(self._key(artifact.url, artifact.commit, artifact.variant))
+		if entry is not None:
+			return entry['sha256']
+		return filehash(artifact.path)
+
+	def tag(self, artifact, commit):
+		"""Index the stored apk of artifact under another commit of the same repo, i.e. when the commits in between
+		did not change the build. Returns the new Artifact or None if artifact is not stored anymore"""
+		with self._lock:
+			entry = self._index.get(self._key(artifact.url, artifact.commit, artifact.variant))
+			if entry is None or not os.path.isfile(os.path.join(self.root, entry['file'])):
+				return None
+			now = time.time()
+			tagged = dict(entry, commit=commit, created=now, atime=now)
+			self._index[self._key(artifact.url, commit, artifact.variant)] = tagged
+			self._evict()
+			self._save()
+		return Artifact(artifact.url, commit, artifact.variant, artifact.path)
+
+	def _evict(self):
+		"""Drop the least recently used entries until the store fits its limits. Must be called with the lock held"""
+		files = {}
+		for entry in self._index.values():
+			files[entry['file']] = entry['size']
+		total = sum(files.values())
+		for key, entry in sorted(self._index.items(), key=lambda item: item[1]['atime']):
+			if total <= self.maxsize and len(self._index) <= self.maxcount:
+				break
+			del self._index[key]
+			if any(other['file'] == entry['file'] for other in self._index.values()):
+				continue
+			total -= files[entry['file']]
+			path = os.path.join(self.root, entry['file'])
+			try:
+				os.remove(path)
+				if not os.listdir(os.path.dirname(path)):
+					os.rmdir(os.path.dirname(path))
+			except OSError as e:
+				logger.info(e)
+
+	def flush(self):
+		"""Persist access times which are only kept in memory by get()"""
+		with self._lock:
+			self._save()
+
+	def stats(self):
+		with self._lock:
+			sizes = dict((entry['file'], entry['size']) for entry in self._index.values())
+			return {'entries': len(self._index), 'bytes': sum(sizes.values()), 'hits': self.hits, 'misses': self.misses}
+
+
+store = ArtifactStore(artifactdir, artifactmaxsize, artifactmaxcount)
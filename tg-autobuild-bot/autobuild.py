@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+import hashlib
+import hmac
+import json
+import logging
+import random
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+import config
+import metrics
+import mysqlHelper as db
+import remotehead
+from githelper import samecommit
+
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+autobuildinterval = getattr(config, 'autobuildinterval', 300)
+autobuildjitter = getattr(config, 'autobuildjitter', 0.2)
+pushwebhookport = getattr(config, 'pushwebhookport', 0)
+pushwebhooklisten = getattr(config, 'pushwebhooklisten', '127.0.0.1')
+pushwebhookpath = getattr(config, 'pushwebhookpath', '/github')
+pushwebhooksecret = getattr(config, 'pushwebhooksecret', '')
+
+
+class ChangeDetector(object):
+	"""Finds new upstream commits of the repos of every chat which enabled automatic builds.
+
+	Every interval seconds, randomly stretched or shortened by jitter so many bots do not hit github in lockstep, the
+	subscribed chats are loaded with a single query and their repos are probed at once: with one graphql request per
+	100 repos if a github token is set, otherwise with a conditional rest request per repo which github answers with
+	304 while the head did not move. No git process is started. onchange(bot, chat_id, repo, sha) is called for every
+	chat whose repo has a head it did not build yet. A head is only reported once per chat so a failing commit is not
+	built again on every check"""
+
+	def __init__(self, onchange, interval=autobuildinterval, jitter=autobuildjitter):
+		self.onchange = onchange
+		self.interval = interval
+		self.jitter = jitter
+		self.checks = 0
+		self.changes = 0
+		self._reported = {}
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._thread = None
+		self.bot = None
+
+	def start(self, bot):
+		"""Start checking on a background thread. bot is passed on to onchange"""
+		self.bot = bot
+		self._thread = threading.Thread(target=self._run, name="autobuild")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+
+	def _run(self):
+		while not self._stop.wait(self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)):
+			try:
+				self.check()
+			except Exception as e:
+				logger.exception(e)
+
+	def check(self):
+		"""Probe every subscribed repo once and report the chats whose repo changed"""
+		with metrics.span('autobuild_change_check_seconds'):
+			subscriptions = db.getautobuilds()
+			repos = set(sub['url'] for sub in subscriptions if sub['url'])
+			heads = remotehead.githubheads(repos)
+			for repo in repos - set(heads):
+				sha = remotehead.getremotehead(repo, None, maxage=0, lsremote=False)
+				if sha is not None:
+					heads[repo] = sha
+		self.checks += 1
+		for sub in subscriptions:
+			sha = heads.get(sub['url'])
+			if sha is not None and not samecommit(sub['commit_hash'], sha):
+				self._report(sub['chatid'], sub['url'], sha)
+
+	def pushed(self, repo, sha):
+		"""Report a push to the default branch of repo to every chat which enabled automatic builds for it"""
+		repo = repo.lower()
+		remotehead.remember(repo, sha)
+		for sub in db.getautobuilds(url=repo):
+			if not samecommit(sub['commit_hash'], sha):
+				self._report(sub['chatid'], sub['url'], sha)
+
+	def _report(self, chat_id, repo, sha):
+		with self._lock:
+			if self._reported.get((chat_id, repo)) == sha:
+				return
+			self._reported[(chat_id, repo)] = sha
+			self.changes += 1
+		metrics.registry.inc('autobuild_changes_total')
+		try:
+			self.onchange(self.bot, chat_id, repo, sha)
+		except Exception as e:
+			logger.exception(e)
+
+	def stats(self):
+		with self._lock:
+			return {'checks': self.checks, 'changes': self.changes}
+
+
+def verifysignature(secret, body, signature):
+	"""Check the X-Hub-Signature-256 header github signs the payload of a webhook with"""
+	if not signature or not signature.startswith('sha256='):
+		return False
+	expected = 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+	return hmac.compare_digest(expected, str(signature))
+
+
+class _PushHandler(BaseHTTPRequestHandler):
+	detector = None
+
+	def do_POST(self):
+		if self.path != pushwebhookpath:
+			self.send_error(404)
+			return
+		body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+		if not verifysignature(pushwebhooksecret, body, self.headers.get('X-Hub-Signature-256')):
+			self.send_error(403)
+			return
+		event = self.headers.get('X-GitHub-Event')
+		if event == 'push':
+			try:
+				payload = json.loads(body)
+				repository = payload['repository']
+				ref, sha = payload['ref'], payload['after']
+			except (ValueError, KeyError, TypeError):
+				self.send_error(400)
+				return
+			"""Only pushes to the default branch change what /build builds. Deleted branches push a zero sha"""
+			if ref == 'refs/heads/' + repository.get('default_branch', '') and sha.strip('0'):
+				try:
+					self.detector.pushed(repository['full_name'], sha)
+				except Exception as e:
+					logger.exception(e)
+					self.send_error(500)
+					return
+		self.send_response(204)
+		self.end_headers()
+
+	def log_message(self, format, *args):
+		logger.debug(format, *args)
+
+
+def serve(detector, listen=pushwebhooklisten, port=pushwebhookport):
+	"""Accept github push webhooks on http://listen:port/pushwebhookpath on a background thread. Does nothing if port
+	is 0. Payloads must be signed with pushwebhooksecret"""
+	if not port:
+		return None
+	if not pushwebhooksecret:
+		raise ValueError("pushwebhooksecret must be set to accept push webhooks")
+	"""BaseHTTPRequestHandler is a classic class, type() can not derive from it"""
+	class PushHandler(_PushHandler):
+		pass
+	PushHandler.detector = detector
+	server = metrics.ThreadingHTTPServer((listen, port), PushHandler)
+	thread = threading.Thread(target=server.serve_forever, name="push-webhook")
+	thread.daemon = True
+	thread.start()
+	return server
@@ -1,27 +1,64 @@
 #!/usr/bin/env python
 import logging
+import time
 
-import requests, os
+import requests
 from requests.auth import HTTPBasicAuth
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.error import (TelegramError, Unauthorized, BadRequest,
                             TimedOut, ChatMigrated, NetworkError)
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, TypeHandler
 from telegram.ext.dispatcher import run_async
 
+import autobuild
+import config
 import githelper as git
+import metrics
 import mysqlHelper as db
-from config import botapiToken, botUserName, gitusername, gitpassword
-from mwt import MWT
+from admins import AdminIndex
+from artifacts import store
+from buildhistory import formatbuild, formatduration, history
+from buildmatrix import formatmatrix, parsematrix
+from buildqueue import BuildScheduler, BuildRequest, PRIORITY_LOW, PRIORITY_NORMAL
+from deltas import deltas
+from delivery import deliver, reply, sendapk, sendlog, updatemessage
+from gradleenv import gradle
+from outbox import outbox
+from remotehead import githubapiurl
+from sandbox import buildmemory, physicalmemory, runner
+from config import botapiToken, gitusername, gitpassword
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-
-@MWT(timeout=60)
-def get_admin_ids(bot, chat_id):
-	"""Method to get list of admins of a group cached every minute"""
-	return [admin.user.id for admin in bot.get_chat_administrators(chat_id)]
+"""Optional variables. Defaults are used if they are not set in config.py"""
+maxbuilds = getattr(config, 'maxbuilds', 2)
+dispatcherworkers = getattr(config, 'dispatcherworkers', 8)
+botapiurl = getattr(config, 'botapiurl', '')
+webhookmode = getattr(config, 'webhookmode', False)
+webhooklisten = getattr(config, 'webhooklisten', '127.0.0.1')
+webhookport = getattr(config, 'webhookport', 8443)
+webhookpath = getattr(config, 'webhookpath', '')
+webhookurl = getattr(config, 'webhookurl', '')
+shutdowntimeout = getattr(config, 'shutdowntimeout', 600)
+admincachesize = getattr(config, 'admincachesize', 4096)
+adminttl = getattr(config, 'adminttl', 60 * 60)
+"""Memory the builds may take together, 3/4 of the machine by default to leave room for the bot and the system. Only a
+build sandbox which enforces the memory ceiling of a build is budgeted, without one maxbuilds alone limits the builds"""
+buildmemorybudget = getattr(config, 'buildmemorybudget', None) or physicalmemory() * 3 // 4
+if not runner.enforceslimits:
+	buildmemorybudget = None
+"""Where builds run: 'local' in this process or 'queue' in the build workers (worker.py) through the buildjobs table"""
+buildbackend = getattr(config, 'buildbackend', 'local')
+"""Number of builds /history lists"""
+historylength = getattr(config, 'historylength', 10)
+
+"""Factor from the peak memory of the recent builds of a repo to the memory its next build is expected to take"""
+MEMORY_HEADROOM = 1.25
+"""Update types the bot asks telegram for. Member updates keep the admin index up to date"""
+ALLOWED_UPDATES = ['message', 'callback_query', 'chat_member', 'my_chat_member']
+
+admins = AdminIndex(ttl=adminttl, maxsize=admincachesize)
 
 
 def is_admin(message, userid=None):
@@ -32,8 +69,8 @@ def is_admin(message, userid=None):
 
 	if message.chat.all_members_are_administrators:
 		return True
-	elif message.chat.type in (message.chat.GROUP,  message.chat.SUPERGROUP) and userid in \
-			get_admin_ids(message.bot, message.chat_id):
+	elif message.chat.type in (message.chat.GROUP,  message.chat.SUPERGROUP) and \
+			admins.isadmin(message.bot, message.chat_id, userid):
 		return True
 	elif message.chat.type in (message.chat.PRIVATE):
 		return True
@@ -44,15 +81,14 @@ def is_admin(message, userid=None):
 def setadminonly(bot, update):
 	"""Command handler method to set if the /build command must only be used by admin."""
 	msg = update.message
-	print type(msg.chat_id)
 	if not msg.chat.type == msg.chat.PRIVATE and not is_admin(msg):
-		msg.reply_text("You think you have permission to do this? Grow up!")
+		reply(msg, "You think you have permission to do this? Grow up!")
 		return
 
 	keyboard = [[InlineKeyboardButton("Yes!", callback_data="setadmin-true%{}".format(msg.from_user.id)),
 				InlineKeyboardButton("No", callback_data="setadmin-false%{}".format(msg.from_user.id))]]
 	reply_markup = InlineKeyboardMarkup(keyboard)
-	update.message.reply_text("should the build command be invoked by admins only?", reply_markup=reply_markup)
+	reply(update.message, "should the build command be invoked by admins only?", reply_markup=reply_markup)
 
 
 def start(bot, update, args):
@@ -61,91 +97,241 @@ def start(bot, update, args):
 		"""Check if there is a payload with the start command to send the log in private"""
 		params = args[0].split("_")
 		if params[0] == "sendlog":
-			logpath = db.getlogfile(params[1])
-			if os.path.isfile(logpath) and os.path.getsize(logpath) > 0:
-				update.message.reply_text("sending log")
-				sendFile(bot, update.message.chat_id, logpath)
+			"""The payload is sendlog_{chatid}_{id of the row of the repo}. Links sent before chats had several repos
+			do not name the repo"""
+			try:
+				repo = db.getrepobyid(int(params[1]), int(params[2])) if len(params) > 2 else db.getRepo(int(params[1]))
+			except ValueError:
+				repo = None
+			log = db.getbuildlog(repo) if repo else ''
+			if log:
+				reply(update.message, "sending log")
+				sendlog(bot, update.message.chat_id, log)
 			else:
-				update.message.reply_text("No log found")
+				reply(update.message, "No log found")
 			return
-	update.message.reply_text('Hello World!')
+	reply(update.message, 'Hello World!')
 
 
 def hello(bot, update):
 	"""Command handler method to display hello message"""
-	update.message.reply_text(
+	reply(update.message,
 		'Hello {}!\nTry /help to find the list of possible commands and its actions!'.format(update.message.from_user.first_name))
 
 
 def getchatid(bot, update):
 	"""Command handler method to get the chatid of the group(To debug)"""
-	update.message.reply_text(update.message.chat_id)
+	reply(update.message, update.message.chat_id)
+
+
+def selectrepo(message, args):
+	"""Return the repo of the chat named by the command arguments - {github username}/{repository} or just the name of
+	the repository - or the repo /build builds if there are none. Replies to the message and returns None if the chat
+	has no such repo or the name is ambiguous"""
+	name = str(args[0]) if args else None
+	repos = db.findrepos(message.chat_id, name)
+	if repos is None:
+		reply(message, "Could not retrieve repo. Try again later")
+	elif not repos and name is None:
+		reply(message, "No repo set. Set a repo using /setrepo first")
+	elif not repos:
+		reply(message, "This chat has no repo {0}. Its repos are: {1}".format(
+			name, ", ".join(record['url'] for record in db.getrepos(message.chat_id) or []) or "none"))
+	elif len(repos) > 1:
+		reply(message, "{0} could be any of {1}. Add the github username, i.e. {2}".format(
+			name, ", ".join(repos), repos[0]))
+	else:
+		return repos[0]
+	return None
 
 
-def forceBuild(bot, update):
+def forceBuild(bot, update, args):
 	"""Command handler method to force build the repo though the repo with latest source has already been built.
 	Is strictly admin only to prevent server load. If successful, calls build() with force=True"""
 	msg = update.message
 	if not is_admin(msg):
-		msg.reply_text("You think you have permission to do this? Grow up!")
+		reply(msg, "You think you have permission to do this? Grow up!")
 		return
-	compilerepo(bot, update, force=True)
+	compilerepo(bot, update, args, force=True)
 
 
 @run_async
-def compilerepo(bot, update, force=False):
-	"""Command handler method to sync the source, build and send the apk to the chat"""
+def compilerepo(bot, update, args=None, force=False):
+	"""Command handler method to queue a build which syncs the source, builds and sends the apk to the chat. A chat
+	with several repos names the repo to build, /build alone builds the repo set last"""
 	message = update.message
 	chat_id = message.chat_id
-	commit_hash = db.getlatesthash(chat_id)
+	if buildbackend == 'queue':
+		"""The build workers update the row of the chat, the cached copy may be outdated"""
+		db.records.invalidate(chat_id)
 
 	"""Check if admins only are allowed to run the command"""
 	if db.isadminonly(chat_id) and not is_admin(message):
-		message.reply_text("Only admins can build repo!")
+		reply(message, "Only admins can build repo!")
+		return
+	repo = selectrepo(message, args)
+	if repo is None:
 		return
+	commit_hash = db.getlatesthash(chat_id, repo)
+	buildmatrix = db.getbuildmatrix(chat_id, repo)
 
 	"""If no /forcebuild is called, there is no need to build the repo again if the latest source is already built.
 	Check if the lastest source is build and inform the user"""
-	if not force and commit_hash == git.getLatestRemoteHash(db.getrepodir(chat_id)):
+	latest_hash = git.getRemoteHead(repo)
+	if not force and git.samecommit(commit_hash, latest_hash) and \
+			git.getBuiltApk(repo, buildmatrix, commit_hash) is not None:
 		# msg = update.message.reply_text("App already built")
-		keyboard = [[InlineKeyboardButton("Yes!", callback_data="yes"), InlineKeyboardButton("No", callback_data="no")]]
+		keyboard = [[InlineKeyboardButton("Yes!", callback_data="yes%{0}".format(db.getrepoid(chat_id, repo))),
+					InlineKeyboardButton("No", callback_data="no")]]
 		reply_markup = InlineKeyboardMarkup(keyboard)
-		message.reply_text(
+		reply(message,
 			"An already built app is available for the latest source.\nDo you want to send the app?",
 			reply_markup=reply_markup)
 		return
 	if force:
-		msg = message.reply_text("Force building app")
+		msg = reply(message, "Force building app")
 	else:
-		msg = message.reply_text("Repo cloning...")
+		msg = reply(message, "Repo cloning...")
 	try:
-		if db.getRepo(chat_id) == '':
-			"""OOPS! if the code reaches this point, the user tried to /build without setting the repo url!"""
-			msg.edit_text("No repo set. Set a repo using /setrepo first")
-			return
-		"""This is where the actual build occurs! The return value is a boolean"""
-		result = git.clone(bot, msg, updatemessage, sendFile)
-		if not result:
-			"""Oops! Building app failed for some reason! Ask the user if the error log must be sent.
-			If yes, it is sent in a private chat"""
-			if message.chat.type == message.chat.PRIVATE:
-				keyboard = [[InlineKeyboardButton("Send", callback_data="err-log-send"),
-							InlineKeyboardButton("Don't send", callback_data="err-log-dntsend")]]
-			else:
-				"""Called when the chat is not private. This lets the log to be sent in private than in the group"""
-				keyboard = [[InlineKeyboardButton("Send",
-													url="https://telegram.me/{0}?start=sendlog_{1}".format(botUserName,
-													chat_id),
-													callback_data="err-log-msg-update"),
-							InlineKeyboardButton("Don't send", callback_data="err-log-dntsend")]]
-			reply_markup = InlineKeyboardMarkup(keyboard)
-			msg.edit_text(text="Build failed")
-			message.reply_text("An error has occured while building the app. Do you want me to send the log?",
-										reply_markup=reply_markup)
+		"""Builds of the same repo, commit and build matrix are coalesced, every chat waiting on it gets the same apks"""
+		queuebuild((repo, latest_hash, buildmatrix), BuildRequest(bot, message, msg, force=force, repo=repo))
 	except Exception as w:
 		logger.info(w)
 
 
+def queuebuild(key, request, priority=PRIORITY_NORMAL):
+	"""Queue a build of key - (repo, commit, build matrix) - for the request, either in the scheduler of this process or
+	in the buildjobs table for the build workers. Builds of the same repo share its directory and never run at the same
+	time"""
+	if buildbackend == 'queue':
+		jobid = db.addbuildjob('{0}@{1}#{2}'.format(*key), key[0], key[1], key[2], request.status.chat_id,
+								request.status.message_id, request.message.message_id, request.force, priority)
+		if jobid is None:
+			updatemessage(request.status, "Could not queue the build. Please try again later")
+		else:
+			updatemessage(request.status, "Waiting for a build worker")
+		return
+	scheduler.submit(key, db.getrepodir(key[0]), request, priority=priority, cost=buildcost(key[0]))
+
+
+def buildcost(repo):
+	"""Return the memory a build of the repo is expected to take: the peak of its recent builds with some headroom, up
+	to the memory ceiling of a build. Repos whose builds were never measured cost the whole ceiling"""
+	peak = history.memory(repo)
+	if peak is None:
+		return buildmemory
+	return min(buildmemory, int(peak * MEMORY_HEADROOM))
+
+
+def runbuild(job):
+	"""Build worker method. Syncs and builds the repo of the job reporting the progress to every waiting chat"""
+	def progress(text):
+		for request in list(job.requests):
+			updatemessage(request.status, text)
+	"""This is where the actual build occurs! The return value is the result and the apk location"""
+	force = any(request.force for request in job.requests)
+	repo, commit_hash, buildmatrix = job.key
+	report = {}
+	started = time.time()
+	result = None
+	try:
+		result = git.clone(repo, buildmatrix, progress, force=force, commit=commit_hash, report=report)
+	finally:
+		history.finished(repo, buildmatrix, commit_hash, job.requests, result, report, started)
+	return result
+
+
+def deliverbuild(job, result):
+	"""Build worker method to send the apks to every chat waiting on the job or inform them that the build failed"""
+	deliver(job.requests, result)
+
+
+def queueautobuild(bot, chat_id, repo, sha):
+	"""Change detector method to build a new upstream commit for a chat which turned on automatic builds. The build is
+	queued with low priority so builds asked for with /build go first. Every repo of a chat the bot was removed from is
+	turned off"""
+	try:
+		msg = outbox.call(chat_id, lambda: bot.send_message(chat_id, "New commit {0} on {1}. Building the app...".format(
+			sha[:7], repo)))
+	except Unauthorized as e:
+		logger.info("Turning off automatic builds of %s: %s", chat_id, e)
+		for record in db.getrepos(chat_id) or []:
+			db.setautobuild(chat_id, False, record['url'])
+		return
+	queuebuild((repo, sha, db.getbuildmatrix(chat_id, repo)), BuildRequest(bot, msg, msg, repo=repo, reason='autobuild'),
+				priority=PRIORITY_LOW)
+
+
+def setautobuild(bot, update, args):
+	"""Command handler to turn automatic builds of new upstream commits on or off. This method is strictly admin only"""
+	msg = update.message
+	if not msg.chat.type == msg.chat.PRIVATE and not is_admin(msg):
+		reply(msg, "You think you have permission to do this? Grow up!")
+		return
+	chat_id = msg.chat_id
+	option = args[0].lower() if len(args) > 0 and args[0].lower() in ('on', 'off') else None
+	repo = selectrepo(msg, args[1:] if option else args)
+	if repo is None:
+		return
+	if option is None:
+		reply(msg, "Automatic builds of {0} are {1}.\nSyntax is /autobuild [on|off] [repo]".format(
+			repo, "on" if db.isautobuild(chat_id, repo) else "off"))
+		return
+	enabled = option == 'on'
+	db.setautobuild(chat_id, enabled, repo)
+	if enabled:
+		reply(msg, "New commits of {0} will be built and sent automatically".format(repo))
+	else:
+		reply(msg, "Automatic builds of {0} are turned off".format(repo))
+
+
+def setdelivery(bot, update, args):
+	"""Command handler to choose if apks are sent in full or as binary patches against the apk the chat got before"""
+	msg = update.message
+	if not msg.chat.type == msg.chat.PRIVATE and not is_admin(msg):
+		reply(msg, "You think you have permission to do this? Grow up!")
+		return
+	chat_id = msg.chat_id
+	if not len(args) > 0 or args[0].lower() not in ('full', 'delta'):
+		reply(msg, "Apks are sent {0}.\nSyntax is /delivery [full|delta]".format(
+			"as patches when possible" if db.getdelivery(chat_id) == 'delta' else "in full"))
+		return
+	mode = args[0].lower()
+	if mode == 'delta' and not deltas.available():
+		reply(msg, "Patches are not available on this bot, bsdiff4 is not installed")
+		return
+	db.setdelivery(chat_id, mode)
+	if mode == 'delta':
+		reply(msg, "New builds are sent as a bsdiff patch against the apk sent before if it is much smaller. "
+						"Apply it with bspatch")
+	else:
+		reply(msg, "Apks are sent in full")
+
+
+def notifyqueued(request, position):
+	"""Method to inform a chat about its position in the build queue"""
+	if position == 0:
+		updatemessage(request.status, "A build of this repo is already running. The app will be sent once it is done")
+	elif request.wait is None:
+		updatemessage(request.status, "Waiting for a free build slot. Position in queue: {}".format(position))
+	else:
+		"""The estimate comes from the median durations of the recent builds of the repos ahead"""
+		updatemessage(request.status, "Waiting for a free build slot. Position in queue: {0}, starting in about {1}"
+						.format(position, formatduration(request.wait)))
+
+
+def repoofbutton(chat_id, data):
+	"""Return the repo named by the callback data of a button - {action}%{id of the row of the repo}. Buttons sent
+	before chats had several repos do not name it, they refer to the repo /build builds"""
+	recordid = data.partition("%")[2]
+	if not recordid:
+		return db.getRepo(chat_id)
+	try:
+		return db.getrepobyid(chat_id, int(recordid))
+	except ValueError:
+		return None
+
+
 def button(bot, update):
 	"""Method to handle callback data from inlinekeyboard buttons"""
 	query = update.callback_query
@@ -159,66 +345,64 @@ def button(bot, update):
 	err-log-dntsend - If the build failed and the user selected no, update the inlinekeyboard to consume the action
 	setadmin-true - set only admins can call /build to True. Will be consumed only if the choice is made by an admin
 	setadmin-false - set only admins can call /build to False. Will be consumed only if the choice is made by an admin"""
-	if query.data == "yes":
-		bot.edit_message_text("App is being sent!", chat_id=message.chat_id, message_id=message.message_id)
-		repoDir = db.getrepodir(message.chat_id)
-		sendFile(bot, message.chat_id, git.destApkLocation(repoDir))
+	if query.data.partition("%")[0] == "yes":
+		repo = repoofbutton(message.chat_id, query.data)
+		artifacts = git.getBuiltApk(repo, db.getbuildmatrix(message.chat_id, repo),
+									db.getlatesthash(message.chat_id, repo)) if repo else None
+		if artifacts is None:
+			updatemessage(message, "The app is not available anymore. Use /forcebuild to build it again")
+			return
+		updatemessage(message, "App is being sent!")
+		for artifact in artifacts:
+			sendapk(bot, message.chat_id, artifact)
 	elif query.data == "no":
-		bot.edit_message_text("Ok! The app wont be sent", chat_id=message.chat_id,
-								message_id=message.message_id)
-	elif query.data == "err-log-send":
-		bot.edit_message_text("Log is being sent", chat_id=message.chat_id, message_id=message.message_id)
-		sendFile(bot, message.chat_id, db.getlogfile(message.chat_id))
+		updatemessage(message, "Ok! The app wont be sent")
+	elif query.data.partition("%")[0] == "err-log-send":
+		repo = repoofbutton(message.chat_id, query.data)
+		log = db.getbuildlog(repo) if repo else ''
+		if not log:
+			updatemessage(message, "No log found")
+			return
+		updatemessage(message, "Log is being sent")
+		sendlog(bot, message.chat_id, log)
 	elif query.data == "err-log-msg-update":
-		bot.edit_message_text("Log is being sent in private", chat_id=message.chat_id,
-								message_id=message.message_id)
-		print "updating mesage"
+		updatemessage(message, "Log is being sent in private")
 	elif query.data == "err-log-dntsend":
-		bot.edit_message_text("Log will not be sent", chat_id=message.chat_id,
-								message_id=message.message_id)
+		updatemessage(message, "Log will not be sent")
 	elif "setadmin-true" in query.data:
-		print "inside set"
 		if is_admin(message, int(query.data.rpartition("%")[2])):
 			db.setadminonly(message.chat_id, True)
-			bot.edit_message_text("Only admins can execute /build from now on!", chat_id=message.chat_id,
-								message_id=message.message_id)
+			updatemessage(message, "Only admins can execute /build from now on!")
 		else:
-			print "isadmin failed"
+			logger.info("%s is not an admin of %s", query.data.rpartition("%")[2], message.chat_id)
 	elif "setadmin-false" in query.data:
 		if is_admin(message, int(query.data.rpartition("%")[2])):
 			db.setadminonly(message.chat_id, False)
-			bot.edit_message_text("Anyone can execute /build from now on!", chat_id=message.chat_id,
-								message_id=message.message_id)
-
-
-def updatemessage(message, new_text_message):
-	"""Method to update a message with new text"""
-	try:
-		message.edit_text(text=new_text_message)
-	except Exception as e:
-		logger.info(e)
-
-
-def sendFile(bot, chat_id, pathToFile):
-	"""Method to send a file to the chat (apk, log)"""
-	bot.send_document(chat_id=chat_id, document=open(pathToFile, 'rb'))
+			updatemessage(message, "Anyone can execute /build from now on!")
 
 
 def unknown(bot, update):
 	"""If the user sends a command which is not recognized by the bot, inform the user"""
-	update.message.reply_text("Sorry, I didn't understand that command.\nTry /help to get available commands")
+	reply(update.message, "Sorry, I didn't understand that command.\nTry /help to get available commands")
 
 
 def help(bot, update):
 	"""Command handler method to send the supported commands by the bot"""
-	update.message.reply_text(
+	reply(update.message,
 		'Hello there!Try the below commands!\n'
 		'/start - Initialize the bot\n'
-		'/setrepo [{github username}/{repository}] - set the github repository to use to build apk\n'
-		'/getrepo - Get the repo used for building apk\n'
+		'/setrepo [{github username}/{repository}] [{modules}:{flavors}:{build types}] - set the github repository '
+		'to use to build apk and optionally the variants to build, i.e. app,wear:free,paid:release. A chat may add '
+		'several repos, the repo set last is the one built by /build\n'
+		'/getrepo - Get the repos used for building apk\n'
+		'/removerepo [repo] - Remove a repo from the chat\n'
 		'/setadminonly - Provides a inline button keyboard to set if the build command can only be used by admins\n'
-		'/build - Build the app from latest source pulled from remote repository\n'
-		'/forcebuild - Force a build though latest app from source is built already(Admins only!)\n'
+		'/build [repo] - Build the app from latest source pulled from remote repository\n'
+		'/forcebuild [repo] - Force a build though latest app from source is built already(Admins only!)\n'
+		'/autobuild [on|off] [repo] - Build and send the app whenever new commits are pushed to the repository\n'
+		'/delivery [full|delta] - Send whole apks or patches against the apk sent before\n'
+		'/status [repo] - Last build, last success, median build duration and failure rate of the repo\n'
+		'/history [repo] - List the last builds of the repo\n'
 		'/chatid - Get your unique chat id(For debugging)')
 
 
@@ -226,25 +410,34 @@ def setrepo(bot, update, args):
 	"""Command handler to set the repo to use to build the app. This method is strictly admin only"""
 	msg = update.message
 	if not is_admin(msg):
-		msg.reply_text("You think you have permission to do this? Grow up!")
+		reply(msg, "You think you have permission to do this? Grow up!")
 		return
 	chat_id = msg.chat_id
 
 	"""Check if there is any arguments passed with /setrepo if not, inform user to send command with one.
-	The arugument must contain a github repo link in the form GITHUB_USER/REPONAME"""
+	The arugument must contain a github repo link in the form GITHUB_USER/REPONAME. It may be followed by a build
+	matrix modules:flavors:buildtypes, i.e. app,wear:free,paid:release,debug"""
 	if not len(args) > 0:
-		msg.reply_text("Oops! no option specified!\nSyntax is /setrepo [{github username}/{repo}]")
+		reply(msg, "Oops! no option specified!\nSyntax is /setrepo [{github username}/{repo}] "
+						"[{modules}:{flavors}:{build types}]")
 		return
 	chatargs = str(args[0])
+	buildmatrix = str(args[1]) if len(args) > 1 else ''
+	try:
+		variants = parsematrix(buildmatrix)
+	except ValueError as e:
+		reply(msg, "Oops! {0}\nThe build matrix is written as modules:flavors:buildtypes, i.e. "
+						"app:free,paid:release".format(e))
+		return
 
 	"""Make sure the argument is not empty"""
 	if chatargs.strip() in (None, ''):
-		msg.reply_text("Oops! The option cannot be empty\nSyntax is /setrepo [{github username}/{repo}]")
+		reply(msg, "Oops! The option cannot be empty\nSyntax is /setrepo [{github username}/{repo}]")
 		return
 
 	"""Build the repo url with chat args"""
 	url = 'https://github.com/' + chatargs
-	gitapiurl = 'https://api.github.com/repos/'
+	gitapiurl = githubapiurl + '/repos/'
 	httpauth = None
 
 	"""Check if github username and password is set in config.py.
@@ -261,15 +454,99 @@ def setrepo(bot, update, args):
 	elif "Bad credentials" in data.values():
 		result = "Oops! Seems like the git credentials is not correct! Please check the credentials and try again!"
 	elif (url + ".git").lower() in (str(x).lower() for x in data.values()):
-		result = db.addRepo(chat_id, chatargs)
+		result = db.addRepo(chat_id, chatargs, buildmatrix)
+		if buildmatrix:
+			result += "\nEvery build makes {0} apks: {1}".format(len(variants), formatmatrix(variants))
 	else:
 		result = "Unknown error has occured! Could not verify the repo existence"
-	msg.reply_text(result)
+	reply(msg, result)
 
 
 def getrepo(bot, update):
-	"""Command handler to display the set repo"""
-	update.message.reply_text("The repo url is {}".format(db.getrepourl(update.message.chat_id)))
+	"""Command handler to display the repos of the chat. The one /build builds is marked"""
+	chat_id = update.message.chat_id
+	repos = db.getrepos(chat_id)
+	if not repos or len(repos) == 1:
+		reply(update.message, "The repo url is {}".format(db.getrepourl(chat_id)))
+		return
+	selected = db.getRepo(chat_id)
+	reply(update.message, "The repos of this chat are:\n{}".format("\n".join(
+		"https://github.com/{0}{1}".format(record['url'], " - built by /build" if record['url'] == selected else "")
+		for record in repos)))
+
+
+def removerepo(bot, update, args):
+	"""Command handler to remove a repo from the chat. This method is strictly admin only"""
+	msg = update.message
+	if not is_admin(msg):
+		reply(msg, "You think you have permission to do this? Grow up!")
+		return
+	if not len(args) > 0:
+		reply(msg, "Oops! no repo specified!\nSyntax is /removerepo [{github username}/{repo}]")
+		return
+	repo = selectrepo(msg, args)
+	if repo is not None:
+		reply(msg, db.removeRepo(msg.chat_id, repo))
+
+
+def status(bot, update, args):
+	"""Command handler to show how the recent builds of a repo of the chat went. Answered from the aggregates the build
+	history keeps per repo"""
+	msg = update.message
+	repo = selectrepo(msg, args)
+	if repo is None:
+		return
+	if buildbackend == 'queue':
+		"""The build workers record the builds, the cached aggregates may be outdated"""
+		history.invalidate(repo)
+	try:
+		stats = history.stats(repo)
+	except Exception as e:
+		logger.info(e)
+		reply(msg, "Could not retrieve the build history. Try again later")
+		return
+	if stats['last'] is None:
+		reply(msg, "{0} was not built yet. Build it with /build".format(repo))
+		return
+	lines = ["Builds of {0}".format(repo), "Last build: " + formatbuild(stats['last'])]
+	if stats['lastsuccess'] is None:
+		lines.append("No successful build in the last {0} builds".format(len(stats['builds'])))
+	elif stats['lastsuccess'] is not stats['last']:
+		lines.append("Last success: " + formatbuild(stats['lastsuccess']))
+	if stats['median'] is not None:
+		lines.append("Median build duration: {0}".format(formatduration(stats['median'])))
+		lines.append("Failure rate: {0:.0%} of the last {1} builds which ran gradle".format(stats['failurerate'],
+																								stats['built']))
+	if buildbackend == 'local':
+		queued, running = scheduler.depth()
+		lines.append("Build queue: {0} waiting, {1} running".format(queued, running))
+	reply(msg, "\n".join(lines))
+
+
+def showhistory(bot, update, args):
+	"""Command handler to list the last builds of a repo of the chat"""
+	msg = update.message
+	repo = selectrepo(msg, args)
+	if repo is None:
+		return
+	if buildbackend == 'queue':
+		history.invalidate(repo)
+	try:
+		builds = history.stats(repo)['builds'][:historylength]
+	except Exception as e:
+		logger.info(e)
+		reply(msg, "Could not retrieve the build history. Try again later")
+		return
+	if not builds:
+		reply(msg, "{0} was not built yet. Build it with /build".format(repo))
+		return
+	now = time.time()
+	reply(msg, "Last builds of {0}:\n{1}".format(repo, "\n".join(formatbuild(build, now) for build in builds)))
+
+
+def trackadmins(bot, update):
+	"""Handler method which runs before the command handlers to keep the admin index up to date"""
+	admins.track(update)
 
 
 def error_callback(bot, update, error):
@@ -278,42 +555,115 @@ def error_callback(bot, update, error):
 		raise error
 	except Unauthorized:
 		# remove update.message.chat_id from conversation list
-		print (Unauthorized)
+		logger.warning("Unauthorized: %s", error)
 	except BadRequest:
 		# handle malformed requests - read more below!
-		print (BadRequest)
+		logger.warning("BadRequest: %s", error)
 	except TimedOut:
 		# handle slow connection problems
-		print (TimedOut)
+		logger.warning("TimedOut: %s", error)
 	except NetworkError:
 		# handle other connection problems
-		print (NetworkError)
+		logger.warning("NetworkError: %s", error)
 	except ChatMigrated as e:
 		# the chat_id of a group has changed, use e.new_chat_id instead
 		db.updateID(update.message.chat_id, e.new_chat_id)
+		admins.invalidate(update.message.chat_id)
 	except TelegramError:
 		# handle all other telegram related errors
-		print (TelegramError)
+		logger.warning("TelegramError: %s", error)
+
+
+detector = autobuild.ChangeDetector(queueautobuild)
+scheduler = BuildScheduler(runbuild, deliverbuild, notify=notifyqueued, workers=maxbuilds,
+							capacity=buildmemorybudget, estimate=lambda key: history.estimate(key[0]))
+
+
+def registergauges():
+	"""Expose the state of the queues and caches on the metrics endpoint"""
+	registry = metrics.registry
+	if buildbackend == 'queue':
+		registry.gauge('autobuild_queue_depth', lambda: dict(zip(('queued', 'running'), db.countbuildjobs())),
+						label='state', text='Build jobs waiting in the queue and running')
+	else:
+		registry.gauge('autobuild_queue_depth', lambda: dict(zip(('queued', 'running'), scheduler.depth())),
+						label='state', text='Build jobs waiting in the queue and running')
+	registry.gauge('autobuild_build_memory_bytes', scheduler.usage, label='state',
+					text='Memory ceilings of the running builds and the budget they share')
+	registry.gauge('autobuild_change_detector', detector.stats, label='stat',
+					text='Checks of the subscribed repos and new commits found')
+	registry.gauge('autobuild_artifact_store', store.stats, label='stat', text='Stored apks, their size and lookups')
+	registry.gauge('autobuild_record_cache', db.records.stats, label='stat', text='Repo record cache')
+	registry.gauge('autobuild_fileid_cache', db.fileids.stats, label='stat', text='Telegram file_id cache')
+	registry.gauge('autobuild_history_cache', history.cache.stats, label='stat', text='Build history aggregate cache')
+	registry.gauge('autobuild_db_pool', db.pool.stats, label='stat', text='Database connection pool')
+	registry.gauge('autobuild_db_writes', db.writes.stats, label='stat', text='Batched database writes')
+	registry.gauge('autobuild_admin_index', admins.stats, label='stat', text='Admin index')
+	registry.gauge('autobuild_outbox_queued', lambda: outbox.stats()['queued'], label='lane',
+					text='Bot api requests waiting in the outbox')
+	registry.gauge('autobuild_gradle_daemon_builds', lambda: dict((name, daemon['builds'])
+					for name, daemon in gradle.stats().items()), label='daemon', text='Builds run per gradle daemon')
+
+
+def addhandlers(dispatcher):
+	"""Add all the supported commands and the error handler to the dispatcher"""
+	admins.watch()
+	dispatcher.add_handler(TypeHandler(Update, trackadmins), group=-1)
+	dispatcher.add_handler(CommandHandler('start', start, pass_args=True))
+	dispatcher.add_handler(CommandHandler('hello', hello))
+	dispatcher.add_handler(CommandHandler('chatid', getchatid))
+	dispatcher.add_handler(CommandHandler('build', compilerepo, pass_args=True))
+	dispatcher.add_handler(CommandHandler('forcebuild', forceBuild, pass_args=True))
+	dispatcher.add_handler(CallbackQueryHandler(button))
+	dispatcher.add_handler(CommandHandler('help', help))
+	dispatcher.add_handler(CommandHandler("setrepo", setrepo, pass_args=True))
+	dispatcher.add_handler(CommandHandler('getrepo', getrepo))
+	dispatcher.add_handler(CommandHandler('removerepo', removerepo, pass_args=True))
+	dispatcher.add_handler(CommandHandler('setadminonly', setadminonly))
+	dispatcher.add_handler(CommandHandler('autobuild', setautobuild, pass_args=True))
+	dispatcher.add_handler(CommandHandler('delivery', setdelivery, pass_args=True))
+	dispatcher.add_handler(CommandHandler('status', status, pass_args=True))
+	dispatcher.add_handler(CommandHandler('history', showhistory, pass_args=True))
+	dispatcher.add_handler(MessageHandler(Filters.command, unknown))
+	dispatcher.add_error_handler(error_callback)
 
 
 def main():
 	"""Main method where the bot is initialized and all the supported commands, error handlers are added for listening"""
-	updater = Updater(token=botapiToken)
-	updater.dispatcher.add_handler(CommandHandler('start', start, pass_args=True))
-	updater.dispatcher.add_handler(CommandHandler('hello', hello))
-	updater.dispatcher.add_handler(CommandHandler('chatid', getchatid))
-	updater.dispatcher.add_handler(CommandHandler('build', compilerepo))
-	updater.dispatcher.add_handler(CommandHandler('forcebuild', forceBuild))
-	updater.dispatcher.add_handler(CallbackQueryHandler(button))
-	updater.dispatcher.add_handler(CommandHandler('help', help))
-	updater.dispatcher.add_handler(CommandHandler("setrepo", setrepo, pass_args=True))
-	updater.dispatcher.add_handler(CommandHandler('getrepo', getrepo))
-	updater.dispatcher.add_handler(CommandHandler('setadminonly', setadminonly))
-	updater.dispatcher.add_handler(MessageHandler(Filters.command, unknown))
-	updater.dispatcher.add_error_handler(error_callback)
-
-	updater.start_polling()
+	if webhookmode and not webhookpath:
+		raise ValueError("webhookpath must be set to a secret to receive updates through a webhook")
+	if buildbackend == 'queue':
+		logger.info("Builds run in the build workers")
+	else:
+		logger.info("Builds run in the %s build sandbox, up to %d at a time%s", runner.name, maxbuilds,
+					"" if buildmemorybudget is None else " within {0:.1f} GB".format(buildmemorybudget / 1073741824.0))
+	updater = Updater(token=botapiToken, base_url=botapiurl or None, workers=dispatcherworkers)
+	registergauges()
+	metrics.serve()
+	addhandlers(updater.dispatcher)
+
+	if webhookmode:
+		"""Telegram pushes updates to http://webhooklisten:webhookport/webhookpath. The path should be secret as anyone
+		who knows it can post updates. TLS is expected to be terminated by a reverse proxy serving webhookurl"""
+		updater.start_webhook(listen=webhooklisten, port=webhookport, url_path=webhookpath,
+								webhook_url=webhookurl or None, allowed_updates=ALLOWED_UPDATES)
+	else:
+		updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+	detector.start(updater.bot)
+	autobuild.serve(detector)
 	updater.idle()
+	shutdown()
+
+
+def shutdown():
+	"""Let queued and running builds finish, then release the database connections. Called once the updater stopped
+	receiving updates"""
+	logger.info("Waiting for builds to finish")
+	detector.stop()
+	scheduler.shutdown(wait=True, timeout=shutdowntimeout)
+	store.flush()
+	db.writes.close()
+	db.pool.closeall()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+"""Load and latency benchmark. Drives the command handlers of the bot with a synthetic stream of /build commands and
+reports what the chats would see, so performance changes can be compared run to run:
+
+	python benchmark.py --chats 50 --repos 5 --rate 2 --duration 120 --gradle-seconds 3 --json
+
+Nothing leaves the machine. Telegram and the github api are answered by a local fake server, every repo is a local
+git repository cloned through file://, its gradlew is a stub which sleeps --gradle-seconds and writes an apk of
+--apk-bytes and the sqlite backend keeps the database in the temporary working directory. Commits are pushed to the
+repos at --commit-rate so builds, cached apks and reused apks mix like they do in production. Runs with the same
+--seed send the same commands at the same times.
+
+Reported are the latency of the first answer to a command and of the apk (p50/p90/p99), builds per hour by result,
+database connections opened and queries run per command, bot api calls by method, uploaded bytes and the count and
+mean of every timed pipeline stage"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from BaseHTTPServer import BaseHTTPRequestHandler
+from collections import Counter, deque
+
+TOKEN = '123456:benchmark'
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+
+"""Stand-in for the gradle wrapper of every benchmark repo. It assembles app/build/outputs/apk/release/ like the
+android gradle plugin does"""
+GRADLEW = r'''#!/bin/sh
+case " $* " in *" --stop "*) exit 0 ;; esac
+echo "> Task :app:preBuild"
+sleep "${BENCH_GRADLE_SECONDS:-1}"
+echo "> Task :app:assembleRelease"
+if [ "$(od -An -N2 -tu2 /dev/urandom | tr -d ' ')" -lt "${BENCH_FAILURE_THRESHOLD:-0}" ]; then
+	echo "error: benchmark failure"
+	echo "FAILURE: Build failed with an exception."
+	exit 1
+fi
+mkdir -p app/build/outputs/apk/release
+head -c "${BENCH_APK_BYTES:-1048576}" /dev/urandom > app/build/outputs/apk/release/app-release.apk
+echo "BUILD SUCCESSFUL"
+'''
+
+
+def installconfig(args, workdir):
+	"""Make `import config` return the configuration of the benchmark instead of config.py. The urls of the fake apis
+	are set once they listen"""
+	config = types.ModuleType('config')
+	config.__dict__.update({
+		'botapiToken': TOKEN, 'botUserName': BOT_USER['username'],
+		'dbbackend': 'sqlite', 'dbpath': os.path.join(workdir, 'bench.sqlite3'), 'dbtablename': 'repos',
+		'gitusername': '', 'gitpassword': '',
+		'gitcloneurl': 'file://' + os.path.join(workdir, 'remotes', '{repo}'),
+		'maxbuilds': args.builds,
+		'buildbackend': args.backend,
+		'remoteheadttl': args.head_ttl,
+		'outboxglobalrate': args.global_rate,
+		'outboxprivaterate': args.chat_rate,
+		'workerpollinterval': 0.5,
+		'progressinterval': 5,
+		'metricsport': 0,
+		'pushwebhookport': 0,
+	})
+	sys.modules['config'] = config
+	return config
+
+
+def commit(cwd, message):
+	"""Commit every change of the repo at cwd and return the sha of the commit"""
+	subprocess.check_call(('git', 'add', '-A'), cwd=cwd)
+	subprocess.check_call(('git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '-m',
+							message), cwd=cwd)
+	return subprocess.check_output(('git', 'rev-parse', 'HEAD'), cwd=cwd).strip()
+
+
+class Remotes(object):
+	"""The local git repositories the benchmark repos are cloned from. heads is what the fake github api answers"""
+
+	def __init__(self, root, count):
+		self.root = root
+		self.names = ['bench/app{}'.format(i) for i in range(count)]
+		self.heads = {}
+		self.pushes = 0
+		self._lock = threading.Lock()
+		for name in self.names:
+			path = os.path.join(root, name)
+			os.makedirs(os.path.join(path, 'app', 'src', 'main'))
+			with open(os.path.join(path, 'gradlew'), 'w') as f:
+				f.write(GRADLEW)
+			os.chmod(os.path.join(path, 'gradlew'), 0o755)
+			with open(os.path.join(path, 'README.md'), 'w') as f:
+				f.write('Benchmark repo\n')
+			self._touch(path, 'app/src/main/Bench.java')
+			subprocess.check_call(('git', 'init', '-q'), cwd=path)
+			self.heads[name] = commit(path, 'Initial commit')
+
+	def _touch(self, path, filename):
+		with open(os.path.join(path, filename), 'a') as f:
+			f.write('// {0}\n'.format(self.pushes))
+
+	def push(self, rng, docsratio):
+		"""Commit to a random repo. With probability docsratio only a file which does not affect the apk changes"""
+		name = rng.choice(self.names)
+		path = os.path.join(self.root, name)
+		with self._lock:
+			self.pushes += 1
+			self._touch(path, 'README.md' if rng.random() < docsratio else 'app/src/main/Bench.java')
+			self.heads[name] = commit(path, 'Commit {0}'.format(self.pushes))
+
+
+class Recorder(object):
+	"""Matches the bot api calls of the fake server to the commands they answer.
+
+	The first sendMessage to a chat which is not a reply answers its oldest unanswered command of the same kind: a build
+	or a command which only asks for information, like /status. Builds run asynchronously, so information is often
+	answered before builds sent earlier. Unless the answer offers an already built apk, an apk or a failure notice is
+	expected for a build later: the next sendDocument to the chat or the sendMessage replying to the command"""
+
+	def __init__(self):
+		self.commandlatency = []
+		self.deliverylatency = []
+		self.calls = Counter()
+		self.uploaded = 0
+		self.prompts = 0
+		self.failures = 0
+		self._answers = {}
+		self._deliveries = {}
+		self._lock = threading.Lock()
+
+	def command(self, chat_id, message_id, builds=True):
+		with self._lock:
+			self._answers.setdefault(chat_id, deque()).append((message_id, time.time(), builds))
+
+	def call(self, method, params, size):
+		now = time.time()
+		chat_id = params.get('chat_id')
+		chat_id = int(chat_id) if chat_id is not None else None
+		with self._lock:
+			self.calls[method] += 1
+			if method == 'sendMessage' and params.get('reply_to_message_id'):
+				replyto = int(params['reply_to_message_id'])
+				pending = self._deliveries.get(chat_id)
+				if pending:
+					"""Answers in private chats are not replies, commands sent close together may have been paired
+					with each other's answer. The oldest delivery of the chat is taken then"""
+					entry = next((entry for entry in pending if entry[0] == replyto), pending[0])
+					pending.remove(entry)
+					self.failures += 1
+					self.deliverylatency.append(now - entry[1])
+			elif method == 'sendMessage' and self._answers.get(chat_id):
+				text = params.get('text', '')
+				building = text in ('Repo cloning...', 'Force building app') or text.startswith('An already built app')
+				answers = self._answers[chat_id]
+				entry = next((entry for entry in answers if entry[2] == building), answers[0])
+				answers.remove(entry)
+				message_id, sent, builds = entry
+				self.commandlatency.append(now - sent)
+				if text.startswith('An already built app'):
+					self.prompts += 1
+				elif builds:
+					self._deliveries.setdefault(chat_id, deque()).append((message_id, sent))
+			elif method == 'sendDocument':
+				self.uploaded += size
+				if self._deliveries.get(chat_id):
+					message_id, sent = self._deliveries[chat_id].popleft()
+					self.deliverylatency.append(now - sent)
+
+	def pending(self):
+		with self._lock:
+			return sum(len(queue) for queue in self._answers.values() + self._deliveries.values())
+
+
+class FakeApi(object):
+	"""State of the fake telegram bot api and github api"""
+
+	def __init__(self, recorder, remotes, latency):
+		self.recorder = recorder
+		self.remotes = remotes
+		self.latency = latency
+		self._ids = iter(xrange(1000000, sys.maxint)).next
+		self._lock = threading.Lock()
+
+	def message(self, params, **fields):
+		with self._lock:
+			message_id = self._ids()
+		chat_id = int(params.get('chat_id') or 0)
+		message = {'message_id': int(params.get('message_id') or message_id), 'date': int(time.time()),
+					'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'}, 'from': BOT_USER}
+		message.update(fields)
+		return message
+
+	def botapi(self, method, params, size):
+		self.recorder.call(method, params, size)
+		if method == 'getMe':
+			return BOT_USER
+		if method in ('sendMessage', 'editMessageText'):
+			return self.message(params, text=params.get('text', ''))
+		if method == 'sendDocument':
+			return self.message(params, document={'file_id': 'bench-{0}'.format(self._ids())})
+		if method == 'getChatAdministrators':
+			return []
+		return True
+
+
+def parseform(body, contenttype):
+	"""Return the plain fields of a multipart/form-data body"""
+	boundary = contenttype.partition('boundary=')[2].strip('"')
+	fields = {}
+	for part in body.split('--' + boundary):
+		header, _, value = part.partition('\r\n\r\n')
+		match = re.search(r'name="([^"]+)"(?!; filename)', header)
+		if match and 'filename=' not in header:
+			fields[match.group(1)] = value.rstrip('\r\n')
+	return fields
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+	"""Serves /bot<token>/<method> like the telegram bot api and /repos/<repo>/commits/HEAD like the github api"""
+	api = None
+
+	def reply(self, status, body='', headers=()):
+		self.send_response(status)
+		for name, value in headers:
+			self.send_header(name, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		time.sleep(self.api.latency)
+		match = re.match(r'^/repos/(.+)/commits/HEAD$', self.path)
+		if match is None:
+			self.do_POST()
+			return
+		sha = self.api.remotes.heads.get(match.group(1))
+		if sha is None:
+			self.reply(404)
+		elif self.headers.get('If-None-Match') == '"{0}"'.format(sha):
+			self.reply(304, headers=[('ETag', '"{0}"'.format(sha))])
+		else:
+			self.reply(200, sha, [('ETag', '"{0}"'.format(sha))])
+
+	def do_POST(self):
+		if self.command == 'POST':
+			time.sleep(self.api.latency)
+		match = re.match(r'^/bot[^/]+/(\w+)', self.path)
+		if match is None:
+			self.reply(404)
+			return
+		size = int(self.headers.get('Content-Length') or 0)
+		body = self.rfile.read(size) if size else ''
+		contenttype = self.headers.get('Content-Type') or ''
+		if contenttype.startswith('multipart/form-data'):
+			params = parseform(body, contenttype)
+		else:
+			params = json.loads(body) if body else {}
+		result = self.api.botapi(match.group(1), params, size)
+		self.reply(200, json.dumps({'ok': True, 'result': result}), [('Content-Type', 'application/json')])
+
+	def log_message(self, format, *args):
+		pass
+
+
+def percentiles(values):
+	"""Return the p50, p90 and p99 (nearest rank) and the maximum of values in milliseconds"""
+	if not values:
+		return {}
+	values = sorted(values)
+
+	def rank(p):
+		return round(values[min(len(values) - 1, int(len(values) * p / 100.0))] * 1000, 1)
+	return {'count': len(values), 'p50': rank(50), 'p90': rank(90), 'p99': rank(99),
+			'max': round(values[-1] * 1000, 1)}
+
+
+def diffsnapshot(before, after):
+	"""Return the counters and histograms which changed between two snapshots of the metrics registry"""
+	def index(entries, field):
+		return dict(((entry['name'], tuple(sorted(entry['labels'].items()))), entry[field]) for entry in entries)
+	counters = Counter()
+	old = index(before['counters'], 'value')
+	for key, value in index(after['counters'], 'value').items():
+		counters[key] = value - old.get(key, 0)
+	histograms = {}
+	oldcount, oldsum = index(before['histograms'], 'count'), index(before['histograms'], 'sum')
+	newsum = index(after['histograms'], 'sum')
+	for key, count in index(after['histograms'], 'count').items():
+		count -= oldcount.get(key, 0)
+		if count:
+			histograms[key] = count, newsum[key] - oldsum.get(key, 0)
+	return counters, histograms
+
+
+def parseargs(argv=None):
+	parser = argparse.ArgumentParser(description="Load and latency benchmark of the bot with fake telegram, git and "
+												"gradle")
+	parser.add_argument('--chats', type=int, default=20, help="private chats sending /build")
+	parser.add_argument('--repos', type=int, default=4, help="repos the chats are spread over")
+	parser.add_argument('--repos-per-chat', type=int, default=1, help="repos added by every chat. With more than one "
+																		"the commands name a random one of them")
+	parser.add_argument('--rate', type=float, default=1.0, help="/build commands per second (poisson arrivals)")
+	parser.add_argument('--duration', type=float, default=60, help="seconds commands are sent for")
+	parser.add_argument('--force-ratio', type=float, default=0.0, help="fraction of the commands which are /forcebuild")
+	parser.add_argument('--status-ratio', type=float, default=0.0, help="fraction of the commands which are /status")
+	parser.add_argument('--commit-rate', type=float, default=0.05, help="commits pushed per second over all repos")
+	parser.add_argument('--docs-ratio', type=float, default=0.3, help="fraction of the commits which do not affect "
+																		"the apk")
+	parser.add_argument('--gradle-seconds', type=float, default=2.0, help="duration of a stub gradle build")
+	parser.add_argument('--apk-bytes', type=int, default=1024 * 1024, help="size of the apk a build writes")
+	parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of the builds which fail")
+	parser.add_argument('--builds', type=int, default=2, help="builds running at the same time: maxbuilds, or the "
+						"build workers with --backend queue")
+	parser.add_argument('--backend', choices=('local', 'queue'), default='local',
+						help="build in the bot process or in a build worker thread claiming jobs from the database")
+	parser.add_argument('--api-latency', type=float, default=0.0, help="seconds the fake apis take to answer")
+	parser.add_argument('--head-ttl', type=float, default=30, help="remoteheadttl")
+	parser.add_argument('--global-rate', type=float, default=30, help="outboxglobalrate")
+	parser.add_argument('--chat-rate', type=float, default=1, help="outboxprivaterate")
+	parser.add_argument('--drain', type=float, default=600, help="seconds to wait for running builds after the load")
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--workdir', help="working directory, a temporary one which is removed afterwards by default")
+	parser.add_argument('--json', action='store_true', help="print the report as json")
+	parser.add_argument('--verbose', action='store_true', help="keep the info logging of the bot")
+	return parser.parse_args(argv)
+
+
+def run(args):
+	"""Run the benchmark in the current directory and return the report"""
+	workdir = os.getcwd()
+	rng = random.Random(args.seed)
+	recorder = Recorder()
+	remotes = Remotes(os.path.join(workdir, 'remotes'), args.repos)
+	api = FakeApi(recorder, remotes, args.api_latency)
+	class ApiHandler(_ApiHandler):
+		pass
+	ApiHandler.api = api
+	config = installconfig(args, workdir)
+	"""metrics reads config when it is imported"""
+	from metrics import ThreadingHTTPServer
+	server = ThreadingHTTPServer(('127.0.0.1', 0), ApiHandler)
+	thread = threading.Thread(target=server.serve_forever, name="fake-api")
+	thread.daemon = True
+	thread.start()
+	config.botapiurl = 'http://127.0.0.1:{0}/bot'.format(server.server_address[1])
+	config.githubapiurl = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+	os.environ['BENCH_GRADLE_SECONDS'] = str(args.gradle_seconds)
+	os.environ['BENCH_APK_BYTES'] = str(args.apk_bytes)
+	os.environ['BENCH_FAILURE_THRESHOLD'] = str(int(args.failure_rate * 65536))
+
+	"""The modules of the bot read config and create their directories when they are imported"""
+	import logging
+	import autobuildbot
+	import metrics
+	import mysqlHelper as db
+	import worker
+	from telegram import Update
+	from telegram.ext import Updater
+	if not args.verbose:
+		logging.getLogger().setLevel(logging.WARNING)
+
+	chats = [1000 + i for i in range(args.chats)]
+	repos = {}
+	for i, chat_id in enumerate(chats):
+		repos[chat_id] = [remotes.names[(i + j) % len(remotes.names)]
+							for j in range(min(args.repos_per_chat, len(remotes.names)))]
+		for repo in repos[chat_id]:
+			db.addRepo(chat_id, repo)
+	updater = Updater(token=TOKEN, base_url=autobuildbot.botapiurl, workers=autobuildbot.dispatcherworkers)
+	autobuildbot.addhandlers(updater.dispatcher)
+	dispatcher = threading.Thread(target=updater.dispatcher.start, name="dispatcher")
+	dispatcher.daemon = True
+	dispatcher.start()
+	if args.backend == 'queue':
+		"""Several workers claim jobs from the same table, like worker.py with workerthreads"""
+		for i in range(args.builds):
+			building = threading.Thread(target=worker.work, args=(updater.bot, 'bench-{}'.format(i)),
+										name="build-worker-{}".format(i))
+			building.daemon = True
+			building.start()
+
+	def idle():
+		if args.backend == 'queue':
+			depth = db.countbuildjobs()
+		else:
+			depth = autobuildbot.scheduler.depth()
+		return depth == (0, 0) and not any(autobuildbot.outbox.stats()['queued'].values())
+
+	"""Command and commit times are drawn up front so runs with the same seed are comparable"""
+	events = []
+	now = 0.0
+	while args.rate > 0:
+		now += rng.expovariate(args.rate)
+		if now >= args.duration:
+			break
+		draw = rng.random()
+		text = '/forcebuild' if draw < args.force_ratio else \
+			'/status' if draw < args.force_ratio + args.status_ratio else '/build'
+		events.append((now, 'command', rng.choice(chats), text))
+	now = 0.0
+	while args.commit_rate > 0:
+		now += rng.expovariate(args.commit_rate)
+		if now >= args.duration:
+			break
+		events.append((now, 'commit', None, None))
+	events.sort()
+
+	baseline = metrics.registry.snapshot()
+	opened = db.pool.opened
+	writes = db.writes.stats()
+	started = time.time()
+	for update_id, (at, kind, chat_id, text) in enumerate(events):
+		delay = started + at - time.time()
+		if delay > 0:
+			time.sleep(delay)
+		if kind == 'commit':
+			remotes.push(rng, args.docs_ratio)
+			continue
+		command = len(text)
+		if len(repos[chat_id]) > 1:
+			text += ' ' + rng.choice(repos[chat_id]).rpartition('/')[2]
+		message_id = update_id + 1
+		update = Update.de_json({'update_id': update_id, 'message': {
+			'message_id': message_id, 'date': int(time.time()), 'text': text,
+			'entities': [{'type': 'bot_command', 'offset': 0, 'length': command}],
+			'chat': {'id': chat_id, 'type': 'private', 'first_name': 'bench'},
+			'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'}}}, updater.bot)
+		recorder.command(chat_id, message_id, builds=not text.startswith('/status'))
+		updater.dispatcher.update_queue.put(update)
+	loaded = time.time()
+	deadline = loaded + args.drain
+	while time.time() < deadline and (recorder.pending() or not idle()):
+		time.sleep(0.2)
+	elapsed = time.time() - started
+
+	commands = sum(1 for event in events if event[1] == 'command')
+	counters, histograms = diffsnapshot(baseline, metrics.registry.snapshot())
+	builds = Counter()
+	for (name, labels), value in counters.items():
+		if name == 'autobuild_builds_total' and value:
+			builds[dict(labels)['result']] += value
+	stages = Counter()
+	stagetime = Counter()
+	for (name, labels), (count, total) in histograms.items():
+		stages[name] += count
+		stagetime[name] += total
+	report = {
+		'commands': commands,
+		'commits': remotes.pushes,
+		'seconds': round(elapsed, 1),
+		'load_seconds': round(loaded - started, 1),
+		'unfinished': recorder.pending(),
+		'command_latency_ms': percentiles(recorder.commandlatency),
+		'delivery_latency_ms': percentiles(recorder.deliverylatency),
+		'already_built_prompts': recorder.prompts,
+		'failure_notices': recorder.failures,
+		'builds': dict(builds),
+		'builds_per_hour': round((builds['success'] + builds['failure']) * 3600.0 / elapsed, 1),
+		'deliveries_per_hour': round((len(recorder.deliverylatency) - recorder.failures) * 3600.0 / elapsed, 1),
+		'db_connections_opened': db.pool.opened - opened,
+		'db_connections_per_command': round((db.pool.opened - opened) / float(max(commands, 1)), 3),
+		'db_queries_per_command': round(stages['autobuild_db_query_seconds'] / float(max(commands, 1)), 2),
+		'db_batched_writes': db.writes.stats()['written'] - writes['written'],
+		'db_write_batches': db.writes.stats()['batches'] - writes['batches'],
+		'botapi_calls': dict(recorder.calls),
+		'uploaded_bytes': recorder.uploaded,
+		'stages': dict((name, {'count': count, 'mean': round(stagetime[name] / count, 4)})
+						for name, count in stages.items()),
+	}
+	updater.dispatcher.stop()
+	worker.stopping.set()
+	autobuildbot.scheduler.shutdown(wait=True, timeout=args.drain)
+	db.writes.close()
+	db.pool.closeall()
+	server.shutdown()
+	server.server_close()
+	return report
+
+
+def printreport(report):
+	print("{commands} commands, {commits} commits in {load_seconds} s, finished after {seconds} s".format(**report))
+	for name in ('command_latency_ms', 'delivery_latency_ms'):
+		latency = report[name]
+		if latency:
+			print("{0:<24} n={count} p50={p50} p90={p90} p99={p99} max={max}".format(name, **latency))
+	print("{0:<24} {1} ({2} per hour, {3} deliveries per hour)".format('builds', report['builds'],
+			report['builds_per_hour'], report['deliveries_per_hour']))
+	print("{0:<24} {1} opened, {2} per command, {3} queries per command, {4} writes batched in {5}".format('database',
+			report['db_connections_opened'], report['db_connections_per_command'], report['db_queries_per_command'],
+			report['db_batched_writes'], report['db_write_batches']))
+	print("{0:<24} {1}".format('bot api calls', report['botapi_calls']))
+	print("{0:<24} {1}".format('uploaded bytes', report['uploaded_bytes']))
+	for name, stage in sorted(report['stages'].items()):
+		print("  {0:<40} n={count:<6} mean={mean}".format(name, **stage))
+	if report['unfinished']:
+		print("{0} commands were not answered within the drain timeout".format(report['unfinished']))
+
+
+def main(argv=None):
+	args = parseargs(argv)
+	workdir = args.workdir or tempfile.mkdtemp(prefix='autobuild-bench-')
+	if not os.path.isdir(workdir):
+		os.makedirs(workdir)
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	os.chdir(workdir)
+	try:
+		report = run(args)
+	finally:
+		if not args.workdir:
+			os.chdir('/')
+			shutil.rmtree(workdir, ignore_errors=True)
+	if args.json:
+		print(json.dumps(report, indent=2, sort_keys=True))
+	else:
+		printreport(report)
+
+
+if __name__ == '__main__':
+	main()
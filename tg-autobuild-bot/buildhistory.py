@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+import logging
+import os
+import threading
+import time
+
+import config
+import mysqlHelper as db
+
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+historywindow = getattr(config, 'historywindow', 50)
+historyretention = getattr(config, 'historyretention', 90 * 24 * 60 * 60)
+historycachesize = getattr(config, 'historycachesize', 1024)
+
+"""Results of builds which ran gradle. Only their durations tell how long a build of the repo takes"""
+BUILT = ('success', 'failure')
+"""Results of builds which ended with apks"""
+SUCCEEDED = ('success', 'cached', 'retagged')
+
+
+def median(values):
+	values = sorted(values)
+	if not values:
+		return None
+	middle = len(values) // 2
+	if len(values) % 2:
+		return values[middle]
+	return (values[middle - 1] + values[middle]) / 2.0
+
+
+class BuildHistory(object):
+	"""History of the builds of every repo and aggregates over the recent ones.
+
+	Every finished build is appended to the buildhistory table with the batched writes. The last window builds of a
+	repo and the aggregates over them - last build, last success, median duration, failure rate and peak memory - are
+	cached and updated as builds finish, so /status, /history and the estimates of the scheduler never scan the table. A repo
+	which is not cached is loaded with one query on the (url, started) index. Rows older than retention seconds are
+	pruned once an hour"""
+
+	def __init__(self, window, retention, cachesize):
+		self.window = window
+		self.retention = retention
+		self.cache = db.RecordCache(maxsize=cachesize)
+		self._lock = threading.Lock()
+		self._lastprune = 0
+
+	def _aggregate(self, builds):
+		"""Return the aggregates over builds, newest first"""
+		built = [build for build in builds if build['result'] in BUILT]
+		failures = sum(1 for build in built if build['result'] == 'failure')
+		return {'builds': builds,
+				'last': builds[0] if builds else None,
+				'lastsuccess': next((build for build in builds if build['result'] in SUCCEEDED), None),
+				'built': len(built),
+				'median': median([build['duration'] for build in built]),
+				'peakmemory': max([build['peakmemory'] for build in built if build.get('peakmemory')] or [None]),
+				'failurerate': float(failures) / len(built) if built else None}
+
+	def stats(self, repo):
+		"""Return the aggregates over the last builds of the repo. Database errors are raised to the caller"""
+		repo = db.normalizerepo(repo)
+		found, stats = self.cache.get(repo)
+		if found:
+			return stats
+		generation = self.cache.generation(repo)
+		stats = self._aggregate(db.getbuildhistory(repo, self.window))
+		self.cache.put(repo, stats, generation)
+		return stats
+
+	def estimate(self, repo):
+		"""Return the median seconds a build of the repo takes or None if it is not known"""
+		try:
+			return self.stats(repo)['median']
+		except Exception as e:
+			logger.info(e)
+		return None
+
+	def memory(self, repo):
+		"""Return the most memory a recent build of the repo took in bytes or None if it is not known"""
+		try:
+			return self.stats(repo)['peakmemory']
+		except Exception as e:
+			logger.info(e)
+		return None
+
+	def invalidate(self, repo):
+		"""Forget the cached aggregates of a repo, i.e. when the build workers of another process build it"""
+		self.cache.invalidate(db.normalizerepo(repo))
+
+	def record(self, repo, buildmatrix, commit, result, reason, chatids, started, duration, artifactbytes=0,
+				peakmemory=None):
+		"""Append a finished build to the history and update the aggregates of the repo. result is the result label of
+		githelper.clone or 'error' if the build crashed, reason why it was built - command, force or autobuild - and
+		chatids the chats which waited on it. peakmemory is the most memory the build took if the sandbox measured it"""
+		repo = db.normalizerepo(repo)
+		build = {'url': repo, 'commit_hash': commit, 'buildmatrix': buildmatrix, 'result': result, 'reason': reason,
+				'chatid': chatids[0] if chatids else None, 'chats': len(chatids), 'started': started,
+				'duration': duration, 'artifactbytes': artifactbytes, 'peakmemory': peakmemory}
+		with self._lock:
+			"""Load the repo before the row is queued, the query must not see it"""
+			try:
+				builds = self.stats(repo)['builds']
+			except Exception as e:
+				logger.info(e)
+				builds = None
+			db.addbuildhistory(**build)
+			if builds is not None:
+				self.cache.put(repo, self._aggregate(([build] + builds)[:self.window]))
+			prune = self.retention and time.time() - self._lastprune > 60 * 60
+			if prune:
+				self._lastprune = time.time()
+		if prune:
+			db.prunebuildhistory(time.time() - self.retention)
+
+	def finished(self, repo, buildmatrix, commit, requests, result, report, started):
+		"""Record a build run by githelper.clone for requests. result is the return value of clone or None if it
+		crashed and report the dict clone filled"""
+		reason = 'force' if any(request.force for request in requests) else requests[0].reason
+		artifactbytes = 0
+		if result is not None and result[0]:
+			artifactbytes = sum(os.path.getsize(artifact.path) for artifact in result[1]
+								if os.path.isfile(artifact.path))
+		chatids = []
+		for request in requests:
+			if request.status.chat_id not in chatids:
+				chatids.append(request.status.chat_id)
+		self.record(repo, buildmatrix, report.get('commit') or commit, report.get('result', 'error'), reason, chatids,
+					started, time.time() - started, artifactbytes, report.get('peakmemory'))
+
+
+def formatduration(seconds):
+	"""Return seconds as i.e. 45s, 3m 20s or 2h 5m"""
+	seconds = int(round(seconds))
+	if seconds < 60:
+		return "{0}s".format(seconds)
+	if seconds < 60 * 60:
+		return "{0}m {1}s".format(seconds // 60, seconds % 60)
+	return "{0}h {1}m".format(seconds // 3600, seconds % 3600 // 60)
+
+
+def formatbuild(build, now=None):
+	"""Return a line describing a build of the history"""
+	ago = (now or time.time()) - build['started']
+	return "{0} {1} - {2} in {3}, {4} ago".format((build['commit_hash'] or '')[:7], build['result'],
+													build['reason'], formatduration(build['duration']),
+													formatduration(max(0, ago)))
+
+
+history = BuildHistory(historywindow, historyretention, historycachesize)
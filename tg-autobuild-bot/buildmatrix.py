@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+import re
+from collections import namedtuple
+
+from artifacts import DEFAULT_VARIANT
+
+"""Built when no build matrix is set for the chat"""
+DEFAULT_MATRIX = 'app::release'
+
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+"""A single apk of the build matrix. flavor is empty if the module has no product flavors"""
+Variant = namedtuple('Variant', 'module flavor buildtype')
+
+
+def _capitalize(name):
+	return name[:1].upper() + name[1:]
+
+
+def variantname(variant):
+	"""Return the gradle name of the variant, i.e. freeRelease"""
+	if not variant.flavor:
+		return variant.buildtype
+	return variant.flavor + _capitalize(variant.buildtype)
+
+
+def variantkey(variant):
+	"""Return the key the apk of the variant is stored and sent under. The release build of the app module keeps the
+	key apks were stored with before build matrices existed"""
+	if variant.module == 'app':
+		if not variant.flavor and variant.buildtype == DEFAULT_VARIANT:
+			return DEFAULT_VARIANT
+		return variantname(variant)
+	return '{0}:{1}'.format(variant.module, variantname(variant))
+
+
+def task(variant):
+	"""Return the gradle task assembling the variant"""
+	return ':{0}:assemble{1}'.format(variant.module, _capitalize(variantname(variant)))
+
+
+def _names(text, default):
+	names = [name.strip() for name in text.split(',') if name.strip()]
+	for name in names:
+		if not NAME_PATTERN.match(name):
+			raise ValueError("Invalid name '{0}' in the build matrix".format(name))
+	return names or default
+
+
+def parsematrix(text):
+	"""Parse a build matrix of the form modules:flavors:buildtypes where every part is a comma separated list, i.e.
+	app,wear:free,paid:release. Empty parts default to the app module, no flavor and the release build type.
+	Returns the list of variants of every combination. Raises ValueError if the matrix is invalid"""
+	parts = (text or DEFAULT_MATRIX).split(':')
+	if len(parts) > 3:
+		raise ValueError("A build matrix has at most three parts: modules:flavors:buildtypes")
+	parts += [''] * (3 - len(parts))
+	modules = _names(parts[0], ['app'])
+	flavors = _names(parts[1], [''])
+	buildtypes = _names(parts[2], [DEFAULT_VARIANT])
+	return [Variant(module, flavor, buildtype)
+			for module in modules for flavor in flavors for buildtype in buildtypes]
+
+
+def formatmatrix(variants):
+	"""Return a human readable list of the variants"""
+	return ', '.join(variantkey(variant) for variant in variants)
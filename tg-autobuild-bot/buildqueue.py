@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+
+class BuildRequest(object):
+	"""A single chat waiting for a build. message is the command message sent by the user and status is the message
+	of the bot which is edited to report the progress. force is set if the chat asked for a fresh build. repo is the
+	github repo of the chat which is built, a chat may have several. reason is why the build was asked for, 'command'
+	or 'autobuild'. wait is the estimated number of seconds until the build starts, None if it is not known"""
+
+	def __init__(self, bot, message, status, force=False, repo=None, reason='command'):
+		self.bot = bot
+		self.message = message
+		self.status = status
+		self.force = force
+		self.repo = repo
+		self.reason = reason
+		self.position = None
+		self.wait = None
+
+
+class BuildJob(object):
+	"""A build of one repo shared by every request which was coalesced into it.
+	key identifies what is built (requests with the same key get the same apk) and lock identifies the working
+	directory, jobs with the same lock never run at the same time"""
+
+	def __init__(self, key, lock, priority, seq, cost=0, estimate=None):
+		self.key = key
+		self.lock = lock
+		self.priority = priority
+		self.seq = seq
+		self.cost = cost
+		self.estimate = estimate
+		self.started = None
+		self.skips = 0
+		self.requests = []
+		self.closed = False
+
+	def __lt__(self, other):
+		return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class BuildScheduler(object):
+	"""Runs builds on a fixed number of worker threads.
+
+	Jobs wait in a priority queue (FIFO within the same priority). A request for a key which is already queued or
+	running is attached to that job instead of starting another build. run(job) performs the build and returns its
+	result, deliver(job, result) is then called once the job is closed for new requests. notify(request, position) is
+	called whenever the queue position of a waiting request changes.
+
+	If capacity is set, a job only starts while the costs of the running jobs (i.e. their memory ceilings) leave room
+	for its own cost, so several small builds run side by side while a large one waits for the machine. A job which does
+	not fit may be overtaken by smaller jobs maxskips times, after that nothing else starts until it fits.
+
+	estimate(key), if set, returns the seconds a build of key is expected to take or None. The requests then get the
+	estimated seconds until their build starts along with their position"""
+
+	def __init__(self, run, deliver, notify=None, workers=2, capacity=None, maxskips=3, estimate=None):
+		self.run = run
+		self.deliver = deliver
+		self.notify = notify
+		self.estimate = estimate
+		self.workers = workers
+		self.capacity = capacity
+		self.maxskips = maxskips
+		self._used = 0
+		self._heap = []
+		self._pending = {}
+		self._running = {}
+		self._locks = set()
+		self._seq = itertools.count()
+		self._cond = threading.Condition()
+		self._stopping = False
+		self._idle = 0
+		self._threads = []
+		for i in range(workers):
+			thread = threading.Thread(target=self._work, name="build-worker-{}".format(i))
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+
+	def submit(self, key, lock, request, priority=PRIORITY_NORMAL, cost=0):
+		"""Queue a build request. Returns the queue position of the request, 0 if it joined a running build.
+		The request is notified of its position unless its build can start right away"""
+		"""The estimate may query the database, it must not hold up the other builds"""
+		estimate = self.estimate(key) if self.estimate is not None else None
+		with self._cond:
+			if self._stopping:
+				raise RuntimeError("Build scheduler is shutting down")
+			job = self._running.get(key)
+			if job is not None and not job.closed:
+				job.requests.append(request)
+				request.position = 0
+				moved = [request]
+			else:
+				job = self._pending.get(key)
+				if job is None:
+					job = BuildJob(key, lock, priority, next(self._seq), self._clamp(cost), estimate)
+					self._pending[key] = job
+					heapq.heappush(self._heap, job)
+				elif priority < job.priority:
+					"""A more urgent request pulls the whole coalesced job forward"""
+					job.priority = priority
+					heapq.heapify(self._heap)
+				job.requests.append(request)
+				moved = self._positions()
+				self._cond.notify()
+				if request.position <= self._idle and lock not in self._locks and self._fits(job):
+					moved.remove(request)
+		self._notify(moved)
+		return request.position
+
+	def _clamp(self, cost):
+		"""A job costing more than the whole capacity runs alone"""
+		if self.capacity is None:
+			return cost
+		return min(cost, self.capacity)
+
+	def _fits(self, job):
+		return self.capacity is None or self._used + job.cost <= self.capacity
+
+	def _next(self):
+		"""Pop the most urgent job whose working directory is not busy and which fits into the free capacity. Jobs it
+		overtakes because they do not fit are charged a skip. Must be called with the lock held"""
+		overtaken = []
+		for job in sorted(self._heap):
+			if job.lock in self._locks:
+				continue
+			if not self._fits(job):
+				if job.skips >= self.maxskips:
+					"""Reserve the capacity for the job, smaller jobs have to wait until it started"""
+					return None
+				overtaken.append(job)
+				continue
+			for other in overtaken:
+				other.skips += 1
+			self._heap.remove(job)
+			heapq.heapify(self._heap)
+			del self._pending[job.key]
+			self._used += job.cost
+			return job
+		return None
+
+	def _work(self):
+		while True:
+			with self._cond:
+				job = self._next()
+				while job is None:
+					if self._stopping and not self._heap:
+						return
+					self._idle += 1
+					self._cond.wait()
+					self._idle -= 1
+					job = self._next()
+				job.started = time.time()
+				self._running[job.key] = job
+				self._locks.add(job.lock)
+				moved = self._positions()
+			self._notify(moved)
+			result = None
+			try:
+				result = self.run(job)
+			except Exception as e:
+				logger.exception(e)
+			with self._cond:
+				job.closed = True
+				del self._running[job.key]
+				"""The build is done, the capacity is free while its apk is delivered"""
+				self._used -= job.cost
+				self._cond.notify_all()
+			try:
+				self.deliver(job, result)
+			except Exception as e:
+				logger.exception(e)
+			with self._cond:
+				self._locks.discard(job.lock)
+				self._cond.notify_all()
+
+	def _positions(self):
+		"""Recompute the queue positions and return the requests whose position changed. The wait of every request is
+		estimated too: the running builds end after their estimated duration and the queued ones start in order on the
+		first free worker. Memory and directory locks are not taken into account"""
+		moved = []
+		now = time.time()
+		free = [max(0, job.started + job.estimate - now) if job.estimate is not None else None
+				for job in self._running.values()]
+		free += [0] * max(0, self.workers - len(free))
+		known = None not in free
+		heapq.heapify(free)
+		for position, job in enumerate(sorted(self._heap), 1):
+			start = None
+			if known:
+				start = heapq.heappop(free)
+				known = job.estimate is not None
+				if known:
+					heapq.heappush(free, start + job.estimate)
+			for request in job.requests:
+				request.wait = start
+				if request.position != position:
+					request.position = position
+					moved.append(request)
+		return moved
+
+	def _notify(self, requests):
+		if self.notify is None:
+			return
+		for request in requests:
+			try:
+				self.notify(request, request.position)
+			except Exception as e:
+				logger.info(e)
+
+	def depth(self):
+		"""Number of queued and running jobs"""
+		with self._cond:
+			return len(self._heap), len(self._running)
+
+	def usage(self):
+		"""Summed cost of the running jobs and the capacity"""
+		with self._cond:
+			return {'used': self._used, 'capacity': self.capacity or 0}
+
+	def shutdown(self, wait=True, timeout=None):
+		"""Stop accepting builds. Queued builds are still run. If wait is True block until every worker is done or
+		timeout seconds passed"""
+		with self._cond:
+			self._stopping = True
+			self._cond.notify_all()
+		if wait:
+			deadline = None if timeout is None else time.time() + timeout
+			for thread in self._threads:
+				thread.join(None if deadline is None else max(0, deadline - time.time()))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+import gzip
+import logging
+import os
+import tempfile
+from collections import namedtuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+import metrics
+import mysqlHelper as db
+from artifacts import Artifact, store
+from deltas import deltas
+from githelper import samecommit
+from outbox import outbox
+from config import botUserName
+
+logger = logging.getLogger(__name__)
+
+"""The status message of a build known only by its ids, i.e. in a build worker process. A telegram Message has the
+same attributes and can be used wherever a StatusMessage is expected"""
+StatusMessage = namedtuple('StatusMessage', 'bot chat_id message_id')
+
+
+def updatemessage(message, new_text_message):
+	"""Method to update a message with new text. The edit is queued in the outbox, which merges it with pending edits
+	of the same message and sends it within the flood limits"""
+	outbox.edit(message.bot, message.chat_id, message.message_id, new_text_message)
+
+
+def reply(message, text, **kwargs):
+	"""Method to reply to a message through the outbox, so command replies count against the flood limits as well.
+	Returns the sent message"""
+	return outbox.call(message.chat_id, lambda: message.reply_text(text, **kwargs))
+
+
+def sendFile(bot, chat_id, pathToFile, artifact=None, filename=None, caption=None):
+	"""Method to send a file to the chat (apk, log). If the file is a stored artifact, the telegram file_id of an earlier
+	upload of it is reused. The file is only uploaded again if telegram rejects the file_id and the file is stored here.
+	Uploads go through the upload lane of the outbox so they do not hold up short messages"""
+	if artifact is not None:
+		file_id = db.getfileid(artifact.url, artifact.commit, artifact.variant)
+		if file_id:
+			try:
+				with metrics.span('autobuild_send_seconds', method='file_id'):
+					return outbox.call(chat_id, lambda: bot.send_document(chat_id=chat_id, document=file_id,
+																			caption=caption))
+			except BadRequest as e:
+				if pathToFile is None:
+					raise
+				logger.info("Cached file_id rejected, uploading the file again: %s", e)
+
+	def upload():
+		with open(pathToFile, 'rb') as document:
+			return bot.send_document(chat_id=chat_id, document=document, filename=filename, caption=caption)
+	with metrics.span('autobuild_send_seconds', method='upload'):
+		sent = outbox.upload(chat_id, upload)
+	metrics.registry.inc('autobuild_sent_bytes_total', os.path.getsize(pathToFile))
+	if artifact is not None and sent.document is not None:
+		db.setfileid(artifact.url, artifact.commit, artifact.variant, sent.document.file_id)
+	return sent
+
+
+def sendapk(bot, chat_id, artifact, previous=None):
+	"""Send an apk to the chat. previous is the commit whose apk the chat got last if the chat asked for delta
+	delivery. A binary patch from that apk is sent instead of the apk if it is much smaller, the full apk otherwise"""
+	if previous and not samecommit(previous, artifact.commit):
+		old = store.get(artifact.url, previous, artifact.variant)
+		delta = deltas.patch(old, artifact) if old is not None else None
+		if delta is not None:
+			oldname, newname = os.path.basename(old.path), os.path.basename(artifact.path)
+			patchname = '{0}.bsdiff'.format(os.path.splitext(newname)[0])
+			caption = ("Patch from {0} ({1:.1f} MB instead of {2:.1f} MB). Apply it to the apk you got before with:\n"
+						"bspatch {3} {4} {5}\nsha256 of {3}: {6}\nsha256 of {4}: {7}\n/delivery full sends whole apks"
+						.format(old.commit[:7], os.path.getsize(delta.path) / 1048576.0,
+								os.path.getsize(artifact.path) / 1048576.0, oldname, newname, patchname,
+								delta.oldsha[:16], delta.newsha[:16]))
+			"""The file_id of a patch is stored under a variant naming both apks"""
+			patch = Artifact(artifact.url, artifact.commit, '{0}~{1}'.format(artifact.variant, delta.oldsha[:16]),
+								delta.path)
+			metrics.registry.inc('autobuild_deliveries_total', mode='delta')
+			return sendFile(bot, chat_id, delta.path, patch, filename=patchname, caption=caption)
+	metrics.registry.inc('autobuild_deliveries_total', mode='full')
+	return sendFile(bot, chat_id, artifact.path, artifact)
+
+
+def sendlog(bot, chat_id, log):
+	"""Send the log of a failed build, as saved by db.setbuildlog, to the chat gzip compressed"""
+	fd, gzpath = tempfile.mkstemp(suffix='.log.gz')
+	os.close(fd)
+	try:
+		with gzip.open(gzpath, 'wb') as compressed:
+			compressed.write(log.encode('utf-8') if isinstance(log, unicode) else log)
+		return sendFile(bot, chat_id, gzpath, filename='error.log.gz', caption="Build log, trimmed to the failure")
+	finally:
+		os.remove(gzpath)
+
+
+def deliver(requests, result):
+	"""Send the apks to every chat waiting on a build or inform them that the build failed. result is the return value
+	of githelper.clone or None if the build crashed"""
+	result, artifacts = result if result is not None else (False, None)
+	if not result:
+		for request in requests:
+			buildfailed(request, artifacts)
+		return
+	for request in requests:
+		try:
+			updatemessage(request.status, "Sending apk..." if len(artifacts) == 1 else
+							"Sending {0} apks...".format(len(artifacts)))
+			chat_id = request.status.chat_id
+			previous = db.getlatesthash(chat_id, request.repo) if db.getdelivery(chat_id) == 'delta' else None
+			for artifact in artifacts:
+				sendapk(request.bot, chat_id, artifact, previous)
+			"""Update the hash to the built commit hash to check if the app should be built again
+			if there is no new commits in the upstream"""
+			db.updatehash(request.status.chat_id, artifacts[0].commit, request.repo)
+		except Exception as e:
+			logger.info(e)
+
+
+def buildfailed(request, failure=None):
+	"""Oops! Building app failed for some reason! Show the lines of the log explaining the failure if there are any and
+	ask the user if the full error log must be sent. If yes, it is sent in a private chat. Only the ids of the messages
+	are used, private chats are the ones with a positive id. The buttons name the repo by the id of its row as the
+	callback data of telegram is limited to 64 bytes"""
+	chat_id = request.status.chat_id
+	recordid = db.getrepoid(chat_id, request.repo)
+	if chat_id > 0:
+		keyboard = [[InlineKeyboardButton("Send", callback_data="err-log-send%{0}".format(recordid)),
+					InlineKeyboardButton("Don't send", callback_data="err-log-dntsend")]]
+	else:
+		"""Called when the chat is not private. This lets the log to be sent in private than in the group"""
+		keyboard = [[InlineKeyboardButton("Send",
+											url="https://telegram.me/{0}?start=sendlog_{1}_{2}".format(botUserName,
+											chat_id, recordid),
+											callback_data="err-log-msg-update"),
+					InlineKeyboardButton("Don't send", callback_data="err-log-dntsend")]]
+	reply_markup = InlineKeyboardMarkup(keyboard)
+	updatemessage(request.status, "Build failed")
+	if failure:
+		"""Keep the excerpt well below the 4096 characters limit of a telegram message"""
+		excerpt = "\n".join(failure)[-3000:]
+		text = "An error has occured while building the app:\n\n{}\n\nDo you want me to send the log?".format(excerpt)
+	else:
+		text = "An error has occured while building the app. Do you want me to send the log?"
+	outbox.call(chat_id, lambda: request.bot.send_message(chat_id, text, reply_markup=reply_markup,
+															reply_to_message_id=request.message.message_id))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import logging
+import os
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+	import bsdiff4
+except ImportError:
+	bsdiff4 = None
+
+import config
+import metrics
+from artifacts import store
+
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+deltadir = getattr(config, 'deltadir', 'deltas')
+deltamaxcount = getattr(config, 'deltamaxcount', 200)
+"""bsdiff needs about 17 times the size of the apk in memory, larger apks are always sent in full"""
+deltamaxsize = getattr(config, 'deltamaxsize', 32 * 1024 * 1024)
+"""A patch is only sent if it is at most this fraction of the size of the apk"""
+deltamaxratio = getattr(config, 'deltamaxratio', 0.6)
+
+"""A binary patch turning the apk old into the apk new. path is where the patch is kept"""
+Delta = namedtuple('Delta', 'old new oldsha newsha path')
+
+
+class DeltaCache(object):
+	"""Binary patches between stored apks, created with bsdiff4 if it is installed.
+
+	Patches are keyed by the content hashes of both apks, so every chat upgrading from the same apk gets the same
+	patch and a rebuilt apk never gets the patch of another build. The deltamaxcount least recently used patches
+	are kept. Every patch has its own lock, so diffs of different apks run at the same time while concurrent requests
+	for the same patch wait for one diff"""
+
+	def __init__(self, root, maxcount):
+		self.root = root
+		self.maxcount = maxcount
+		self._lock = threading.Lock()
+		self._paths = {}
+
+	@contextmanager
+	def _locked(self, path):
+		"""Hold the lock of the patch at path. A lock is dropped once no thread holds or waits for it"""
+		with self._lock:
+			entry = self._paths.setdefault(path, [threading.Lock(), 0])
+			entry[1] += 1
+		try:
+			with entry[0]:
+				yield
+		finally:
+			with self._lock:
+				entry[1] -= 1
+				if not entry[1]:
+					del self._paths[path]
+
+	def available(self):
+		return bsdiff4 is not None
+
+	def patch(self, old, new):
+		"""Return the Delta from the artifact old to the artifact new or None if it is not worth sending"""
+		if bsdiff4 is None:
+			return None
+		newsize = os.path.getsize(new.path)
+		if max(os.path.getsize(old.path), newsize) > deltamaxsize:
+			return None
+		oldsha, newsha = store.digest(old), store.digest(new)
+		path = os.path.join(self.root, '{0}-{1}.bsdiff'.format(oldsha[:16], newsha[:16]))
+		with self._locked(path):
+			if not os.path.isfile(path):
+				try:
+					if not os.path.isdir(self.root):
+						os.makedirs(self.root)
+				except OSError as e:
+					"""Another patch may have created it meanwhile"""
+					if not os.path.isdir(self.root):
+						logger.info(e)
+						return None
+				try:
+					with metrics.span('autobuild_delta_seconds'):
+						bsdiff4.file_diff(old.path, new.path, path + '.tmp')
+				except Exception as e:
+					logger.info("Could not diff %s and %s: %s", old.path, new.path, e)
+					return None
+				os.rename(path + '.tmp', path)
+				created = True
+			else:
+				os.utime(path, None)
+				created = False
+			size = os.path.getsize(path)
+		if created:
+			self._evict()
+		if size > newsize * deltamaxratio:
+			return None
+		return Delta(old, new, oldsha, newsha, path)
+
+	def _evict(self):
+		"""Remove the least recently used patches above maxcount. Patches which are being created or looked up are
+		kept"""
+		with self._lock:
+			patches = [os.path.join(self.root, name) for name in os.listdir(self.root)
+						if name.endswith('.bsdiff') and os.path.join(self.root, name) not in self._paths]
+			patches.sort(key=os.path.getmtime)
+			for path in patches[:max(0, len(patches) - self.maxcount)]:
+				try:
+					os.remove(path)
+				except OSError as e:
+					logger.info(e)
+
+
+deltas = DeltaCache(deltadir, deltamaxcount)
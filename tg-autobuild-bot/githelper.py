@@ -1,99 +1,295 @@
 #!/usr/bin/env python
+import fnmatch
+import glob
 import logging
 import os
-import shutil
-import subprocess
+import time
 
-from git import Repo
 from git.exc import GitCommandError
 
+import config
+import metrics
 import mysqlHelper as db
+import remotehead
+from artifacts import DEFAULT_VARIANT, Artifact, isabbreviation, store
+from buildmatrix import parsematrix, task, variantkey
+from gradleenv import gradle
+from mirrors import mirrors, normalizeurl
+from procrunner import GradleProgress, stream, trimlog
+from sandbox import BuildLimits, runner
 from config import (gitusername, gitpassword)
 
 logger = logging.getLogger(__name__)
 
+"""Minimum seconds between two build progress updates of a message"""
+progressinterval = getattr(config, 'progressinterval', 5)
+"""Paths which do not affect the apk. If every file changed since the last build matches, its apk is reused. Any other
+file is taken to affect the apk, a path missing here costs a build instead of sending an outdated apk. Patterns without
+a / only match files in the repo root"""
+ignoreglobs = getattr(config, 'ignoreglobs', (
+	'*.md', 'docs/*', 'doc/*', '.github/*', '.gitlab/*', '.gitlab-ci.yml', '.travis.yml', 'fastlane/*', 'LICENSE*',
+	'COPYING*', 'README*', 'CHANGELOG*', '.gitignore', '*/.gitignore', '.gitattributes', '.editorconfig'))
 
-def clone(bot, message, updateMessage, sendFile):
-	"""Method to clone/pull and build the repo"""
-	repoURL = db.getrepocloneurl(message.chat_id, gitusername, gitpassword)
-	repoDir = db.getrepodir(message.chat_id)
-	if not os.path.isdir(repoDir):
-		"""The repo isnt cloned yet. Let's clone it first"""
-		try:
-			Repo.clone_from(repoURL, repoDir)
-		except GitCommandError as e:
-			e = str(e)
-			if "Authentication failed" in e:
-				updateMessage(message, "Git Authentication error")
-			elif "Repository not found" in e:
-				updateMessage(message, "Repo not found! Check your remote repository and try again!")
-			else:
-				updateMessage(message, "unknown error")
-			return False
-		updateMessage(message, "repo cloned")
-		"""The repo exists already. Let's just pull the latest source"""
+metrics.registry.describe('autobuild_artifact_bytes', 'Size of built apks in bytes', buckets=metrics.SIZE_BUCKETS)
+
+
+def clone(repo, buildmatrix, updateMessage, force=False, commit=None, report=None):
+	"""Method to clone/pull and build the github repo {username}/{repository}. updateMessage is called with the text to
+	show to the waiting chats. An apk already built from the same commit is reused unless force is True, so is the apk
+	of the commit the repo was built from last if the commits since then only changed files which do not affect the
+	build. commit is the remote head if it is already known, a stored apk of it is sent without syncing the repo.
+	Every variant of buildmatrix is built in one gradle run. report, if given, is a dict which gets the result label of
+	the build and the commit it built, i.e. for the build history.
+	Returns the result - True/False and the list of stored artifacts, one per variant, if the result is True or the
+	lines of the build log explaining the failure if gradle failed"""
+	repoURL = db.getcloneurl(repo, gitusername, gitpassword)
+	repoDir = db.getrepodir(repo)
+	remoteURL = normalizeurl(repoURL)
+	variants = parsematrix(buildmatrix)
+	if not force and commit is not None:
+		artifacts = storedartifacts(remoteURL, commit, variants)
+		if artifacts is not None:
+			counted(report, 'cached', commit)
+			return True, artifacts
+	"""Every chat using the same remote shares one bare mirror, the repo directory is a worktree of it"""
+	if not mirrors.exists(repoURL):
+		updateMessage("Repo cloning...")
 	else:
-		updateMessage(message, "Repo syncing...")
-		try:
-			Repo(repoDir).remote().pull()
-		except GitCommandError as e:
-			e = str(e)
-			if "exit code(1)" in e:
-				print "Error pulling repo"
-			return False
+		updateMessage("Repo syncing...")
+	try:
+		with metrics.span('autobuild_git_sync_seconds', repo=remoteURL):
+			mirrors.sync(repoURL)
+			if commit is None:
+				commit = mirrors.head(repoURL)
+
+		"""If this commit was already built, for this chat or any other chat using the same repo, reuse the apks"""
+		artifacts = None if force else storedartifacts(remoteURL, commit, variants)
+		if artifacts is not None:
+			counted(report, 'cached', commit)
+			return True, artifacts
+		artifacts = None if force else retag(repo, repoURL, commit, variants)
+		if artifacts is not None:
+			counted(report, 'retagged', commit)
+			return True, artifacts
+
+		"""The worktree keeps the outputs of the previous build, gradle only reruns the tasks whose inputs changed"""
+		with metrics.span('autobuild_git_checkout_seconds', repo=remoteURL):
+			mirrors.checkout(repoURL, commit, repoDir)
+	except GitCommandError as e:
+		e = str(e)
+		if "Authentication failed" in e:
+			updateMessage("Git Authentication error")
+		elif "Repository not found" in e:
+			updateMessage("Repo not found! Check your remote repository and try again!")
+		else:
+			logger.info(e)
+			updateMessage("unknown error")
+		counted(report, 'git_error', commit)
+		return False, None
 
 	# time.sleep(5)
-	updateMessage(message, "Building apk...")
-	"""Build the apk. Returns the result - True/False and the apk path if the result is True"""
-	result, apkLocation = buildapk(repoDir)
+	updateMessage("Building apk...")
+	with metrics.span('autobuild_gradle_seconds', repo=remoteURL) as labels:
+		result, output = buildapk(repoDir, updateMessage, variants=variants, report=report)
+		labels['result'] = 'success' if result else 'failure'
+	counted(report, labels['result'], commit)
 	if not result:
-		updateMessage(message, "Building apk failed...")
-		return False
-	"""Send the apk to the chat"""
-	updateMessage(message, "Sending apk...")
-	sendFile(bot, message.chat_id, apkLocation)
-	"""Update the hash to latest commit hash to check if the app should be built again
-	if there is no new commits in the upstream"""
-	db.updatehash(message.chat_id, getLatestRemoteHash(repoDir))
-	return True
-
-
-def buildapk(repodir):
-	"""Build the apk, sign and copy the signed apk to /outputs directory with the commit hash appended to the file name.
-	Redirect all the gradle errors to error.log file"""
+		updateMessage("Building apk failed...")
+		logpath = db.getlogfile(repo)
+		if os.path.isfile(logpath):
+			db.setbuildlog(repo, '\n'.join(trimlog(logpath)) + '\n')
+		return False, output
+	artifacts = []
+	for variant, path in output:
+		metrics.registry.observe('autobuild_artifact_bytes', os.path.getsize(path), repo=remoteURL)
+		artifacts.append(store.put(remoteURL, commit, path, apkName(repoDir, commit, variant), variantkey(variant)))
+	db.setbuilthash(repo, commit)
+	return True, artifacts
+
+
+def counted(report, result, commit):
+	"""Count a finished build by its result and tell the caller of clone"""
+	metrics.registry.inc('autobuild_builds_total', result=result)
+	if report is not None:
+		report['result'] = result
+		report['commit'] = commit
+
+
+def storedartifacts(remoteURL, commit, variants):
+	"""Return the stored artifacts of every variant built from commit or None if any of them is missing"""
+	artifacts = []
+	for variant in variants:
+		artifact = store.get(remoteURL, commit, variantkey(variant))
+		if artifact is None:
+			return None
+		artifacts.append(artifact)
+	return artifacts
+
+
+def uploadedartifacts(remoteURL, commit, variants):
+	"""Return the artifacts of every variant built from commit which were uploaded to telegram before or None if any of
+	them was not. Their path is None, they can only be sent by the file_id of the upload. The apks of build workers are
+	stored on the hosts of the workers, the file_ids are shared through the database"""
+	artifacts = []
+	for variant in variants:
+		artifact = Artifact(remoteURL, commit, variantkey(variant), None)
+		if db.getfileid(artifact.url, artifact.commit, artifact.variant) is None:
+			return None
+		artifacts.append(artifact)
+	return artifacts
+
+
+def affectsbuild(path):
+	"""Return True if a change of the file at path, relative to the repo root, may change the apk. Files below a src
+	directory, i.e. assets and raw resources, always do"""
+	parts = path.split('/')
+	if 'src' in parts[:-1]:
+		return True
+	return not any(fnmatch.fnmatch(path, pattern) for pattern in ignoreglobs if '/' in pattern or len(parts) == 1)
+
+
+def retag(repo, repoURL, commit, variants):
+	"""Store the apks of the commit the repo was built from last under commit too if none of the files changed in
+	between affects the build. The file_ids telegram gave the apks are kept as well. Returns the list of artifacts or
+	None if commit has to be built"""
+	previous = db.getbuilthash(repo)
+	if not previous or samecommit(previous, commit):
+		return None
+	remoteURL = normalizeurl(repoURL)
+	artifacts = storedartifacts(remoteURL, previous, variants)
+	if artifacts is None:
+		return None
+	paths = mirrors.changedpaths(repoURL, artifacts[0].commit, commit)
+	if paths is None or any(affectsbuild(path) for path in paths):
+		return None
+	tagged = []
+	for artifact in artifacts:
+		retagged = store.tag(artifact, commit)
+		if retagged is None:
+			return None
+		file_id = db.getfileid(artifact.url, artifact.commit, artifact.variant)
+		if file_id:
+			db.setfileid(retagged.url, retagged.commit, retagged.variant, file_id)
+		tagged.append(retagged)
+	logger.info("Reusing the apks of %s for %s, %d changed files do not affect the build", artifacts[0].commit, commit,
+				len(paths))
+	return tagged
+
+
+def buildapk(repodir, updateMessage, limits=None, variants=None, report=None):
+	"""Build and sign the apk of every variant in the warm gradle environment, confined by the configured build sandbox
+	to limits. All variants are assembled by a single gradle run, independent modules in parallel. The gradle output is
+	streamed to error.log and the running task is reported through updateMessage. Returns the result - True/False and
+	a list of (variant, path of the signed apk) if the result is True or the lines of the log explaining the failure if
+	it is False. report, if given, gets the most memory the build took if the sandbox measured it"""
+	if variants is None:
+		variants = parsematrix('')
+	gradlew = os.path.join(repodir, 'gradlew')
+	argv, env = gradle.command(repodir, [task(variant) for variant in variants])
+	if len(set(variant.module for variant in variants)) > 1:
+		argv.append('--parallel')
+	progress = GradleProgress(updateMessage, "Building apk...", progressinterval)
+	"""The worktree keeps the outputs of earlier builds. Their apks are removed, so gradle writes the apk again even if
+	its task is up to date and an apk of an older commit is never taken for this build"""
+	for variant in variants:
+		for path in apkcandidates(repodir, variant.module, variant.buildtype, variant.flavor):
+			try:
+				os.remove(path)
+			except OSError as e:
+				logger.info(e)
+	started = time.time()
+	box = None
 	try:
-		output = subprocess.check_output(
-			"cd " + repodir + " && chmod +x gradlew && ./gradlew assembleRelease --stacktrace 2> error.log", shell=True)
-		if "BUILD SUCCESSFUL" in output:
-			apkPath = subprocess.check_output('find  -name "app-release.apk"', shell=True)
-			if apkPath.rstrip() == '':
-				"""Probably apk signing failed"""
-				logger.info("APK not available")
-				return False, None
-			subprocess.check_output('mkdir -p ' + repodir + '/output', shell=True)
-			apkDestLocation = destApkLocation(repodir)
-			shutil.move(apkPath.rstrip(), apkDestLocation)
-			return True, apkDestLocation
-		return False, None
-	except subprocess.CalledProcessError as e:
-		print "error code", e.returncode
-		if e.returncode is not 0:
-			return False, None
-	return False, None
+		os.chmod(gradlew, os.stat(gradlew).st_mode | 0o111)
+		box = runner.sandbox(repodir, env, limits or BuildLimits())
+		process = stream(box.wrap(argv), repodir, env, os.path.join(repodir, 'error.log'), online=progress,
+						timeout=box.limits.timeout, preexec=box.preexec)
+	except (OSError, IOError) as e:
+		logger.info(e)
+		return False, [str(e)]
+	finally:
+		if box is not None:
+			if report is not None:
+				report['peakmemory'] = box.peakmemory()
+			box.close()
+		gradle.finished(repodir, env, time.time() - started)
+		logger.info("Gradle daemons: %s", gradle.stats())
+	if process.timedout is not None:
+		metrics.registry.inc('autobuild_build_timeouts_total')
+	if process.returncode != 0:
+		logger.info("Gradle exited with %s", process.returncode)
+		return False, process.failuretail()
+	apks = []
+	for variant in variants:
+		"""Some file systems round mtimes to seconds"""
+		apkPath = findapk(repodir, variant.module, variant.buildtype, variant.flavor, since=started - 1)
+		if apkPath is None:
+			"""Probably apk signing failed"""
+			logger.info("APK of %s not available", variantkey(variant))
+			return False, ["Build succeeded but no signed apk of {0} was found. Is the {1} signing config set?".format(
+				variantkey(variant), variant.buildtype)]
+		apks.append((variant, apkPath))
+	return True, apks
+
+
+@metrics.timed('autobuild_apk_discovery_seconds')
+def apkcandidates(repodir, module='app', buildtype='release', flavor=''):
+	"""Return the apks in the output directories the android gradle plugin writes the module, flavor and build type to:
+	<module>/build/outputs/apk/[<flavor>/]<buildtype>/ since plugin 3.0 and <module>/build/outputs/apk/ before.
+	Without a flavor the apks of any flavor are returned"""
+	outputs = os.path.join(repodir, module, 'build', 'outputs', 'apk')
+	if flavor:
+		return (glob.glob(os.path.join(outputs, flavor, buildtype, '*.apk')) +
+				glob.glob(os.path.join(outputs, '*-{0}-{1}.apk'.format(flavor, buildtype))))
+	return (glob.glob(os.path.join(outputs, buildtype, '*.apk')) +
+			glob.glob(os.path.join(outputs, '*', buildtype, '*.apk')) +
+			glob.glob(os.path.join(outputs, '*-{}.apk'.format(buildtype))))
 
 
-def destApkLocation(repodir):
-	"""Return the location where the apk must be copied to"""
+def findapk(repodir, module='app', buildtype='release', flavor='', since=None):
+	"""Return the signed apk gradle built for the module, flavor and build type or None if there is none. Apks written
+	before since, the time the build started, are left out"""
+	candidates = apkcandidates(repodir, module, buildtype, flavor)
+	if since is not None:
+		candidates = [path for path in candidates if os.path.getmtime(path) >= since]
+	"""Unsigned apks are left behind when the signing config is missing"""
+	signed = [path for path in candidates if not path.endswith(('-unsigned.apk', '-unaligned.apk'))]
+	if not signed:
+		return None
+	return max(signed, key=os.path.getmtime)
+
+
+def apkName(repodir, commit, variant=None):
+	"""Return the file name the apk is sent with. Variants other than the release apk of the app module are named"""
 	appName = repodir.rpartition('/')[2]
-	cmd = '{0}/output/{1}-{2}.apk'.format(repodir, appName, getLatestRemoteHash(repodir))
-	return cmd
+	key = variantkey(variant) if variant is not None else DEFAULT_VARIANT
+	if key == DEFAULT_VARIANT:
+		return '{0}-{1}.apk'.format(appName, commit[:7])
+	return '{0}-{1}-{2}.apk'.format(appName, key.replace(':', '-'), commit[:7])
 
 
-def getLatestRemoteHash(repodir):
-	"""Get the latest hash of the upstream repo"""
-	try:
-		output = subprocess.check_output("cd " + repodir + " && git rev-parse --short HEAD",
-											shell=True)  # , "&&", "git", "rev-parse --short HEAD)"])
-		return output.rstrip()
-	except Exception as e:
-		return ""
+def getBuiltApk(repo, buildmatrix, commit_hash):
+	"""Return the artifacts of the build matrix of the repo built from commit_hash or None if any is missing. Apks
+	which are not stored here, i.e. built by a build worker, are found by the file_ids of their uploads"""
+	if not repo or not commit_hash:
+		return None
+	remoteURL = normalizeurl(db.getcloneurl(repo, gitusername, gitpassword))
+	variants = parsematrix(buildmatrix)
+	artifacts = storedartifacts(remoteURL, commit_hash, variants)
+	if artifacts is None:
+		artifacts = uploadedartifacts(remoteURL, commit_hash, variants)
+	return artifacts
+
+
+def getRemoteHead(repo):
+	"""Get the full hash of the upstream head of the repo without touching the working tree.
+	Returns None if it could not be determined"""
+	if not repo:
+		return None
+	return remotehead.getremotehead(repo, db.getcloneurl(repo, gitusername, gitpassword))
+
+
+def samecommit(hash1, hash2):
+	"""Compare two commit hashes. Abbreviated hashes stored by older versions match their full hash. '0' and empty
+	hashes mean never built and are never the same commit"""
+	return isabbreviation(hash1, hash2) or isabbreviation(hash2, hash1)
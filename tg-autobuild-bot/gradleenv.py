@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+import glob
+import hashlib
+import logging
+import os
+import re
+import signal
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+gradleuserhome = getattr(config, 'gradleuserhome', 'gradle-home')
+gradlemaxdaemons = getattr(config, 'gradlemaxdaemons', 2)
+gradleidletimeout = getattr(config, 'gradleidletimeout', 3 * 60 * 60)
+gradlejvmargs = getattr(config, 'gradlejvmargs', '-Xmx2g -XX:MaxMetaspaceSize=512m -Dfile.encoding=UTF-8')
+gradleconfigcache = getattr(config, 'gradleconfigcache', True)
+
+"""First gradle version supporting --configuration-cache"""
+CONFIGURATION_CACHE_VERSION = (6, 6)
+
+
+def gradleversion(repodir):
+	"""Return the gradle version of the wrapper of the repo as a tuple of ints or None if it can not be found"""
+	try:
+		with open(os.path.join(repodir, 'gradle', 'wrapper', 'gradle-wrapper.properties')) as f:
+			properties = f.read()
+	except IOError:
+		return None
+	match = re.search(r'distributionUrl=.*gradle-([0-9.]+)[-.]', properties)
+	if match is None:
+		return None
+	return tuple(int(part) for part in match.group(1).strip('.').split('.'))
+
+
+def projectproperties(repodir):
+	"""Return the properties the gradle.properties of the repo sets as a dict"""
+	properties = {}
+	try:
+		with open(os.path.join(repodir, 'gradle.properties')) as f:
+			for line in f:
+				line = line.strip()
+				if not line or line.startswith(('#', '!')):
+					continue
+				key, sep, value = line.partition('=')
+				if not sep:
+					key, sep, value = line.partition(':')
+				properties[key.strip()] = value.strip()
+	except IOError:
+		pass
+	return properties
+
+
+class GradleEnvironment(object):
+	"""Keeps gradle daemons warm between builds.
+
+	Every build runs with the same managed GRADLE_USER_HOME, so dependencies, the build cache and the daemon registry
+	are shared by every repo. The daemon jvm arguments, i.e. the memory cap, are passed to the builds of projects which
+	do not set their own. Gradle reuses a daemon for builds with the same gradle version, java home and jvm arguments,
+	so at most one daemon per (gradle version, java home, jvm arguments of the project) is resident. When more than maxdaemons of them were used within the idle
+	timeout, the least recently used idle one is stopped. Daemons of a gradle version which is building are never
+	stopped"""
+
+	def __init__(self, userhome, maxdaemons, idletimeout, jvmargs, configcache):
+		self.userhome = os.path.abspath(userhome)
+		self.maxdaemons = maxdaemons
+		self.idletimeout = idletimeout
+		self.jvmargs = jvmargs
+		self.configcache = configcache
+		self._daemons = {}
+		self._lock = threading.Lock()
+		self._prepared = False
+
+	def prepare(self):
+		"""Write the gradle.properties of the managed gradle user home. Properties there take precedence over the ones
+		of the project, only the ones managing the daemons are set"""
+		if not os.path.isdir(self.userhome):
+			os.makedirs(self.userhome)
+		with open(os.path.join(self.userhome, 'gradle.properties'), 'w') as f:
+			f.write('# Managed by tg-autobuild-bot, changes are overwritten\n')
+			f.write('org.gradle.daemon=true\n')
+			f.write('org.gradle.daemon.idletimeout={}\n'.format(int(self.idletimeout * 1000)))
+		self._prepared = True
+
+	@staticmethod
+	def _daemonkey(repodir, env):
+		return gradleversion(repodir), env.get('JAVA_HOME', ''), projectproperties(repodir).get('org.gradle.jvmargs', '')
+
+	def _daemon(self, key):
+		"""Return the usage of the daemon of key. Must be called with the lock held"""
+		return self._daemons.setdefault(key, {'builds': 0, 'buildtime': 0.0, 'lastused': 0, 'running': 0})
+
+	def command(self, repodir, tasks):
+		"""Return the argv and environment to run the gradle tasks of the repo with. Every command must be followed by
+		a call of finished once the build is done, until then its daemon is busy"""
+		if not self._prepared:
+			self.prepare()
+		argv = ['./gradlew'] + list(tasks) + ['--stacktrace', '--build-cache', '--console=plain']
+		version = gradleversion(repodir)
+		if self.configcache and version is not None and version >= CONFIGURATION_CACHE_VERSION:
+			"""Problems of builds which do not support the configuration cache yet are reported but do not fail it"""
+			argv += ['--configuration-cache', '--configuration-cache-problems=warn']
+		if self.jvmargs and 'org.gradle.jvmargs' not in projectproperties(repodir):
+			argv.append('-Dorg.gradle.jvmargs={0}'.format(self.jvmargs))
+		env = dict(os.environ)
+		env['GRADLE_USER_HOME'] = self.userhome
+		with self._lock:
+			self._daemon(self._daemonkey(repodir, env))['running'] += 1
+		return argv, env
+
+	def finished(self, repodir, env, duration):
+		"""Record a build of the repo which took duration seconds and stop idle daemons above the limit. They are
+		stopped with the lock held, no build can pick a daemon up while it is stopped"""
+		key = self._daemonkey(repodir, env)
+		now = time.time()
+		with self._lock:
+			daemon = self._daemon(key)
+			daemon['running'] = max(0, daemon['running'] - 1)
+			daemon['builds'] += 1
+			daemon['buildtime'] += duration
+			daemon['lastused'] = now
+			resident = [k for k, d in self._daemons.items() if d['running'] or now - d['lastused'] < self.idletimeout]
+			"""Daemons of one gradle version are stopped together, whatever java home they run"""
+			busy = set(k[0] for k in resident if self._daemons[k]['running'])
+			idle = [k for k in resident if k[0] not in busy]
+			evict = sorted(idle, key=lambda k: self._daemons[k]['lastused'])[:max(0, len(resident) - self.maxdaemons)]
+			for k in evict:
+				self._daemons[k]['lastused'] = 0
+			for version in set(k[0] for k in evict):
+				self._stop(version)
+
+	def _stop(self, version):
+		"""Stop the daemons of a gradle version by their pids. Gradle names the log of every daemon it starts in the
+		managed user home after its pid. The pid of a daemon which exited may have been reused, only gradle daemons
+		started from the managed user home are killed"""
+		if version is None:
+			return
+		logs = os.path.join(self.userhome, 'daemon', '.'.join(str(part) for part in version), 'daemon-*.out.log')
+		for path in glob.glob(logs):
+			match = re.match(r'daemon-(\d+)\.out\.log$', os.path.basename(path))
+			if match is None:
+				continue
+			pid = int(match.group(1))
+			try:
+				with open('/proc/{0}/cmdline'.format(pid)) as f:
+					cmdline = f.read()
+			except IOError:
+				continue
+			if 'GradleDaemon' not in cmdline or self.userhome not in cmdline:
+				continue
+			try:
+				os.kill(pid, signal.SIGTERM)
+				logger.info("Stopped gradle daemon %s of gradle %s", pid, version)
+			except OSError as e:
+				logger.info("Could not stop gradle daemon %s: %s", pid, e)
+
+	def stats(self):
+		"""Return the usage of every daemon seen so far, keyed by gradle version, java home and a hash of the jvm
+		arguments of the project if it sets them"""
+		now = time.time()
+		with self._lock:
+			result = {}
+			for (version, javahome, jvmargs), daemon in self._daemons.items():
+				if not daemon['builds']:
+					continue
+				name = '.'.join(str(part) for part in version) if version else 'unknown'
+				if javahome:
+					name += '@' + javahome
+				if jvmargs:
+					name += '#' + hashlib.sha1(jvmargs).hexdigest()[:7]
+				result[name] = {'builds': daemon['builds'],
+								'averagebuildtime': daemon['buildtime'] / daemon['builds'],
+								'running': daemon['running'],
+								'idle': now - daemon['lastused'] if daemon['lastused'] else None,
+								'resident': now - daemon['lastused'] < self.idletimeout}
+			return result
+
+
+gradle = GradleEnvironment(gradleuserhome, gradlemaxdaemons, gradleidletimeout, gradlejvmargs, gradleconfigcache)
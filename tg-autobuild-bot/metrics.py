@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+import json
+import logging
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from contextlib import contextmanager
+from functools import wraps
+
+import config
+
+logger = logging.getLogger(__name__)
+
+"""Spans are written as one json object per line to this logger at debug level"""
+spanlogger = logging.getLogger('metrics.spans')
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+metricsport = getattr(config, 'metricsport', 0)
+metricslisten = getattr(config, 'metricslisten', '127.0.0.1')
+metricslogfile = getattr(config, 'metricslogfile', '')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+SIZE_BUCKETS = tuple(2 ** power for power in range(16, 31, 2))
+
+
+def _labelkey(labels):
+	return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _formatlabels(labelkey, extra=()):
+	pairs = list(labelkey) + list(extra)
+	if not pairs:
+		return ''
+	return '{' + ','.join('{0}="{1}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"'))
+							for key, value in pairs) + '}'
+
+
+def _formatnumber(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value))
+
+
+class Histogram(object):
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * len(buckets)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.sum += value
+		self.count += 1
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				self.counts[i] += 1
+
+
+class Registry(object):
+	"""Counters, histograms and gauges rendered in the prometheus text format. Gauges are callbacks which return a
+	number or a dict of {label value: number} and are only evaluated when the metrics are scraped"""
+
+	def __init__(self):
+		self._counters = {}
+		self._histograms = {}
+		self._buckets = {}
+		self._gauges = {}
+		self._help = {}
+		self._lock = threading.Lock()
+
+	def describe(self, name, text, buckets=None):
+		self._help[name] = text
+		if buckets is not None:
+			self._buckets[name] = buckets
+
+	def inc(self, name, value=1, **labels):
+		key = (name, _labelkey(labels))
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + value
+
+	def observe(self, name, value, **labels):
+		key = (name, _labelkey(labels))
+		with self._lock:
+			histogram = self._histograms.get(key)
+			if histogram is None:
+				histogram = self._histograms[key] = Histogram(self._buckets.get(name, DEFAULT_BUCKETS))
+			histogram.observe(value)
+
+	def gauge(self, name, func, label=None, text=None):
+		"""Register a gauge callback. If label is set, func returns a dict mapping label values to numbers"""
+		self._gauges[name] = func, label
+		if text is not None:
+			self._help[name] = text
+
+	def render(self):
+		"""Return every metric in the prometheus text exposition format"""
+		lines = []
+		with self._lock:
+			counters = sorted(self._counters.items())
+			histograms = sorted((key, (h.buckets, list(h.counts), h.sum, h.count)) for key, h in self._histograms.items())
+		typed = set()
+
+		def header(name, kind):
+			if name not in typed:
+				typed.add(name)
+				if name in self._help:
+					lines.append('# HELP {0} {1}'.format(name, self._help[name]))
+				lines.append('# TYPE {0} {1}'.format(name, kind))
+		for (name, labels), value in counters:
+			header(name, 'counter')
+			lines.append('{0}{1} {2}'.format(name, _formatlabels(labels), _formatnumber(value)))
+		for (name, labels), (buckets, counts, total, count) in histograms:
+			header(name, 'histogram')
+			for bound, bucketcount in zip(buckets, counts):
+				lines.append('{0}_bucket{1} {2}'.format(name, _formatlabels(labels, [('le', _formatnumber(bound))]),
+														bucketcount))
+			lines.append('{0}_bucket{1} {2}'.format(name, _formatlabels(labels, [('le', '+Inf')]), count))
+			lines.append('{0}_sum{1} {2}'.format(name, _formatlabels(labels), _formatnumber(total)))
+			lines.append('{0}_count{1} {2}'.format(name, _formatlabels(labels), count))
+		for name, (func, label) in sorted(self._gauges.items()):
+			try:
+				value = func()
+			except Exception as e:
+				logger.info("Gauge %s failed: %s", name, e)
+				continue
+			header(name, 'gauge')
+			if label is None:
+				lines.append('{0} {1}'.format(name, _formatnumber(value)))
+			else:
+				for labelvalue, number in sorted(value.items()):
+					lines.append('{0}{1} {2}'.format(name, _formatlabels(((label, str(labelvalue)),)),
+													_formatnumber(number)))
+		return '\n'.join(lines) + '\n'
+
+	def snapshot(self):
+		"""Return counters and histogram summaries as a json serializable dict"""
+		with self._lock:
+			counters = [{'name': name, 'labels': dict(labels), 'value': value}
+						for (name, labels), value in self._counters.items()]
+			histograms = [{'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum}
+							for (name, labels), h in self._histograms.items()]
+		return {'counters': counters, 'histograms': histograms}
+
+
+registry = Registry()
+
+
+@contextmanager
+def span(name, **labels):
+	"""Time the block. The duration is observed in the histogram name and logged as a json line together with the
+	labels and whether the block raised"""
+	started = time.time()
+	ok = True
+	try:
+		yield labels
+	except Exception:
+		ok = False
+		raise
+	finally:
+		duration = time.time() - started
+		registry.observe(name, duration, **labels)
+		record = dict(labels)
+		record.update({'span': name, 'duration': round(duration, 6), 'ok': ok, 'time': round(started, 3)})
+		spanlogger.debug(json.dumps(record, sort_keys=True))
+
+
+def timed(name, **labels):
+	"""Decorator timing every call of the function in a span"""
+	def decorator(f):
+		@wraps(f)
+		def func(*args, **kwargs):
+			with span(name, **labels):
+				return f(*args, **kwargs)
+		return func
+	return decorator
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path == '/metrics':
+			body, contenttype = registry.render(), 'text/plain; version=0.0.4'
+		elif self.path == '/metrics.json':
+			body, contenttype = json.dumps(registry.snapshot()), 'application/json'
+		else:
+			self.send_error(404)
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', contenttype)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		logger.debug(format, *args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	"""HTTP server handling every request on its own daemon thread"""
+	daemon_threads = True
+
+
+def serve(listen=metricslisten, port=metricsport):
+	"""Serve /metrics (prometheus) and /metrics.json on a background thread. Does nothing if port is 0"""
+	if metricslogfile:
+		handler = logging.FileHandler(metricslogfile)
+		handler.setFormatter(logging.Formatter('%(message)s'))
+		spanlogger.addHandler(handler)
+		spanlogger.setLevel(logging.DEBUG)
+		spanlogger.propagate = False
+	if not port:
+		return None
+	server = ThreadingHTTPServer((listen, port), _MetricsHandler)
+	thread = threading.Thread(target=server.serve_forever, name="metrics")
+	thread.daemon = True
+	thread.start()
+	return server
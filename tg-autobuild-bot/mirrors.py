@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from git import Git, Repo
+from git.exc import GitCommandError
+from git.refs.symbolic import SymbolicReference
+
+import config
+
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+mirrordir = getattr(config, 'mirrordir', 'mirrors')
+
+"""Refs a mirror fetches. Other refs, i.e. the refs/pull/* of every pull request on github, are left on the remote"""
+REFSPECS = ('+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*')
+
+
+def normalizeurl(url):
+	"""Normalize a remote url so every chat using the same repo shares the same key. Credentials, the .git suffix and
+	case are dropped"""
+	scheme, sep, rest = url.partition('://')
+	if not sep:
+		scheme, rest = '', scheme
+	rest = rest.rpartition('@')[2].rstrip('/')
+	if rest.endswith('.git'):
+		rest = rest[:-4]
+	return (scheme + sep + rest).lower()
+
+
+class MirrorManager(object):
+	"""Keeps one bare partial mirror per unique remote and checks commits of it out into worktrees.
+
+	Mirrors are bare clones of the branches and tags with --filter=blob:none, so only the blobs of the commits which
+	are actually checked out are downloaded. A worktree shares the object store of its mirror, checking out another commit only writes the changed
+	files and leaves untracked build outputs alone"""
+
+	def __init__(self, root):
+		self.root = root
+		self._locks = {}
+		self._lock = threading.Lock()
+
+	def path(self, url):
+		"""Return the directory of the mirror of url"""
+		key = normalizeurl(url)
+		name = re.sub(r'[^a-z0-9._-]+', '-', '/'.join(key.split('/')[-2:]))
+		return os.path.join(self.root, '{0}-{1}.git'.format(name, hashlib.sha1(key.encode('utf-8')).hexdigest()[:10]))
+
+	def _mirrorlock(self, path):
+		with self._lock:
+			return self._locks.setdefault(path, threading.Lock())
+
+	def exists(self, url):
+		return os.path.isdir(self.path(url))
+
+	@staticmethod
+	def _configure(path):
+		"""Make the mirror fetch only REFSPECS. Mirrors cloned with --mirror by older versions fetched every ref of the
+		remote, the refs outside REFSPECS are deleted from them once"""
+		git = Git(path)
+		try:
+			refspecs = git.config('--get-all', 'remote.origin.fetch').splitlines()
+		except GitCommandError:
+			refspecs = []
+		if refspecs == list(REFSPECS):
+			return
+		git.config('--replace-all', 'remote.origin.fetch', REFSPECS[0])
+		for refspec in REFSPECS[1:]:
+			git.config('--add', 'remote.origin.fetch', refspec)
+		try:
+			git.config('--unset', 'remote.origin.mirror')
+		except GitCommandError:
+			pass
+		stale = [ref for ref in git.for_each_ref('--format=%(refname)').splitlines()
+					if not ref.startswith(('refs/heads/', 'refs/tags/'))]
+		if stale:
+			logger.info("Deleting %d refs of %s which are not branches or tags", len(stale), path)
+			with tempfile.TemporaryFile() as commands:
+				commands.write(''.join('delete {0}\n'.format(ref) for ref in stale))
+				commands.seek(0)
+				git.execute(['git', 'update-ref', '--stdin'], istream=commands)
+
+	def sync(self, url):
+		"""Clone the mirror of url or fetch new commits into it. Raises GitCommandError if git fails"""
+		path = self.path(url)
+		with self._mirrorlock(path):
+			if not os.path.isdir(path):
+				if not os.path.isdir(self.root):
+					os.makedirs(self.root)
+				try:
+					Git().clone('--bare', '--filter=blob:none', url, path)
+					self._configure(path)
+				except Exception:
+					shutil.rmtree(path, ignore_errors=True)
+					raise
+				return
+			"""The clone url holds the credentials which may have changed since the mirror was cloned"""
+			origin = Repo(path).remotes.origin
+			if origin.url != url:
+				Git(path).remote('set-url', 'origin', url)
+			self._configure(path)
+			Git(path).fetch('--prune', 'origin')
+
+	def head(self, url):
+		"""Return the full hash of the default branch of the mirror. The refs are read directly, without running git"""
+		return SymbolicReference.dereference_recursive(Repo(self.path(url)), 'HEAD')
+
+	def changedpaths(self, url, old, new):
+		"""Return the paths changed between the commits old and new or None if old is not in the mirror anymore, i.e.
+		after a force push. Only trees are compared, no blob of the partial mirror is fetched"""
+		path = self.path(url)
+		with self._mirrorlock(path):
+			try:
+				output = Git(path).diff('--name-only', '--no-renames', old, new)
+			except GitCommandError as e:
+				logger.info(e)
+				return None
+		return [line for line in output.splitlines() if line]
+
+	def checkout(self, url, commit, worktree):
+		"""Check out commit of the mirror of url into the worktree directory, creating the worktree if needed.
+		Raises GitCommandError if git fails"""
+		path = self.path(url)
+		with self._mirrorlock(path):
+			if os.path.isfile(os.path.join(worktree, '.git')):
+				Git(worktree).checkout('--detach', '--force', commit)
+				return
+			if os.path.exists(worktree):
+				"""Most likely a full clone made by an older version of the bot. Replace it with a worktree"""
+				logger.info("Replacing %s with a worktree of %s", worktree, path)
+				shutil.rmtree(worktree)
+			Git(path).worktree('prune')
+			Git(path).worktree('add', '--detach', '--force', os.path.abspath(worktree), commit)
+
+
+mirrors = MirrorManager(mirrordir)
@@ -1,43 +1,117 @@
 #!/usr/bin/env python
-# Source: http://code.activestate.com/recipes/325905-memoize-decorator-with-timeout/#c1
+# Based on: http://code.activestate.com/recipes/325905-memoize-decorator-with-timeout/#c1
 
+import threading
 import time
+from collections import OrderedDict
 
 
 class MWT(object):
-	"""Memoize With Timeout"""
-	_caches = {}
-	_timeouts = {}
+	"""Memoize With Timeout
 
-	def __init__(self, timeout=2):
+	Every decorated function gets its own bounded cache. Results expire timeout seconds after they were computed and
+	the least recently used result is evicted once maxsize results are cached. Expired results are dropped when they
+	are looked up and by collect(), which runs at most once every timeout seconds on a call.
+
+	key is called with the arguments of the function and returns the cache key, i.e. to leave out arguments such as
+	the bot. Concurrent calls which miss on the same key compute the result once, the other callers wait for it.
+
+	The decorated function exposes stats(), invalidate(*args, **kwargs) and clear()"""
+
+	def __init__(self, timeout=2, maxsize=1024, key=None):
 		self.timeout = timeout
+		self.maxsize = maxsize
+		self.key = key
+		self.cache = OrderedDict()
+		self._inflight = {}
+		self._lock = threading.Lock()
+		self._lastcollect = time.time()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+
+	def _makekey(self, args, kwargs):
+		if self.key is not None:
+			return self.key(*args, **kwargs)
+		return args, tuple(sorted(kwargs.items()))
 
 	def collect(self):
 		"""Clear cache of results which have timed out"""
-		for func in self._caches:
-			cache = {}
-			for key in self._caches[func]:
-				if (time.time() - self._caches[func][key][1]) < self._timeouts[func]:
-					cache[key] = self._caches[func][key]
-			self._caches[func] = cache
+		now = time.time()
+		with self._lock:
+			self._lastcollect = now
+			for key in [key for key, v in self.cache.items() if now - v[1] > self.timeout]:
+				del self.cache[key]
+				self.expirations += 1
 
-	def __call__(self, f):
-		self.cache = self._caches[f] = {}
-		self._timeouts[f] = self.timeout
+	def _lookup(self, key, now):
+		"""Return (True, value) on a hit. Must be called with the lock held"""
+		try:
+			v = self.cache.pop(key)
+		except KeyError:
+			return False, None
+		if now - v[1] > self.timeout:
+			self.expirations += 1
+			return False, None
+		self.cache[key] = v
+		return True, v[0]
 
+	def _store(self, key, value, now):
+		"""Cache value and evict the least recently used results above maxsize. Must be called with the lock held"""
+		self.cache.pop(key, None)
+		self.cache[key] = value, now
+		while len(self.cache) > self.maxsize:
+			self.cache.popitem(last=False)
+			self.evictions += 1
+
+	def stats(self):
+		with self._lock:
+			return {'size': len(self.cache), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+					'evictions': self.evictions, 'expirations': self.expirations, 'inflight': len(self._inflight)}
+
+	def __call__(self, f):
 		def func(*args, **kwargs):
-			kw = sorted(kwargs.items())
-			key = (args, tuple(kw))
+			key = self._makekey(args, kwargs)
+			while True:
+				now = time.time()
+				if now - self._lastcollect > self.timeout:
+					self.collect()
+				with self._lock:
+					found, value = self._lookup(key, now)
+					if found:
+						self.hits += 1
+						return value
+					event = self._inflight.get(key)
+					if event is None:
+						"""This caller computes the result, concurrent callers for the key wait for it"""
+						self.misses += 1
+						event = self._inflight[key] = threading.Event()
+						break
+				event.wait()
+				"""Loop to pick up the result. If the computation failed, the next caller computes it again"""
 			try:
-				v = self.cache[key]
-				# print("cache")
-				if (time.time() - v[1]) > self.timeout:
-					raise KeyError
-			except KeyError:
-				# print("new")
-				v = self.cache[key] = f(*args, **kwargs), time.time()
-			return v[0]
+				value = f(*args, **kwargs)
+				with self._lock:
+					self._store(key, value, time.time())
+				return value
+			finally:
+				with self._lock:
+					del self._inflight[key]
+				event.set()
+
+		def invalidate(*args, **kwargs):
+			with self._lock:
+				self.cache.pop(self._makekey(args, kwargs), None)
+
+		def clear():
+			with self._lock:
+				self.cache.clear()
 
 		func.func_name = f.__name__
+		func.__doc__ = f.__doc__
+		func.stats = self.stats
+		func.invalidate = invalidate
+		func.clear = clear
 
 		return func
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py. The defaults are the limits telegram
+documents for bots: 30 messages per second overall, one per second in a chat and 20 per minute in a group"""
+outboxglobalrate = getattr(config, 'outboxglobalrate', 30)
+outboxprivaterate = getattr(config, 'outboxprivaterate', 1)
+outboxgrouprate = getattr(config, 'outboxgrouprate', 20 / 60.0)
+outboxmaxretries = getattr(config, 'outboxmaxretries', 5)
+
+LANES = ('short', 'upload')
+"""Seconds between sweeps of the token buckets of idle chats"""
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket(object):
+	"""Allows rate requests per second on average with bursts of up to burst requests"""
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = float(burst)
+		self.last = time.time()
+
+	def delay(self, now):
+		"""Return the seconds until a token is available"""
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+		if self.tokens >= 1:
+			return 0
+		return (1 - self.tokens) / self.rate
+
+	def take(self):
+		self.tokens -= 1
+
+	def full(self, now):
+		"""Return True if the bucket has refilled completely, it then behaves like a new bucket"""
+		return self.tokens + (now - self.last) * self.rate >= self.burst
+
+
+class OutboundRequest(object):
+	"""A bot api call waiting in the outbox. func performs the call. key is set for message edits which are merged"""
+
+	def __init__(self, chat_id, func, lane, key=None):
+		self.chat_id = chat_id
+		self.func = func
+		self.lane = lane
+		self.key = key
+		self.attempts = 0
+		self.result = None
+		self.error = None
+		self.done = threading.Event()
+
+	def wait(self):
+		"""Block until the call was made. Returns its result or raises its error"""
+		self.done.wait()
+		if self.error is not None:
+			raise self.error
+		return self.result
+
+
+class Outbox(object):
+	"""Sends bot api requests within the flood limits of telegram.
+
+	Requests wait in one of two lanes, each served by its own thread, so large document uploads do not hold up short
+	messages. A request is sent once both the global and the per chat token bucket allow it. Consecutive edits of
+	the same message which have not been sent yet are merged, only the latest text is sent. A request answered with
+	429 is retried after the retry_after telegram asks for, other chats keep being served meanwhile"""
+
+	def __init__(self, globalrate, privaterate, grouprate, maxretries):
+		self.privaterate = privaterate
+		self.grouprate = grouprate
+		self.maxretries = maxretries
+		self._global = TokenBucket(globalrate, globalrate)
+		self._chats = {}
+		self._blocked = {}
+		self._lanes = dict((lane, deque()) for lane in LANES)
+		self._edits = {}
+		self._cond = threading.Condition()
+		self._pruned = time.time()
+		self.sent = 0
+		self.merged = 0
+		self.retried = 0
+		for lane in LANES:
+			thread = threading.Thread(target=self._work, args=(lane,), name="outbox-" + lane)
+			thread.daemon = True
+			thread.start()
+
+	def _bucket(self, chat_id):
+		"""Return the token bucket of a chat. Group ids are negative. Must be called with the lock held"""
+		bucket = self._chats.get(chat_id)
+		if bucket is None:
+			if chat_id < 0:
+				bucket = TokenBucket(self.grouprate, 3)
+			else:
+				bucket = TokenBucket(self.privaterate, 3)
+			self._chats[chat_id] = bucket
+		return bucket
+
+	def _prune(self, now):
+		"""Drop the token buckets which have refilled and the holds which have expired. A chat which sends again gets a
+		new bucket, which is the same as the dropped full one. Must be called with the lock held"""
+		self._pruned = now
+		for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.full(now)]:
+			del self._chats[chat_id]
+		for chat_id in [chat_id for chat_id, until in self._blocked.items() if until <= now]:
+			del self._blocked[chat_id]
+
+	def _put(self, request):
+		with self._cond:
+			self._lanes[request.lane].append(request)
+			self._cond.notify_all()
+		return request
+
+	def edit(self, bot, chat_id, message_id, text):
+		"""Queue an edit of the text of a message. Returns without waiting for it to be sent"""
+		key = (chat_id, message_id)
+		with self._cond:
+			pending = self._edits.get(key)
+			if pending is not None:
+				pending.text = text
+				self.merged += 1
+				return pending
+			request = OutboundRequest(chat_id, None, 'short', key=key)
+			request.text = text
+			request.func = lambda: bot.edit_message_text(request.text, chat_id=chat_id, message_id=message_id)
+			self._edits[key] = request
+		return self._put(request)
+
+	def call(self, chat_id, func):
+		"""Send a short request through the outbox and wait for its result"""
+		return self._put(OutboundRequest(chat_id, func, 'short')).wait()
+
+	def upload(self, chat_id, func):
+		"""Send a document upload through the upload lane and wait for its result"""
+		return self._put(OutboundRequest(chat_id, func, 'upload')).wait()
+
+	def _next(self, queue):
+		"""Pop the first request of the lane which may be sent now and take its tokens. Returns the request or None
+		and the seconds to wait before trying again. Must be called with the lock held"""
+		now = time.time()
+		if now - self._pruned >= PRUNE_INTERVAL:
+			self._prune(now)
+		wait = self._global.delay(now)
+		if wait > 0:
+			return None, wait
+		wait = None
+		for request in queue:
+			chatwait = max(self._bucket(request.chat_id).delay(now), self._blocked.get(request.chat_id, 0) - now)
+			if chatwait <= 0:
+				queue.remove(request)
+				self._global.take()
+				self._bucket(request.chat_id).take()
+				if request.key is not None:
+					"""Later edits of the message start a new request"""
+					self._edits.pop(request.key, None)
+				return request, None
+			wait = chatwait if wait is None else min(wait, chatwait)
+		return None, wait
+
+	def _work(self, lane):
+		queue = self._lanes[lane]
+		while True:
+			with self._cond:
+				request, wait = self._next(queue)
+				while request is None:
+					self._cond.wait(wait)
+					request, wait = self._next(queue)
+			self._send(request)
+
+	def _send(self, request):
+		request.attempts += 1
+		try:
+			request.result = request.func()
+			self.sent += 1
+		except RetryAfter as e:
+			if request.attempts <= self.maxretries:
+				self._retry(request, e.retry_after)
+				return
+			request.error = e
+		except Exception as e:
+			request.error = e
+		if request.error is not None and request.key is not None:
+			"""Nobody waits for edits, log their failure here"""
+			logger.info(request.error)
+		request.done.set()
+
+	def _retry(self, request, retry_after):
+		"""Hold back the chat for retry_after seconds and put the request back at the head of its lane"""
+		with self._cond:
+			self.retried += 1
+			self._blocked[request.chat_id] = time.time() + retry_after
+			if request.key is not None:
+				if request.key in self._edits:
+					"""A newer edit is already queued and will carry the latest text"""
+					request.done.set()
+					return
+				self._edits[request.key] = request
+			self._lanes[request.lane].appendleft(request)
+			self._cond.notify_all()
+
+	def stats(self):
+		with self._cond:
+			return {'sent': self.sent, 'merged': self.merged, 'retried': self.retried, 'chats': len(self._chats),
+					'queued': dict((lane, len(queue)) for lane, queue in self._lanes.items())}
+
+
+outbox = Outbox(outboxglobalrate, outboxprivaterate, outboxgrouprate, outboxmaxretries)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+"""Lines of gradle output which start the part of the log explaining a failure"""
+FAILURE_MARKERS = ('FAILURE:', '* What went wrong:', 'e: ', 'error:')
+
+TASK_PATTERN = re.compile(r'^> Task (\S+)')
+
+
+class ProcessResult(object):
+	"""Outcome of a streamed process. tail holds the last lines of its output"""
+
+	def __init__(self, returncode, tail, logpath, timedout=None):
+		self.returncode = returncode
+		self.tail = tail
+		self.logpath = logpath
+		self.timedout = timedout
+
+	def failuretail(self, maxlines=30):
+		"""Return the lines of the tail which explain the failure. Falls back to the last maxlines lines"""
+		if self.timedout is not None:
+			return list(self.tail)[-maxlines + 1:] + ["Build killed after {0} seconds".format(self.timedout)]
+		lines = list(self.tail)
+		for i, line in enumerate(lines):
+			if line.startswith(FAILURE_MARKERS):
+				lines = lines[i:]
+				break
+		return lines[-maxlines:]
+
+
+def stream(argv, cwd, env, logpath, online=None, taillines=200, timeout=None, preexec=None):
+	"""Run argv in cwd and read its output line by line while it runs. stdout and stderr are merged, written to
+	logpath and the last taillines lines are kept in memory. online is called with every line.
+	The process runs in its own process group which is killed once it ran for timeout seconds. preexec is called in
+	the child before argv is executed"""
+	tail = deque(maxlen=taillines)
+	killed = []
+
+	def setup():
+		os.setsid()
+		if preexec is not None:
+			preexec()
+	with open(logpath, 'w') as log:
+		process = subprocess.Popen(argv, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+									preexec_fn=setup)
+
+		def kill():
+			killed.append(timeout)
+			try:
+				os.killpg(process.pid, signal.SIGKILL)
+			except OSError as e:
+				logger.info(e)
+		timer = None
+		if timeout:
+			timer = threading.Timer(timeout, kill)
+			timer.daemon = True
+			timer.start()
+		for line in iter(process.stdout.readline, b''):
+			log.write(line)
+			line = line.rstrip()
+			tail.append(line)
+			if online is not None:
+				try:
+					online(line)
+				except Exception as e:
+					logger.info(e)
+		process.stdout.close()
+		returncode = process.wait()
+		if timer is not None:
+			timer.cancel()
+	return ProcessResult(returncode, tail, logpath, timedout=killed[0] if killed else None)
+
+
+def trimlog(logpath, head=40, context=200):
+	"""Return the lines of a build log which matter to find out why it failed: the first head lines, which show the
+	gradle and plugin versions, and everything from context lines before the first failure marker to the end. Without
+	a failure marker the last context lines are kept"""
+	with open(logpath) as log:
+		lines = log.read().splitlines()
+	start = None
+	for i, line in enumerate(lines):
+		if line.startswith(FAILURE_MARKERS):
+			start = max(0, i - context)
+			break
+	if start is None:
+		start = max(0, len(lines) - context)
+	if start <= head:
+		return lines
+	return lines[:head] + ['', '... {0} lines skipped ...'.format(start - head), ''] + lines[start:]
+
+
+class GradleProgress(object):
+	"""Follows the tasks gradle runs and reports them through report(text), at most once every interval seconds and
+	only when the text changed, to stay within the message edit limits of telegram"""
+
+	def __init__(self, report, prefix, interval):
+		self.report = report
+		self.prefix = prefix
+		self.interval = interval
+		self.tasks = 0
+		self.current = None
+		self._lastreport = 0
+		self._lasttext = None
+
+	def __call__(self, line):
+		match = TASK_PATTERN.match(line)
+		if match is None:
+			return
+		self.tasks += 1
+		self.current = match.group(1)
+		now = time.time()
+		if now - self._lastreport < self.interval:
+			return
+		text = "{0}\n{1} ({2} tasks done)".format(self.prefix, self.current, self.tasks)
+		if text != self._lasttext:
+			self._lastreport = now
+			self._lasttext = text
+			self.report(text)
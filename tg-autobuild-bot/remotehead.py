@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+import json
+import logging
+import threading
+import time
+
+import requests
+from git import Git
+from git.exc import GitCommandError
+from requests.auth import HTTPBasicAuth
+
+import config
+from config import (gitusername, gitpassword)
+
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+remoteheadttl = getattr(config, 'remoteheadttl', 30)
+"""Base url of the github api, i.e. of a github enterprise server"""
+githubapiurl = getattr(config, 'githubapiurl', 'https://api.github.com').rstrip('/')
+"""A github token lets the heads of up to 100 repos be asked for with a single graphql request"""
+githubtoken = getattr(config, 'githubtoken', '')
+
+GITHUB_COMMIT_URL = githubapiurl + '/repos/{}/commits/HEAD'
+GITHUB_GRAPHQL_URL = githubapiurl + '/graphql'
+GRAPHQL_BATCH = 100
+
+"""repo -> (sha, etag, checked at). The etag is kept after the ttl expires so the next probe is a conditional request,
+which github answers with 304 without counting it against the rate limit"""
+_heads = {}
+_lock = threading.Lock()
+
+
+def _auth():
+	if not gitusername == '' and not gitpassword == '':
+		return HTTPBasicAuth(gitusername, gitpassword)
+	return None
+
+
+def _githubhead(repo, sha, etag):
+	"""Ask the github api for the sha of the default branch of repo. Returns the sha and etag or None if the api could
+	not answer"""
+	headers = {'Accept': 'application/vnd.github.sha'}
+	if etag is not None and sha is not None:
+		headers['If-None-Match'] = etag
+	try:
+		response = requests.get(GITHUB_COMMIT_URL.format(repo), headers=headers, auth=_auth(), timeout=10)
+	except requests.RequestException as e:
+		logger.info(e)
+		return None
+	if response.status_code == 304:
+		return sha, etag
+	if response.status_code == 200 and len(response.text.strip()) == 40:
+		return response.text.strip(), response.headers.get('ETag')
+	logger.info("Github api returned %s for %s", response.status_code, repo)
+	return None
+
+
+def _lsremote(cloneurl):
+	"""Ask the remote itself for the sha of HEAD with git ls-remote. Does not need a clone"""
+	try:
+		output = Git().ls_remote(cloneurl, 'HEAD')
+	except GitCommandError as e:
+		logger.info(e)
+		return None
+	sha = output.split('\t')[0].strip()
+	return sha if len(sha) == 40 else None
+
+
+def getremotehead(repo, cloneurl, maxage=None, lsremote=True):
+	"""Get the full sha of the head of the remote repo without touching the working tree. repo is the github
+	{username}/{repository} and cloneurl the url git uses to reach it. The answer is cached for maxage seconds,
+	remoteheadttl by default. git ls-remote is only run if lsremote is True and the github api could not answer.
+	Returns None if the head could not be determined"""
+	now = time.time()
+	with _lock:
+		sha, etag, checked = _heads.get(repo, (None, None, 0))
+	if sha is not None and now - checked < (remoteheadttl if maxage is None else maxage):
+		return sha
+	result = _githubhead(repo, sha, etag)
+	if result is None:
+		if not lsremote:
+			return None
+		result = _lsremote(cloneurl), None
+	if result[0] is None:
+		return None
+	with _lock:
+		_heads[repo] = result[0], result[1], now
+	return result[0]
+
+
+def forget(repo):
+	"""Drop the cached head of repo so the next probe asks the remote"""
+	with _lock:
+		_heads.pop(repo, None)
+
+
+def remember(repo, sha):
+	"""Cache a head learnt elsewhere, i.e. from a push webhook. The etag of the last conditional request is kept"""
+	with _lock:
+		etag = _heads.get(repo, (None, None, 0))[1]
+		_heads[repo] = sha, etag, time.time()
+
+
+def githubheads(repos):
+	"""Ask the github graphql api for the heads of the default branches of many repos, GRAPHQL_BATCH repos per request.
+	Needs githubtoken. Returns a dict of repo -> sha, repos which could not be resolved are left out"""
+	heads = {}
+	if not githubtoken:
+		return heads
+	repos = list(repos)
+	for start in range(0, len(repos), GRAPHQL_BATCH):
+		batch = repos[start:start + GRAPHQL_BATCH]
+		fields = []
+		for i, repo in enumerate(batch):
+			owner, _, name = repo.partition('/')
+			fields.append('r{0}: repository(owner: {1}, name: {2}) {{ defaultBranchRef {{ target {{ oid }} }} }}'.format(
+				i, json.dumps(owner), json.dumps(name)))
+		try:
+			response = requests.post(GITHUB_GRAPHQL_URL, json={'query': '{ ' + ' '.join(fields) + ' }'},
+										headers={'Authorization': 'bearer ' + githubtoken}, timeout=30)
+			data = response.json().get('data') or {}
+		except (requests.RequestException, ValueError) as e:
+			logger.info(e)
+			continue
+		for i, repo in enumerate(batch):
+			try:
+				sha = data['r{0}'.format(i)]['defaultBranchRef']['target']['oid']
+			except (KeyError, TypeError):
+				continue
+			heads[repo] = sha
+			remember(repo, sha)
+	return heads
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+import errno
+import logging
+import os
+import subprocess
+import time
+import uuid
+
+import config
+
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+buildsandbox = getattr(config, 'buildsandbox', 'none')
+buildmemory = getattr(config, 'buildmemory', 3 * 1024 * 1024 * 1024)
+buildcpuweight = getattr(config, 'buildcpuweight', 100)
+buildtimeout = getattr(config, 'buildtimeout', 60 * 60)
+buildnetwork = getattr(config, 'buildnetwork', True)
+cgrouproot = getattr(config, 'cgrouproot', '/sys/fs/cgroup/autobuild')
+buildimage = getattr(config, 'buildimage', '')
+
+
+class BuildLimits(object):
+	"""Resources a build may use. memory is in bytes, cpuweight is the cgroup v2 cpu.weight (1-10000, 100 is an equal
+	share), timeout is the wall clock limit in seconds and network tells if the build may reach the network"""
+
+	def __init__(self, memory=buildmemory, cpuweight=buildcpuweight, timeout=buildtimeout, network=buildnetwork):
+		self.memory = memory
+		self.cpuweight = cpuweight
+		self.timeout = timeout
+		self.network = network
+
+
+class Sandbox(object):
+	"""Confinement of a single build process. wrap() returns the argv to run, preexec() runs in the child before it
+	execs, peakmemory() returns the most memory the build took in bytes, if it is measured, once the process exited and
+	close() releases whatever the sandbox holds"""
+
+	def __init__(self, limits):
+		self.limits = limits
+
+	def wrap(self, argv):
+		return argv
+
+	def preexec(self):
+		pass
+
+	def peakmemory(self):
+		return None
+
+	def close(self):
+		pass
+
+
+class LocalRunner(object):
+	"""Runs builds directly in the environment of the bot. Only the wall clock timeout is enforced. Gradle daemons stay
+	warm between builds"""
+	name = 'none'
+	enforceslimits = False
+
+	def sandbox(self, repodir, env, limits):
+		return Sandbox(limits)
+
+
+class CgroupSandbox(Sandbox):
+	def __init__(self, limits, path):
+		Sandbox.__init__(self, limits)
+		self.path = path
+		os.mkdir(path)
+		self._write('memory.max', str(limits.memory))
+		self._write('memory.swap.max', '0')
+		self._write('cpu.weight', str(limits.cpuweight))
+
+	def _write(self, name, value):
+		try:
+			with open(os.path.join(self.path, name), 'w') as f:
+				f.write(value)
+		except IOError as e:
+			"""The controller may not be enabled in the parent cgroup"""
+			logger.info("Could not set %s of %s: %s", name, self.path, e)
+
+	def wrap(self, argv):
+		"""A gradle daemon would outlive the cgroup, so every build gets its own single use daemon inside it"""
+		argv = list(argv) + ['--no-daemon']
+		if not self.limits.network:
+			argv = ['unshare', '--net', '--map-root-user'] + argv
+		return argv
+
+	def preexec(self):
+		with open(os.path.join(self.path, 'cgroup.procs'), 'w') as f:
+			f.write(str(os.getpid()))
+
+	def peakmemory(self):
+		"""memory.peak needs linux 5.19 or later"""
+		try:
+			with open(os.path.join(self.path, 'memory.peak')) as f:
+				return int(f.read())
+		except (IOError, ValueError):
+			return None
+
+	def close(self):
+		"""Kill whatever the build left running and remove the cgroup"""
+		try:
+			self._write('cgroup.kill', '1')
+			for attempt in range(50):
+				try:
+					os.rmdir(self.path)
+					return
+				except OSError as e:
+					if e.errno != errno.EBUSY:
+						raise
+					time.sleep(0.1)
+			logger.info("cgroup %s is still busy", self.path)
+		except OSError as e:
+			logger.info(e)
+
+
+class CgroupRunner(object):
+	"""Runs every build in its own cgroup v2 below root, capping its memory and weighting its cpu share. The bot user
+	needs write access to root, i.e. a delegated systemd slice. Builds without network run in a new network namespace
+	through unshare"""
+	name = 'cgroup'
+	enforceslimits = True
+
+	def __init__(self, root):
+		self.root = root
+
+	def sandbox(self, repodir, env, limits):
+		return CgroupSandbox(limits, os.path.join(self.root, 'build-' + uuid.uuid4().hex[:12]))
+
+
+def gitcommondir(worktree):
+	"""Return the git directory a worktree shares with its mirror or None if worktree is not a worktree. The .git file
+	of the worktree names its git directory by absolute path, which has a commondir file pointing to the mirror"""
+	try:
+		with open(os.path.join(worktree, '.git')) as f:
+			gitdir = f.read().strip().partition('gitdir:')[2].strip()
+		with open(os.path.join(gitdir, 'commondir')) as f:
+			return os.path.abspath(os.path.join(gitdir, f.read().strip()))
+	except IOError:
+		return None
+
+
+class DockerSandbox(Sandbox):
+	def __init__(self, limits, image, repodir, env):
+		Sandbox.__init__(self, limits)
+		self.image = image
+		self.repodir = os.path.abspath(repodir)
+		self.gitdir = gitcommondir(self.repodir)
+		self.userhome = env.get('GRADLE_USER_HOME')
+		self.container = 'autobuild-' + uuid.uuid4().hex[:12]
+
+	def wrap(self, argv):
+		command = ['docker', 'run', '--rm', '--name', self.container,
+					'--user', '{0}:{1}'.format(os.getuid(), os.getgid()),
+					'--memory', str(self.limits.memory), '--memory-swap', str(self.limits.memory),
+					'--cpu-shares', str(max(2, self.limits.cpuweight * 1024 // 100)),
+					'-v', '{0}:{0}'.format(self.repodir), '-w', self.repodir]
+		if self.gitdir:
+			"""Build scripts running git, i.e. for the versionCode, need the mirror at the path the worktree names"""
+			command += ['-v', '{0}:{0}:ro'.format(self.gitdir)]
+		if self.userhome:
+			command += ['-v', '{0}:/gradle'.format(self.userhome), '-e', 'GRADLE_USER_HOME=/gradle']
+		if not self.limits.network:
+			command += ['--network', 'none']
+		return command + [self.image] + list(argv) + ['--no-daemon']
+
+	def close(self):
+		"""docker run only forwards the kill of a timed out build to the container if it is still attached"""
+		with open(os.devnull, 'w') as devnull:
+			subprocess.call(['docker', 'rm', '-f', self.container], stdout=devnull, stderr=devnull)
+
+
+class DockerRunner(object):
+	"""Runs every build in a throwaway container of image with the repo and the gradle user home mounted"""
+	name = 'docker'
+	enforceslimits = True
+
+	def __init__(self, image):
+		self.image = image
+
+	def sandbox(self, repodir, env, limits):
+		return DockerSandbox(limits, self.image, repodir, env)
+
+
+def physicalmemory():
+	"""Return the memory of the machine in bytes"""
+	return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def makerunner(kind=buildsandbox):
+	"""Return the build runner configured by buildsandbox: none, cgroup or docker"""
+	if kind == 'cgroup':
+		return CgroupRunner(cgrouproot)
+	if kind == 'docker':
+		if not buildimage:
+			raise ValueError("buildimage must be set to use the docker build sandbox")
+		return DockerRunner(buildimage)
+	return LocalRunner()
+
+
+runner = makerunner()
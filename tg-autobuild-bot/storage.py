@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+try:
+	import MySQLdb
+except ImportError:
+	MySQLdb = None
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+dbbackend = getattr(config, 'dbbackend', 'mysql')
+dbpath = getattr(config, 'dbpath', 'autobuild.sqlite3')
+dbflushinterval = getattr(config, 'dbflushinterval', 1.0)
+dbflushsize = getattr(config, 'dbflushsize', 500)
+"""The mysql credentials are not needed by the sqlite backend"""
+dbhost = getattr(config, 'dbhost', '')
+dbuser = getattr(config, 'dbuser', '')
+dbpass = getattr(config, 'dbpass', '')
+dbname = getattr(config, 'dbname', '')
+
+"""Tables of the sqlite backend, created on the first connection. repos.sql holds the same tables for mysql. {repos},
+{files}, {jobs}, {remotes} and {history} are replaced with the configured table names"""
+SQLITE_SCHEMA = '''
+create table if not exists {repos} (
+	id integer primary key autoincrement,
+	chatid integer not null,
+	url text not null collate nocase,
+	commit_hash text not null default '0',
+	adminonly integer not null default 0,
+	buildmatrix text not null default '',
+	autobuild integer not null default 0,
+	delivery text not null default 'full',
+	selected integer not null default 1,
+	unique (chatid, url));
+create index if not exists {repos}_url on {repos} (url);
+create index if not exists {repos}_autobuild on {repos} (autobuild);
+create table if not exists {remotes} (
+	id integer primary key autoincrement,
+	url text not null unique collate nocase,
+	commit_hash text,
+	built real,
+	log text);
+create table if not exists {files} (
+	id integer primary key autoincrement,
+	url text not null,
+	commit_hash text not null,
+	variant text not null,
+	file_id text not null,
+	unique (url, commit_hash, variant));
+create table if not exists {jobs} (
+	id integer primary key autoincrement,
+	repokey text not null,
+	url text not null default '',
+	commit_hash text,
+	buildmatrix text not null default '',
+	chatid integer not null,
+	messageid integer not null,
+	replyto integer not null,
+	`force` integer not null default 0,
+	priority integer not null default 10,
+	state text not null default 'queued',
+	worker text,
+	created real not null,
+	started real,
+	heartbeat real,
+	finished real);
+create index if not exists {jobs}_claim on {jobs} (state, priority, id);
+create index if not exists {jobs}_repokey on {jobs} (state, repokey);
+create table if not exists {history} (
+	id integer primary key autoincrement,
+	url text not null collate nocase,
+	commit_hash text,
+	buildmatrix text not null default '',
+	result text not null,
+	reason text not null,
+	chatid integer,
+	chats integer not null default 1,
+	started real not null,
+	duration real not null,
+	artifactbytes integer not null default 0,
+	peakmemory integer);
+create index if not exists {history}_repo on {history} (url, started);
+create index if not exists {history}_started on {history} (started);
+'''
+
+
+class MysqlBackend(object):
+	"""Connections and sql dialect of a mysql server"""
+	name = 'mysql'
+	Error = MySQLdb.Error if MySQLdb is not None else Exception
+	begin = "start transaction"
+	forupdate = " for update"
+	insertignore = "insert ignore"
+
+	def connect(self):
+		"""Open a mysql connection"""
+		if MySQLdb is None:
+			raise ImportError("The mysql backend needs the MySQLdb package")
+		db = MySQLdb.connect(host=dbhost,  # your host, usually localhost
+								user=dbuser,  # your username
+								passwd=dbpass,  # your password
+								db=dbname)
+		"""Pooled connections live across many queries. Without autocommit a select would pin the connection to an old
+		snapshot and never see rows written by other connections"""
+		db.autocommit(True)
+		return db
+
+	@staticmethod
+	def upsert(table, columns, keys):
+		"""Return an insert of columns into table which updates the columns not in keys if the keys already exist"""
+		return "insert into {0} ({1}) values ({2}) on duplicate key update {3}".format(
+			table, ", ".join(columns), ", ".join(["%s"] * len(columns)),
+			", ".join("{0}=values({0})".format(column) for column in columns if column not in keys))
+
+
+class SqliteCursor(object):
+	"""Cursor of an sqlite database with the behaviour of a MySQLdb cursor: %s placeholders and a rowcount for selects.
+	The rows of a select are fetched at once, like the buffered cursors of MySQLdb do"""
+
+	def __init__(self, connection):
+		self.connection = connection
+		self._cursor = connection.db.cursor()
+		self._rows = []
+		self.rowcount = -1
+		self.lastrowid = None
+
+	def execute(self, sql, params=()):
+		statement = self.connection.statement(sql)
+		self._cursor.execute(statement, tuple(params))
+		self._done(statement)
+		return self.rowcount
+
+	def executemany(self, sql, params):
+		statement = self.connection.statement(sql)
+		self._cursor.executemany(statement, [tuple(row) for row in params])
+		self._done(statement)
+		return self.rowcount
+
+	def _done(self, statement):
+		if statement == SqliteBackend.begin:
+			self.connection.transaction = True
+		if self._cursor.description is not None:
+			self._rows = self._cursor.fetchall()
+			self.rowcount = len(self._rows)
+		else:
+			self._rows = []
+			self.rowcount = self._cursor.rowcount
+		self.lastrowid = self._cursor.lastrowid
+
+	def fetchone(self):
+		return self._rows.pop(0) if self._rows else None
+
+	def fetchall(self):
+		rows, self._rows = self._rows, []
+		return rows
+
+	def close(self):
+		self._cursor.close()
+
+
+class SqliteConnection(object):
+	"""Connection to an sqlite database with the interface of a MySQLdb connection. Like the pooled mysql connections it
+	runs in autocommit mode, transactions are only the ones started with SqliteBackend.begin"""
+
+	def __init__(self, path, statements):
+		self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False,
+									cached_statements=256)
+		self.db.execute("pragma journal_mode=wal")
+		"""With wal, synchronous=normal loses at most the last transactions on a power failure, never the database"""
+		self.db.execute("pragma synchronous=normal")
+		self.statements = statements
+		self.transaction = False
+
+	def statement(self, sql):
+		"""Return the sqlite form of a statement written for mysql. Translations are shared by every connection"""
+		statement = self.statements.get(sql)
+		if statement is None:
+			statement = sql.replace('%s', '?')
+			self.statements[sql] = statement
+		return statement
+
+	def autocommit(self, on):
+		pass
+
+	def ping(self):
+		pass
+
+	def cursor(self):
+		return SqliteCursor(self)
+
+	def commit(self):
+		if self.transaction:
+			self.transaction = False
+			self.db.execute("commit")
+
+	def rollback(self):
+		if self.transaction:
+			self.transaction = False
+			self.db.execute("rollback")
+
+	def close(self):
+		self.db.close()
+
+
+class SqliteBackend(object):
+	"""Connections and sql dialect of an embedded sqlite database in wal mode, for deployments without a mysql server.
+	Readers do not block the writer and each other, writers take turns. The tables are created on the first connection"""
+	name = 'sqlite'
+	Error = sqlite3.Error
+	"""Take the write lock at the start, the equivalent of the locking reads the mysql backend does"""
+	begin = "begin immediate"
+	forupdate = ""
+	insertignore = "insert or ignore"
+
+	def __init__(self, path, tables):
+		self.path = path
+		self.tables = tables
+		self._statements = {}
+		self._created = False
+		self._lock = threading.Lock()
+
+	def connect(self):
+		connection = SqliteConnection(self.path, self._statements)
+		with self._lock:
+			if not self._created:
+				connection.db.executescript(SQLITE_SCHEMA.format(**self.tables))
+				self._created = True
+		return connection
+
+	@staticmethod
+	def upsert(table, columns, keys):
+		"""Return an insert of columns into table which updates the columns not in keys if the keys already exist"""
+		return "insert into {0} ({1}) values ({2}) on conflict ({3}) do update set {4}".format(
+			table, ", ".join(columns), ", ".join(["%s"] * len(columns)), ", ".join(keys),
+			", ".join("{0}=excluded.{0}".format(column) for column in columns if column not in keys))
+
+
+def makebackend(tables, kind=dbbackend):
+	"""Return the database backend configured by dbbackend: mysql or sqlite. tables maps repos, files, jobs,
+	remotes and history to the configured table names"""
+	if kind == 'sqlite':
+		return SqliteBackend(dbpath, tables)
+	if kind != 'mysql':
+		raise ValueError("Unknown dbbackend {0}".format(kind))
+	return MysqlBackend()
+
+
+class WriteBehind(object):
+	"""Batches writes which may reach the database a little later, i.e. the hash of the last build of a chat.
+
+	Writes are queued with a key. A write with the same statement and key as a queued one replaces it, so only the last
+	hash of a chat is written. Queued writes are sent every interval seconds, or as soon as maxpending are queued, with
+	one executemany per statement in a single transaction on a single pooled connection. Writes without a key are never
+	merged. If interval is 0 every write is sent right away"""
+
+	def __init__(self, pool, begin, interval=1.0, maxpending=500):
+		self.pool = pool
+		self.begin = begin
+		self.interval = interval
+		self.maxpending = maxpending
+		self._pending = OrderedDict()
+		self._seq = 0
+		self._lock = threading.Lock()
+		self._flushlock = threading.Lock()
+		self._wake = threading.Event()
+		self._closed = threading.Event()
+		self._thread = None
+		self.written = 0
+		self.merged = 0
+		self.batches = 0
+
+	def put(self, sql, params, key=None):
+		"""Queue the statement sql with params. Raises database errors to the caller if it is sent right away"""
+		if not self.interval or self._closed.is_set():
+			self._write([(sql, params)])
+			return
+		with self._lock:
+			if key is None:
+				self._seq += 1
+				key = ('', self._seq)
+			if (sql, key) in self._pending:
+				self.merged += 1
+				del self._pending[(sql, key)]
+			self._pending[(sql, key)] = params
+			full = len(self._pending) >= self.maxpending
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name="write-behind")
+				self._thread.daemon = True
+				self._thread.start()
+		if full:
+			self._wake.set()
+
+	def pending(self, sql, key):
+		"""Return the params of the queued write of sql for key or None if there is none"""
+		with self._lock:
+			return self._pending.get((sql, key))
+
+	def _run(self):
+		while not self._closed.is_set():
+			self._wake.wait(self.interval)
+			self._wake.clear()
+			try:
+				self.flush()
+			except Exception as e:
+				logger.info("Could not write %d queued writes: %s", len(self._pending), e)
+
+	def flush(self):
+		"""Send every queued write now. Writes which failed are queued again unless newer ones replaced them"""
+		with self._flushlock:
+			with self._lock:
+				batch, self._pending = self._pending, OrderedDict()
+			if not batch:
+				return
+			try:
+				self._write([(sql, params) for (sql, key), params in batch.items()])
+			except Exception:
+				with self._lock:
+					for item, params in batch.items():
+						self._pending.setdefault(item, params)
+				raise
+
+	def close(self):
+		"""Send the queued writes and write right away from now on. Used on shutdown"""
+		self._closed.set()
+		self._wake.set()
+		if self._thread is not None:
+			self._thread.join()
+		self.flush()
+
+	def _write(self, writes):
+		statements = OrderedDict()
+		for sql, params in writes:
+			statements.setdefault(sql, []).append(params)
+		with metrics.span('autobuild_db_query_seconds', query='writebehind'), self.pool.connection() as db:
+			cursor = db.cursor()
+			cursor.execute(self.begin)
+			try:
+				for sql, rows in statements.items():
+					cursor.executemany(sql, rows)
+				db.commit()
+			except Exception:
+				db.rollback()
+				raise
+		with self._lock:
+			self.written += len(writes)
+			self.batches += 1
+
+	def stats(self):
+		with self._lock:
+			return {'pending': len(self._pending), 'written': self.written, 'merged': self.merged,
+					'batches': self.batches}
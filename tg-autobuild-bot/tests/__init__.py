@@ -0,0 +1,24 @@
+"""Tests of the build queue, the outbox, the caches, the database and the mirrors. Run them from the directory of the
+bot with python -m unittest discover -s tests -t .
+
+The modules read config.py when they are imported. The tests never use the config.py of the bot, they run against a
+temporary sqlite database and directory"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+workdir = tempfile.mkdtemp(prefix='autobuild-tests-')
+atexit.register(shutil.rmtree, workdir, True)
+
+config = types.ModuleType('config')
+config.__dict__.update({
+	'botapiToken': '', 'botUserName': 'autobuildtestbot',
+	'dbbackend': 'sqlite', 'dbpath': os.path.join(workdir, 'tests.sqlite3'), 'dbtablename': 'repos',
+	'gitusername': '', 'gitpassword': '',
+	'mirrordir': os.path.join(workdir, 'mirrors'),
+	'metricsport': 0,
+})
+sys.modules['config'] = config
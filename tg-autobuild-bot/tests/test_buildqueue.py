@@ -0,0 +1,142 @@
+import threading
+import time
+import unittest
+
+from buildqueue import BuildRequest, BuildScheduler, PRIORITY_HIGH
+
+
+def request():
+	return BuildRequest(None, None, None)
+
+
+class Builds(object):
+	"""run and deliver of a scheduler. Builds block until they are released and record what ran at the same time"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.release = {}
+		self.started = []
+		self.delivered = []
+		self.running = 0
+		self.peak = 0
+
+	def gate(self, key):
+		with self.lock:
+			return self.release.setdefault(key, threading.Event())
+
+	def run(self, job):
+		with self.lock:
+			self.started.append(job.key)
+			self.running += 1
+			self.peak = max(self.peak, self.running)
+		self.gate(job.key).wait(5)
+		with self.lock:
+			self.running -= 1
+		return job.key
+
+	def deliver(self, job, result):
+		with self.lock:
+			self.delivered.append((result, list(job.requests)))
+
+	def waitfor(self, count, attr='started'):
+		deadline = time.time() + 5
+		while len(getattr(self, attr)) < count and time.time() < deadline:
+			time.sleep(0.01)
+		return len(getattr(self, attr)) >= count
+
+
+class CoalescingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.builds = Builds()
+		self.scheduler = BuildScheduler(self.builds.run, self.builds.deliver, workers=1)
+
+	def tearDown(self):
+		for key in ('a', 'b'):
+			self.builds.gate(key).set()
+		self.scheduler.shutdown(timeout=5)
+
+	def test_queued_requests_share_one_build(self):
+		self.scheduler.submit('a', 'a', request())
+		self.assertTrue(self.builds.waitfor(1))
+		first, second = request(), request()
+		self.assertEqual(self.scheduler.submit('b', 'b', first), 1)
+		self.assertEqual(self.scheduler.submit('b', 'b', second), 1)
+		self.assertEqual(self.scheduler.depth(), (1, 1))
+		self.builds.gate('a').set()
+		self.builds.gate('b').set()
+		self.assertTrue(self.builds.waitfor(2, 'delivered'))
+		self.assertEqual(self.builds.started, ['a', 'b'])
+		self.assertEqual(self.builds.delivered[1], ('b', [first, second]))
+
+	def test_request_joins_running_build(self):
+		self.scheduler.submit('a', 'a', request())
+		self.assertTrue(self.builds.waitfor(1))
+		late = request()
+		self.assertEqual(self.scheduler.submit('a', 'a', late), 0)
+		self.builds.gate('a').set()
+		self.assertTrue(self.builds.waitfor(1, 'delivered'))
+		self.assertEqual(self.builds.started, ['a'])
+		self.assertIn(late, self.builds.delivered[0][1])
+
+	def test_urgent_request_moves_job_forward(self):
+		self.scheduler.submit('a', 'a', request())
+		self.assertTrue(self.builds.waitfor(1))
+		self.scheduler.submit('b', 'b', request())
+		urgent = request()
+		self.scheduler.submit('c', 'c', urgent, priority=PRIORITY_HIGH)
+		self.assertEqual(urgent.position, 1)
+		self.builds.gate('c').set()
+		self.builds.gate('a').set()
+		self.assertTrue(self.builds.waitfor(2))
+		self.assertEqual(self.builds.started[1], 'c')
+
+
+class CapacityTest(unittest.TestCase):
+
+	def setUp(self):
+		self.builds = Builds()
+		self.scheduler = BuildScheduler(self.builds.run, self.builds.deliver, workers=4, capacity=4, maxskips=1)
+
+	def tearDown(self):
+		for key in ('small1', 'small2', 'small3', 'large', 'x1', 'x2'):
+			self.builds.gate(key).set()
+		self.scheduler.shutdown(timeout=5)
+
+	def test_builds_run_while_they_fit(self):
+		self.scheduler.submit('small1', 'small1', request(), cost=2)
+		self.scheduler.submit('small2', 'small2', request(), cost=2)
+		self.scheduler.submit('small3', 'small3', request(), cost=2)
+		self.assertTrue(self.builds.waitfor(2))
+		time.sleep(0.1)
+		self.assertEqual(self.builds.started, ['small1', 'small2'])
+		self.assertEqual(self.scheduler.usage(), {'used': 4, 'capacity': 4})
+		self.builds.gate('small1').set()
+		self.assertTrue(self.builds.waitfor(3))
+		self.assertEqual(self.builds.peak, 2)
+
+	def test_large_build_is_overtaken_at_most_maxskips_times(self):
+		self.scheduler.submit('small1', 'small1', request(), cost=2)
+		self.assertTrue(self.builds.waitfor(1))
+		self.scheduler.submit('large', 'large', request(), cost=4)
+		self.scheduler.submit('small2', 'small2', request(), cost=2)
+		self.scheduler.submit('small3', 'small3', request(), cost=2)
+		self.assertTrue(self.builds.waitfor(2))
+		time.sleep(0.1)
+		"""small2 overtook the large build once, small3 has to wait for it"""
+		self.assertEqual(self.builds.started, ['small1', 'small2'])
+		self.builds.gate('small1').set()
+		self.builds.gate('small2').set()
+		self.assertTrue(self.builds.waitfor(3))
+		self.assertEqual(self.builds.started[2], 'large')
+		self.assertEqual(self.builds.peak, 2)
+
+	def test_builds_of_the_same_directory_never_overlap(self):
+		self.scheduler.submit('x1', 'repo', request(), cost=1)
+		self.scheduler.submit('x2', 'repo', request(), cost=1)
+		self.assertTrue(self.builds.waitfor(1))
+		time.sleep(0.1)
+		self.assertEqual(self.builds.started, ['x1'])
+		self.builds.gate('x1').set()
+		self.assertTrue(self.builds.waitfor(2))
+		self.assertEqual(self.builds.peak, 1)
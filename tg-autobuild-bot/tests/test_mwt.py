@@ -0,0 +1,70 @@
+import threading
+import time
+import unittest
+
+from mwt import MWT
+
+
+class MWTTest(unittest.TestCase):
+
+	def test_concurrent_misses_compute_once(self):
+		calls = []
+
+		@MWT(timeout=60)
+		def slow(x):
+			calls.append(x)
+			time.sleep(0.2)
+			return x * 2
+		results = []
+		threads = [threading.Thread(target=lambda: results.append(slow(21))) for i in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join(5)
+		self.assertEqual(results, [42] * 8)
+		self.assertEqual(calls, [21])
+		self.assertEqual(slow.stats()['misses'], 1)
+		self.assertEqual(slow.stats()['inflight'], 0)
+
+	def test_failed_computation_is_retried(self):
+		calls = []
+
+		@MWT(timeout=60)
+		def flaky(x):
+			calls.append(x)
+			if len(calls) == 1:
+				raise ValueError(x)
+			return x
+		self.assertRaises(ValueError, flaky, 1)
+		self.assertEqual(flaky(1), 1)
+		self.assertEqual(flaky(1), 1)
+		self.assertEqual(calls, [1, 1])
+
+	def test_key_invalidate_and_size(self):
+		calls = []
+
+		@MWT(timeout=60, maxsize=2, key=lambda bot, chat_id: chat_id)
+		def fetch(bot, chat_id):
+			calls.append(chat_id)
+			return chat_id
+		fetch('bot', 1)
+		fetch('another bot', 1)
+		fetch.invalidate(None, 1)
+		fetch('bot', 1)
+		fetch('bot', 2)
+		fetch('bot', 3)
+		self.assertEqual(calls, [1, 1, 2, 3])
+		self.assertEqual(fetch.stats()['size'], 2)
+		self.assertEqual(fetch.stats()['evictions'], 1)
+
+	def test_results_expire(self):
+		calls = []
+
+		@MWT(timeout=0.05)
+		def value(x):
+			calls.append(x)
+			return x
+		value(1)
+		time.sleep(0.1)
+		value(1)
+		self.assertEqual(calls, [1, 1])
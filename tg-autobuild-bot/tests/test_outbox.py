@@ -0,0 +1,80 @@
+import threading
+import time
+import unittest
+
+from telegram.error import RetryAfter
+
+from outbox import Outbox
+
+
+class Bot(object):
+	"""Records the edits sent by the outbox"""
+
+	def __init__(self):
+		self.edits = []
+
+	def edit_message_text(self, text, chat_id, message_id):
+		self.edits.append((chat_id, message_id, text))
+
+
+class OutboxTest(unittest.TestCase):
+
+	def setUp(self):
+		self.outbox = Outbox(globalrate=100, privaterate=100, grouprate=100, maxretries=2)
+
+	def block(self, chat_id):
+		"""Hold up the short lane with a call to chat_id until the returned event is set"""
+		started, release = threading.Event(), threading.Event()
+
+		def call():
+			started.set()
+			release.wait(5)
+		thread = threading.Thread(target=self.outbox.call, args=(chat_id, call))
+		thread.daemon = True
+		thread.start()
+		self.assertTrue(started.wait(5))
+		return release
+
+	def test_pending_edits_of_a_message_are_merged(self):
+		bot = Bot()
+		release = self.block(1)
+		for i in range(5):
+			request = self.outbox.edit(bot, 1, 10, 'text {}'.format(i))
+		other = self.outbox.edit(bot, 1, 11, 'other')
+		release.set()
+		request.done.wait(5)
+		other.done.wait(5)
+		self.assertEqual(bot.edits, [(1, 10, 'text 4'), (1, 11, 'other')])
+		self.assertEqual(self.outbox.stats()['merged'], 4)
+
+	def test_retry_after_holds_back_only_the_chat(self):
+		calls = []
+
+		def limited():
+			calls.append('limited')
+			if calls.count('limited') == 1:
+				raise RetryAfter(0.3)
+			return 'sent'
+		results = {}
+		thread = threading.Thread(target=lambda: results.setdefault('limited', self.outbox.call(1, limited)))
+		thread.start()
+		time.sleep(0.1)
+		self.assertEqual(self.outbox.call(2, lambda: calls.append('other') or 'other'), 'other')
+		thread.join(5)
+		self.assertEqual(results, {'limited': 'sent'})
+		self.assertEqual(calls, ['limited', 'other', 'limited'])
+		self.assertEqual(self.outbox.stats()['retried'], 1)
+
+	def test_retries_are_bounded(self):
+		def limited():
+			raise RetryAfter(0)
+		self.assertRaises(RetryAfter, self.outbox.call, 1, limited)
+		self.assertEqual(self.outbox.stats()['retried'], 2)
+
+	def test_idle_chats_are_dropped(self):
+		for chat_id in range(10):
+			self.outbox.call(chat_id, lambda: None)
+		self.assertEqual(self.outbox.stats()['chats'], 10)
+		with self.outbox._cond:
+			self.outbox._prune(time.time() + 1)
+		self.assertEqual(self.outbox.stats()['chats'], 0)
@@ -0,0 +1,138 @@
+import threading
+import unittest
+from contextlib import contextmanager
+
+import mysqlHelper as db
+from storage import WriteBehind
+
+
+class Cursor(object):
+
+	def __init__(self, pool):
+		self.pool = pool
+
+	def execute(self, sql, params=()):
+		pass
+
+	def executemany(self, sql, rows):
+		if self.pool.failures:
+			self.pool.failures -= 1
+			raise IOError("database is gone")
+		self.pool.written.append((sql, list(rows)))
+
+
+class Pool(object):
+	"""Connection pool whose connections record the batches written and fail the first failures of them"""
+
+	def __init__(self, failures=0):
+		self.failures = failures
+		self.written = []
+
+	@contextmanager
+	def connection(self):
+		yield self
+
+	def cursor(self):
+		return Cursor(self)
+
+	def commit(self):
+		pass
+
+	def rollback(self):
+		pass
+
+
+class WriteBehindTest(unittest.TestCase):
+
+	def test_writes_with_the_same_key_are_merged(self):
+		pool = Pool()
+		writes = WriteBehind(pool, 'begin', interval=60)
+		writes.put('update hash', ('a', 1), key=1)
+		writes.put('update hash', ('b', 2), key=2)
+		writes.put('update hash', ('c', 1), key=1)
+		writes.put('insert log', ('x',))
+		writes.put('insert log', ('x',))
+		self.assertEqual(writes.pending('update hash', 1), ('c', 1))
+		writes.flush()
+		self.assertEqual(pool.written, [('update hash', [('b', 2), ('c', 1)]), ('insert log', [('x',), ('x',)])])
+		self.assertEqual(writes.stats()['merged'], 1)
+		self.assertEqual(writes.stats()['batches'], 1)
+
+	def test_failed_writes_are_queued_again(self):
+		pool = Pool(failures=1)
+		writes = WriteBehind(pool, 'begin', interval=60)
+		writes.put('update hash', ('a', 1), key=1)
+		writes.put('update hash', ('b', 2), key=2)
+		self.assertRaises(IOError, writes.flush)
+		self.assertEqual(writes.stats()['pending'], 2)
+		"""A write queued after the failure is newer than the failed one and replaces it"""
+		writes.put('update hash', ('c', 1), key=1)
+		writes.flush()
+		self.assertEqual(sorted(pool.written[0][1]), [('b', 2), ('c', 1)])
+		self.assertEqual(writes.stats()['pending'], 0)
+
+	def test_writes_are_sent_right_away_after_close(self):
+		pool = Pool()
+		writes = WriteBehind(pool, 'begin', interval=60)
+		writes.put('update hash', ('a', 1), key=1)
+		writes.close()
+		self.assertEqual(pool.written, [('update hash', [('a', 1)])])
+		writes.put('update hash', ('b', 1), key=1)
+		self.assertEqual(pool.written[-1], ('update hash', [('b', 1)]))
+
+
+class BuildJobsTest(unittest.TestCase):
+	"""The build job queue on the sqlite backend"""
+
+	def setUp(self):
+		with db.pool.connection() as conn:
+			cursor = conn.cursor()
+			cursor.execute("delete from {0}".format(db.dbjobtablename))
+
+	def addjob(self, repokey, chatid, priority=10):
+		return db.addbuildjob(repokey, repokey, 'sha', '', chatid, 1, 1, False, priority)
+
+	def test_jobs_of_a_repokey_are_claimed_together(self):
+		first = self.addjob('a', 1)
+		self.addjob('b', 2)
+		second = self.addjob('a', 3)
+		urgent = self.addjob('c', 4, priority=0)
+		self.assertEqual([job['id'] for job in db.claimbuildjobs('w1', 300)], [urgent])
+		self.assertEqual(sorted(job['id'] for job in db.claimbuildjobs('w1', 300)), [first, second])
+		self.assertEqual([job['repokey'] for job in db.claimbuildjobs('w1', 300)], ['b'])
+		self.assertEqual(db.claimbuildjobs('w1', 300), [])
+
+	def test_two_workers_never_claim_the_same_job(self):
+		ids = set(self.addjob('repo{}'.format(i % 7), i) for i in range(40))
+		claimed = {'w1': [], 'w2': []}
+		batches = []
+		start = threading.Event()
+
+		def claim(worker):
+			start.wait()
+			while True:
+				jobs = db.claimbuildjobs(worker, 300)
+				if not jobs:
+					return
+				batches.append(set(job['repokey'] for job in jobs))
+				claimed[worker].extend(job['id'] for job in jobs)
+		threads = [threading.Thread(target=claim, args=(worker,)) for worker in claimed]
+		for thread in threads:
+			thread.start()
+		start.set()
+		for thread in threads:
+			thread.join(30)
+		self.assertEqual(set(claimed['w1']) & set(claimed['w2']), set())
+		self.assertEqual(set(claimed['w1']) | set(claimed['w2']), ids)
+		self.assertEqual(len(claimed['w1']) + len(claimed['w2']), len(ids))
+		self.assertEqual(sorted(len(repokeys) for repokeys in batches), [1] * 7)
+
+	def test_jobs_of_a_silent_worker_are_claimed_again(self):
+		job = self.addjob('a', 1)
+		self.assertEqual([claimed['worker'] for claimed in db.claimbuildjobs('w1', 300)], ['w1'])
+		self.assertEqual(db.claimbuildjobs('w2', 300), [])
+		"""A stale time of -1 second makes every running job stale"""
+		claimed = db.claimbuildjobs('w2', -1)
+		self.assertEqual([(row['id'], row['worker']) for row in claimed], [(job, 'w2')])
+		db.finishbuildjobs([job], 'done')
+		self.assertEqual(db.countbuildjobs(), (0, 0))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""Build worker. Claims the build jobs the bot queues in the buildjobs table when buildbackend is 'queue', builds them
+and sends the apks to the waiting chats. Any number of workers may run on any host which reaches the database:
+
+	python worker.py [working directory]
+
+Workers on the same host need different working directories, the repos, mirrors and apks are kept below it. A worker
+runs workerthreads builds at a time"""
+import os
+import sys
+
+if __name__ == '__main__' and len(sys.argv) > 1:
+	"""The modules below load their directories relative to the working directory when they are imported"""
+	os.chdir(sys.argv[1])
+
+import logging
+import signal
+import socket
+import threading
+import time
+
+from telegram import Bot
+
+import config
+import githelper as git
+import mysqlHelper as db
+from buildhistory import history
+from buildqueue import BuildRequest, PRIORITY_LOW
+from delivery import StatusMessage, deliver, updatemessage
+from config import botapiToken
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+"""Optional tuning variables. Defaults are used if they are not set in config.py"""
+botapiurl = getattr(config, 'botapiurl', '')
+workerpollinterval = getattr(config, 'workerpollinterval', 2)
+workerheartbeat = getattr(config, 'workerheartbeat', 30)
+buildjobstale = getattr(config, 'buildjobstale', 300)
+buildjobretention = getattr(config, 'buildjobretention', 7 * 24 * 60 * 60)
+workerthreads = getattr(config, 'workerthreads', 1)
+
+stopping = threading.Event()
+"""The threads of a worker share its working directory, a repo is built by one of them at a time"""
+repolocks = {}
+repolockslock = threading.Lock()
+
+
+def repolock(url):
+	"""Return the lock of the working directory of the repo"""
+	with repolockslock:
+		return repolocks.setdefault(url.lower(), threading.Lock())
+
+
+def heartbeat(ids, done):
+	"""Keep the claim of the jobs alive until done is set. Jobs without a heartbeat for buildjobstale seconds are
+	queued again for another worker"""
+	while not done.wait(workerheartbeat):
+		db.heartbeatbuildjobs(ids)
+
+
+def runjobs(bot, jobs):
+	"""Build the claimed jobs, which share repo, commit and build matrix, and deliver the result to every chat"""
+	requests = [BuildRequest(bot, StatusMessage(bot, job['chatid'], job['replyto']),
+								StatusMessage(bot, job['chatid'], job['messageid']), force=bool(job['force']),
+								repo=job['url'], reason='autobuild' if job['priority'] == PRIORITY_LOW else 'command')
+				for job in jobs]
+	ids = [job['id'] for job in jobs]
+	logger.info("Building %s for %d chats", jobs[0]['repokey'], len(jobs))
+	for job in jobs:
+		"""The bot and the other workers change the rows of the chats, do not build from a cached copy"""
+		db.records.invalidate(job['chatid'])
+
+	def progress(text):
+		for request in requests:
+			updatemessage(request.status, text)
+	done = threading.Event()
+	beat = threading.Thread(target=heartbeat, args=(ids, done), name="heartbeat")
+	beat.daemon = True
+	beat.start()
+	result = None
+	report = {}
+	started = time.time()
+	"""The claim is kept alive until the jobs are finished, uploading the apks to every chat may take longer than
+	buildjobstale"""
+	try:
+		with repolock(jobs[0]['url']):
+			try:
+				result = git.clone(jobs[0]['url'], jobs[0]['buildmatrix'], progress,
+									force=any(request.force for request in requests), commit=jobs[0]['commit_hash'],
+									report=report)
+			except Exception as e:
+				logger.exception(e)
+		history.finished(jobs[0]['url'], jobs[0]['buildmatrix'], jobs[0]['commit_hash'], requests, result, report,
+							started)
+		deliver(requests, result)
+		db.finishbuildjobs(ids, 'done' if result is not None and result[0] else 'failed')
+	finally:
+		done.set()
+
+
+def work(bot, name):
+	"""Claim and build jobs until stopping is set"""
+	lastprune = 0
+	while not stopping.is_set():
+		if time.time() - lastprune > 60 * 60:
+			lastprune = time.time()
+			db.prunebuildjobs(lastprune - buildjobretention)
+		try:
+			jobs = db.claimbuildjobs(name, buildjobstale)
+		except Exception as e:
+			logger.info(e)
+			jobs = []
+		if not jobs:
+			stopping.wait(workerpollinterval)
+			continue
+		runjobs(bot, jobs)
+
+
+def main():
+	"""Main method of a build worker. SIGTERM and SIGINT let the running build finish before the worker exits"""
+	name = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+	bot = Bot(token=botapiToken, base_url=botapiurl or None)
+
+	def stop(signum, frame):
+		logger.info("Stopping after the running build")
+		stopping.set()
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGINT, stop)
+	logger.info("Build worker %s started in %s with %d threads", name, os.getcwd(), workerthreads)
+	threads = []
+	for i in range(workerthreads):
+		thread = threading.Thread(target=work, args=(bot, '{0}:{1}'.format(name, i) if i else name),
+									name="worker-{}".format(i))
+		thread.start()
+		threads.append(thread)
+	"""Signals are only delivered to the main thread while it is not blocked in a join"""
+	for thread in threads:
+		while thread.is_alive():
+			thread.join(1)
+	db.writes.close()
+	db.pool.closeall()
+
+
+if __name__ == '__main__':
+	main()